@@ -141,19 +141,44 @@ JAVA_HOME="$JAVA11_HOME" ./gradlew -q assemble -g ../.gradle/
 
 mkdir -p "$OUT_DIR"
 
-# Delete all locks
+# Delete all locks, the FIFOs of processes waiting for cache placeholders, and
+# the temporary files of interrupted cache writes
 if [ -d "$CACHE_DIR" ]; then
     find "$CACHE_DIR" -name "*.lock" -delete
+    find "$CACHE_DIR" -name "*.fifo" -delete
+    find "$CACHE_DIR" -name ".*.tmp" -delete
 fi
 REPOS_PATH=${AST_REPOS_PATH:-repos}
 if [ -d "$REPOS_PATH" ]; then
     find "$REPOS_PATH/locks" -name "*.lock" -delete
 fi
 
+# Keep the clones and working copies within the disk budget during the run
+if [ -n "${AST_DISK_BUDGET:-}" ]; then
+    echo "run.sh: about to run storage_manager.py in the background"
+    # The last stage that uses the clones writes the results of each repo
+    if [ "$no_timing" = false ]; then
+        results_path="$OUT_DIR/merges_timed/"
+    else
+        results_path="$OUT_DIR/merges_tested/"
+    fi
+    python3 src/python/storage_manager.py \
+        --merges_path "$OUT_DIR/merges_sampled/" \
+        --results_path "$results_path" \
+        --report "$OUT_DIR/storage_report.json" \
+        --interval 600 &
+    storage_manager_pid=$!
+    trap 'kill "$storage_manager_pid" 2>/dev/null || true' EXIT
+fi
+
 echo "run.sh: about to run delete_cache_placeholders.py"
 python3 src/python/utils/delete_cache_placeholders.py \
     --cache_dir "$CACHE_DIR"
 
+echo "run.sh: about to run prefetch_repos.py"
+python3 src/python/prefetch_repos.py \
+    --repos_csv "$REPOS_CSV"
+
 echo "run.sh: about to run write_head_hashes.py"
 python3 src/python/write_head_hashes.py \
     --repos_csv "$REPOS_CSV" \
@@ -193,6 +218,18 @@ else
         --n_merges "$total_merges"
 fi
 
+# Clone the repos that were deleted since, busiest first, while the merges are analyzed
+echo "run.sh: about to run prefetch_repos.py in the background"
+python3 src/python/prefetch_repos.py \
+    --repos_csv "$OUT_DIR/repos_head_passes.csv" \
+    --merges_path "$OUT_DIR/merges_sampled/" &
+prefetch_pid=$!
+
+echo "run.sh: about to run precompute_merge_bases.py"
+python3 src/python/precompute_merge_bases.py \
+    --repos_csv "$OUT_DIR/repos_head_passes.csv" \
+    --merges_path "$OUT_DIR/merges_sampled/"
+
 echo "run.sh: about to run merge_analyzer.py"
 python3 src/python/merge_analyzer.py \
     --repos_head_passes_csv "$OUT_DIR/repos_head_passes.csv" \
@@ -208,6 +245,8 @@ python3 src/python/merge_tester.py \
     --output_dir "$OUT_DIR/merges_tested/" \
     --cache_dir "$CACHE_DIR"
 
+wait "$prefetch_pid" || true
+
 if [ "$no_timing" = false ]; then
     echo "run.sh: about to run merge_runtime_measure.py"
     python3 src/python/merge_runtime_measure.py \
@@ -9,16 +9,22 @@ import java.io.FileReader;
 import java.io.IOException;
 import java.lang.reflect.Constructor;
 import java.lang.reflect.Method;
+import java.nio.channels.FileChannel;
+import java.nio.channels.FileLock;
 import java.nio.charset.StandardCharsets;
 import java.nio.file.Files;
 import java.nio.file.Path;
 import java.nio.file.Paths;
+import java.nio.file.StandardOpenOption;
 import java.util.ArrayList;
 import java.util.Collections;
 import java.util.Comparator;
+import java.util.HashMap;
 import java.util.HashSet;
 import java.util.LinkedHashMap;
 import java.util.List;
+import java.util.Locale;
+import java.util.Map;
 import java.util.Random;
 import java.util.Set;
 import java.util.stream.Collectors;
@@ -52,6 +58,13 @@ import org.plumelib.util.StringsPlume;
  * 1 commit SHA, parent 2 commit SHA, base commit SHA, notes. The "notes" column contains "a parent
  * is the base", "two initial commits", or is blank.
  *
+ * <p>A repository that has a local mirror (see {@code src/python/mirror_store.py}) is read from
+ * the mirror instead of being cloned from GitHub, after fetching the repository into the mirror
+ * (unless {@code AST_OFFLINE=1}). If the fetch fails, the repository is cloned from GitHub.
+ *
+ * <p>The merge bases that are in the merge base index of a repository (see {@code
+ * src/python/merge_base_index.py}) are read from it instead of being computed.
+ *
  * <p>Requires (because JGit requires authentication for cloning and fetching public repositories):
  *
  * <ul>
@@ -71,6 +84,9 @@ public class FindMergeCommits {
   /** The maximum number of merge commits to output for any given branch. */
   private static final int MAX_MERGE_COMMITS = 2000;
 
+  /** The base of two commits that have no merge base, in the merge base index. */
+  private static final String NO_MERGE_BASE = "-";
+
   /** The GitHub repositories to search for merge commits. */
   final List<OrgAndRepo> repos;
 
@@ -305,13 +321,20 @@ public class FindMergeCommits {
     }
     Git git;
     try {
-      git =
-          Git.cloneRepository()
-              .setURI("https://github.com/" + orgName + "/" + repoName + ".git")
-              .setDirectory(repoDirFile)
-              .setCloneAllBranches(true)
-              .setCredentialsProvider(credentialsProvider)
-              .call();
+      File mirrorDirFile = localMirror(orgName, repoName);
+      if (mirrorDirFile != null
+          && updateMirror(mirrorDirFile, orgName, repoName)
+          && cloneFromMirror(mirrorDirFile, repoDirFile)) {
+        git = Git.open(repoDirFile);
+      } else {
+        git =
+            Git.cloneRepository()
+                .setURI("https://github.com/" + orgName + "/" + repoName + ".git")
+                .setDirectory(repoDirFile)
+                .setCloneAllBranches(true)
+                .setCredentialsProvider(credentialsProvider)
+                .call();
+      }
     } catch (Exception e) {
       System.out.println("Exception in cloning");
       try (BufferedWriter writer = Files.newBufferedWriter(outputPath, StandardCharsets.UTF_8)) {
@@ -324,12 +347,14 @@ public class FindMergeCommits {
 
     makeBranchesForPullRequests(git);
 
+    Map<String, String> mergeBases = readMergeBaseIndex(orgName, repoName);
+
     try (BufferedWriter writer = Files.newBufferedWriter(outputPath, StandardCharsets.UTF_8)) {
       // Write the CSV header
       writer.write("idx,branch_name,merge_commit,parent_1,parent_2,notes");
       writer.newLine();
 
-      writeMergeCommitsForBranches(git, repo, orgName, repoName, writer);
+      writeMergeCommitsForBranches(git, repo, orgName, repoName, mergeBases, writer);
     }
   }
 
@@ -340,12 +365,18 @@ public class FindMergeCommits {
    * @param repo the JGit file system repository
    * @param orgName the organization (owner) name
    * @param repoName the repository name
+   * @param mergeBases the merge base index of the repository; see {@link #readMergeBaseIndex}
    * @param writer where to write the merge commits
    * @throws IOException if there is trouble reading or writing files
    * @throws GitAPIException if there is trouble running Git commands
    */
   void writeMergeCommitsForBranches(
-      Git git, FileRepository repo, String orgName, String repoName, BufferedWriter writer)
+      Git git,
+      FileRepository repo,
+      String orgName,
+      String repoName,
+      Map<String, String> mergeBases,
+      BufferedWriter writer)
       throws IOException, GitAPIException {
     // github-api.kohsuke.org gives no way to get the commits of a branch, so use JGit instead.
     // (But there is GHRepository.getSHA1(); would that have done the trick?)
@@ -362,7 +393,7 @@ public class FindMergeCommits {
     int index = 1;
     // This loop cannot be parallelized, because of the `index` variable.
     for (Ref branch : branches) {
-      index = writeMergeCommitsForBranch(index, git, repo, branch, writer, written);
+      index = writeMergeCommitsForBranch(index, git, repo, branch, mergeBases, writer, written);
     }
   }
 
@@ -373,6 +404,7 @@ public class FindMergeCommits {
    * @param git the JGit porcelain
    * @param repo the JGit file system repository
    * @param branch the branch whose commits to output
+   * @param mergeBases the merge base index of the repository; see {@link #readMergeBaseIndex}
    * @param writer where to write the merge commits
    * @param written a set of refs that have already been written, to prevent duplicates in the
    *     output
@@ -385,6 +417,7 @@ public class FindMergeCommits {
       Git git,
       FileRepository repo,
       Ref branch,
+      Map<String, String> mergeBases,
       BufferedWriter writer,
       Set<ObjectId> written)
       throws IOException, GitAPIException {
@@ -433,16 +466,22 @@ public class FindMergeCommits {
       ObjectId parent1Id = parent1.toObjectId();
       RevCommit parent2 = parents[1];
       ObjectId parent2Id = parent2.toObjectId();
-      RevCommit mergeBase = getMergeBaseCommit(git, repo, parent1, parent2);
       ObjectId mergeBaseId;
+      String indexedMergeBase =
+          mergeBases.get(ObjectId.toString(parent1Id) + " " + ObjectId.toString(parent2Id));
+      if (indexedMergeBase != null) {
+        mergeBaseId =
+            indexedMergeBase.equals(NO_MERGE_BASE) ? null : ObjectId.fromString(indexedMergeBase);
+      } else {
+        RevCommit mergeBase = getMergeBaseCommit(git, repo, parent1, parent2);
+        mergeBaseId = mergeBase == null ? null : mergeBase.toObjectId();
+      }
       String notes;
 
-      if (mergeBase == null) {
+      if (mergeBaseId == null) {
         // This merge originated from two distinct initial commits.
         notes = "two initial commits";
-        mergeBaseId = null;
       } else {
-        mergeBaseId = mergeBase.toObjectId();
         if (mergeBaseId.equals(parent1Id) || mergeBaseId.equals(parent2Id)) {
           notes = "a parent is the base";
         } else {
@@ -482,6 +521,159 @@ public class FindMergeCommits {
 
   /// Git utilities
 
+  /**
+   * Returns the directory of the local mirrors, {@code $AST_REPOS_PATH/.mirrors/} (by default
+   * {@code repos/.mirrors/}).
+   *
+   * @return the directory of the local mirrors
+   */
+  static Path mirrorsPath() {
+    String reposPath = System.getenv("AST_REPOS_PATH");
+    if (reposPath == null || reposPath.isEmpty()) {
+      reposPath = "repos";
+    }
+    return Paths.get(reposPath, ".mirrors");
+  }
+
+  /**
+   * Returns the local bare mirror of the given repository, which is maintained by {@code
+   * src/python/mirror_store.py} in {@code $AST_REPOS_PATH/.mirrors/} (by default {@code
+   * repos/.mirrors/}).
+   *
+   * @param orgName the organization (owner) name
+   * @param repoName the repository name
+   * @return the mirror directory, or null if there is no mirror of the repository
+   */
+  static @Nullable File localMirror(String orgName, String repoName) {
+    File mirrorDirFile =
+        mirrorsPath()
+            .resolve(
+                Paths.get(
+                    orgName.toLowerCase(Locale.ROOT), repoName.toLowerCase(Locale.ROOT) + ".git"))
+            .toFile();
+    return new File(mirrorDirFile, "config").exists() ? mirrorDirFile : null;
+  }
+
+  /**
+   * Fetches the repository into its local mirror, as {@code update_mirror} in {@code
+   * src/python/mirror_store.py} does and under the same lock, so that the merge commits are those
+   * of the repository now rather than those of a stale mirror. Nothing is fetched when the
+   * environment variable {@code AST_OFFLINE} is 1.
+   *
+   * @param mirrorDirFile the mirror
+   * @param orgName the organization (owner) name
+   * @param repoName the repository name
+   * @return true if the mirror is up to date, or the run is offline
+   * @throws IOException if git cannot be run or the lock cannot be taken
+   */
+  static boolean updateMirror(File mirrorDirFile, String orgName, String repoName)
+      throws IOException {
+    if ("1".equals(System.getenv("AST_OFFLINE"))) {
+      return true;
+    }
+    // The lock of get_mirror_lock in mirror_store.py: fasteners locks are fcntl locks, as are
+    // the locks of FileChannel on Linux.
+    Path lockDir = mirrorsPath().resolve(Paths.get("locks", orgName.toLowerCase(Locale.ROOT)));
+    Files.createDirectories(lockDir);
+    Path lockPath = lockDir.resolve(repoName.toLowerCase(Locale.ROOT));
+    ProcessBuilder processBuilder =
+        new ProcessBuilder(
+            "git", "--git-dir", mirrorDirFile.getAbsolutePath(), "fetch", "--quiet", "origin");
+    processBuilder.inheritIO();
+    processBuilder.environment().put("GIT_TERMINAL_PROMPT", "0");
+    processBuilder.environment().put("GIT_SSH_COMMAND", "ssh -o BatchMode=yes");
+    try (FileChannel channel =
+        FileChannel.open(lockPath, StandardOpenOption.CREATE, StandardOpenOption.WRITE)) {
+      FileLock lock = channel.lock();
+      try {
+        Process process = processBuilder.start();
+        return process.waitFor() == 0;
+      } catch (InterruptedException e) {
+        Thread.currentThread().interrupt();
+        return false;
+      } finally {
+        lock.close();
+      }
+    }
+  }
+
+  /**
+   * Reads the merge base index of the given repository, which is maintained by {@code
+   * src/python/merge_base_index.py} in {@code $AST_MERGE_BASE_INDEX/} (by default {@code
+   * $AST_REPOS_PATH/.merge_bases/}). Each line of the index is "left right base", where base is
+   * {@link #NO_MERGE_BASE} if the two commits have no merge base; other lines, such as a line
+   * that is being written, are ignored.
+   *
+   * @param orgName the organization (owner) name
+   * @param repoName the repository name
+   * @return the merge bases, keyed by "left right"; empty if the repository has no index
+   * @throws IOException if the index cannot be read
+   */
+  static Map<String, String> readMergeBaseIndex(String orgName, String repoName)
+      throws IOException {
+    String indexPath = System.getenv("AST_MERGE_BASE_INDEX");
+    if (indexPath == null || indexPath.isEmpty()) {
+      String reposPath = System.getenv("AST_REPOS_PATH");
+      if (reposPath == null || reposPath.isEmpty()) {
+        reposPath = "repos";
+      }
+      indexPath = Paths.get(reposPath, ".merge_bases").toString();
+    }
+    Path indexFile =
+        Paths.get(
+            indexPath,
+            orgName.toLowerCase(Locale.ROOT),
+            repoName.toLowerCase(Locale.ROOT) + ".txt");
+    Map<String, String> mergeBases = new HashMap<>();
+    if (!Files.exists(indexFile)) {
+      return mergeBases;
+    }
+    try (BufferedReader reader = Files.newBufferedReader(indexFile, StandardCharsets.UTF_8)) {
+      String line;
+      while ((line = reader.readLine()) != null) {
+        String[] fields = line.trim().split(" ", -1);
+        if (fields.length == 3
+            && fields[0].length() == 40
+            && fields[1].length() == 40
+            && (fields[2].length() == 40 || fields[2].equals(NO_MERGE_BASE))) {
+          mergeBases.put(fields[0] + " " + fields[1], fields[2]);
+        }
+      }
+    }
+    return mergeBases;
+  }
+
+  /**
+   * Clones a local mirror with {@code git clone --shared}, so that the clone uses the objects of
+   * the mirror instead of copying them. The branches of the mirror become the remote branches of
+   * the clone, and its pull request heads are fetched by {@link #makeBranchesForPullRequests}, as
+   * for a clone of the GitHub repository.
+   *
+   * @param mirrorDirFile the mirror
+   * @param repoDirFile the directory of the clone, which must not exist
+   * @return true if the clone succeeded
+   * @throws IOException if git cannot be run
+   */
+  static boolean cloneFromMirror(File mirrorDirFile, File repoDirFile) throws IOException {
+    Process process =
+        new ProcessBuilder(
+                "git",
+                "clone",
+                "--quiet",
+                "--shared",
+                "--no-checkout",
+                mirrorDirFile.getAbsolutePath(),
+                repoDirFile.getAbsolutePath())
+            .inheritIO()
+            .start();
+    try {
+      return process.waitFor() == 0;
+    } catch (InterruptedException e) {
+      Thread.currentThread().interrupt();
+      return false;
+    }
+  }
+
   /**
    * Returns a list, retaining only the first branch when multiple branches have the same head SHA,
    * such as refs/heads/master and refs/remotes/origin/master. The result list has elements in the
@@ -2,23 +2,68 @@
 # -*- coding: utf-8 -*-
 """Contains all the functions related to the caches. The functions to interact with each
 of the caches are in this file. Each cache is interacted with through the functions
-of this file. The caches are all JSON files and are stored in the cache directory.
+of this file. The caches are stored in the cache directory.
 There will be 4 caches in total which are stored on disk after running the run.sh script:
 1) cache/sha_cache_entry:  A cache that maps the commit hash to a sha256 hash of the repository.
 2) cache/test_cache: A cache that maps a sha256 to test results.
 3) cache/merge_results: A cache that maps a merge to the result
         of the merge (sha256, run time, and MERGE_STATE).
+The storage of the caches is done by a backend, selected by CACHE_BACKEND:
+- "json": one JSON file per repository, which is replaced on every update.
+- "sharded": one small JSON file per key, in cache_directory/shards/<repo_slug>/,
+        so that reading or writing an entry does not depend on the size of the cache.
+- "sqlite": one SQLite database (in WAL mode) per cache root, with one table per
+        cache, keyed by (repo_slug, key).  Readers never take a lock.
+The files of the "json" and "sharded" backends are encoded according to
+CACHE_ENCODING, and decoded whatever their encoding (see encode_cache_data).
+Every process counts the hits, misses, placeholder waits, lock waits and bytes
+of each cache directory; see flush_cache_stats and summarize_cache_stats.
+Files are written atomically (see write_file_atomically), so readers never take
+a lock; the lock only serializes read-modify-write cycles.
+Use migrate_cache.py to convert an existing cache from one backend to another.
+While an entry is being computed, its value is a placeholder: a lease that names
+the owner process and is renewed by a heartbeat thread.  A waiter reclaims the
+lease if the owner stops renewing it or dies, instead of waiting for TIMEOUT.
 """
 
+from collections import OrderedDict
+from contextlib import contextmanager
 from pathlib import Path
+import copy
+import errno
+import functools
+import hashlib
 import json
-from typing import Union, Tuple
+import os
+import select
+import socket
+import sqlite3
+import threading
+import uuid
+from typing import Callable, Dict, Iterator, List, Set, Union, Tuple
 import time
 import fasteners
 from loguru import logger
+from variables import CACHE_BACKEND, CACHE_ENCODING, CACHE_STATS_DIRECTORY
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# The longest time between two checks of a placeholder.  Waiters are normally
+# woken up as soon as the placeholder is replaced (see PlaceholderWaiter); this
+# bounds the delay if a notification is lost, e.g. for a writer on another host.
 CACHE_BACKOFF_TIME = 2 * 60  # 2 minutes, in seconds
 TIMEOUT = 90 * 60  # 90 minutes, in seconds
+# A lease that has not been renewed for this long belongs to a process that is
+# stuck or dead, and can be reclaimed by another process.
+LEASE_DURATION = 5 * 60  # 5 minutes, in seconds
+LEASE_HEARTBEAT_INTERVAL = 30  # 30 seconds
 
 
 def set_in_cache(
@@ -29,6 +74,8 @@ def set_in_cache(
     acquire_lock: bool = True,
 ) -> None:
     """Puts an entry in the cache, then writes the cache to disk.
+    Inside a cache_transaction, the entry is written when the transaction ends
+    (placeholders, and writes done while the caller holds the lock, are not deferred).
     This function is not thread-safe.
     Args:
         cache_key (Union[Tuple,str]): The key to check.
@@ -39,14 +86,24 @@ def set_in_cache(
     logger.debug(
         f"set_in_cache: {cache_key} {cache_value} {repo_slug} {cache_directory}"
     )
-    lock = get_cache_lock(repo_slug, cache_directory)
+    if _transaction_depth > 0 and acquire_lock and not is_placeholder(cache_value):
+        pending_entries = _pending_writes.setdefault(
+            (str(cache_directory), repo_slug), (repo_slug, cache_directory, {})
+        )[2]
+        pending_entries[cache_key] = cache_value
+        return
+    backend = get_cache_backend(repo_slug, cache_directory)
+    lock = CacheLock(backend)
     if acquire_lock:
         lock.acquire()
-    cache = load_cache(repo_slug, cache_directory)
-    cache[cache_key] = cache_value
-    write_cache(cache, repo_slug, cache_directory)
-    if acquire_lock and lock is not None:
-        lock.release()
+    try:
+        backend.write_entries({cache_key: cache_value})
+    finally:
+        if acquire_lock:
+            lock.release()
+    if not is_placeholder(cache_value):
+        release_lease(cache_key, repo_slug, cache_directory)
+        notify_placeholder_waiters(cache_key, repo_slug, cache_directory)
 
 
 def lookup_in_cache(
@@ -60,38 +117,504 @@ def lookup_in_cache(
         cache_key (Union[Tuple,str]): The key to check.
         repo_slug (str): The slug of the repository, which is "owner/reponame".
         cache_directory (Path): The path to the cache directory.
-        set_run (bool, optional) = False: Wheter to insert an empty cache entry
-            if it does not exist. This is useful for preventing multiple runs from
-            attempting to insert the same cache entry.
+        set_run (bool, optional) = False: Wheter to insert a placeholder (a lease
+            owned by this process) if the entry does not exist. This is useful for
+            preventing multiple runs from attempting to insert the same cache entry.
     Returns:
         Union[dict,None]: The cache entry if it exists, None otherwise.
     """
-    lock = get_cache_lock(repo_slug, cache_directory)
+    pending_write = _pending_writes.get((str(cache_directory), repo_slug))
+    if pending_write is not None and cache_key in pending_write[2]:
+        record_cache_event(cache_directory, "hits")
+        return copy.deepcopy(pending_write[2][cache_key])
+    backend = get_cache_backend(repo_slug, cache_directory)
+    if backend.lock_free_reads:
+        _, cache_data = backend.read_entry(cache_key)
+        if not is_placeholder(cache_data):
+            record_cache_event(cache_directory, "hits")
+            return cache_data
+    lock = CacheLock(backend)
     lock.acquire()
-    cache_entry = get_cache_path(repo_slug, cache_directory)
-    cache_entry.parent.mkdir(parents=True, exist_ok=True)
-    if is_in_cache(cache_key, repo_slug, cache_directory):
-        total_time = 0
-        while True:
-            cache = load_cache(repo_slug, cache_directory)
-            cache_data = cache[cache_key]
-            if cache_data is not None:
-                break
-            lock.release()
-            time.sleep(CACHE_BACKOFF_TIME)
-            total_time += CACHE_BACKOFF_TIME
-            if total_time > TIMEOUT:
-                return None
-            lock.acquire()
+    is_present, cache_data = backend.read_entry(cache_key)
+    if is_present and is_placeholder(cache_data):
+        logger.debug(f"lookup_in_cache: Waiting for {cache_key} for {repo_slug}")
+        # The waiter is registered while holding the lock, so a writer
+        # that replaces the placeholder after this point will notify it.
+        with PlaceholderWaiter(cache_key, repo_slug, cache_directory) as waiter:
+            start_time = time.monotonic()
+            while (
+                is_present
+                and is_placeholder(cache_data)
+                and not is_lease_stale(
+                    cache_data, cache_key, repo_slug, cache_directory
+                )
+            ):
+                lock.release()
+                remaining_time = TIMEOUT - (time.monotonic() - start_time)
+                if remaining_time <= 0:
+                    record_cache_event(cache_directory, "placeholder_waits")
+                    record_cache_event(cache_directory, "placeholder_timeouts")
+                    record_cache_event(
+                        cache_directory, "placeholder_wait_time", TIMEOUT
+                    )
+                    return None
+                waiter.wait(
+                    min(
+                        CACHE_BACKOFF_TIME,
+                        remaining_time,
+                        get_lease_remaining_time(cache_data),
+                    )
+                )
+                lock.acquire()
+                is_present, cache_data = backend.read_entry(cache_key)
+        record_cache_event(cache_directory, "placeholder_waits")
+        record_cache_event(
+            cache_directory, "placeholder_wait_time", time.monotonic() - start_time
+        )
+        if is_present and is_placeholder(cache_data):
+            logger.info(
+                f"lookup_in_cache: Reclaiming the stale lease {cache_data} "
+                f"of {cache_key} for {repo_slug}"
+            )
+            record_cache_event(cache_directory, "leases_reclaimed")
+            is_present = False
+    if is_present:
         lock.release()
+        record_cache_event(cache_directory, "hits")
         return cache_data
+    record_cache_event(cache_directory, "misses")
     if set_run:
-        logger.debug(f"lookup_in_cache: Setting {cache_key} to None for {repo_slug}")
-        set_in_cache(cache_key, None, repo_slug, cache_directory, acquire_lock=False)
+        logger.debug(f"lookup_in_cache: Leasing {cache_key} for {repo_slug}")
+        set_in_cache(
+            cache_key, make_lease(), repo_slug, cache_directory, acquire_lock=False
+        )
+        hold_lease(cache_key, repo_slug, cache_directory)
     lock.release()
     return None
 
 
+# The number of nested cache_transaction blocks being executed, and the writes
+# deferred until the outermost one ends, by (cache directory, repo slug).
+_transaction_depth = 0
+_pending_writes: Dict[Tuple[str, str], Tuple[str, Path, dict]] = {}
+
+
+@contextmanager
+def cache_transaction() -> Iterator[None]:
+    """Groups the set_in_cache calls made in a block.
+    The entries are written when the outermost transaction ends, with one lock
+    acquisition and one write per cache, even if the block raises an exception.
+    Lookups in the block see the deferred entries.  Can also be used as a decorator.
+    """
+    global _transaction_depth
+    _transaction_depth += 1
+    try:
+        yield
+    finally:
+        _transaction_depth -= 1
+        if _transaction_depth == 0:
+            commit_pending_writes()
+
+
+def commit_pending_writes() -> None:
+    """Writes the entries deferred by cache_transaction."""
+    while _pending_writes:
+        _, (repo_slug, cache_directory, entries) = _pending_writes.popitem()
+        set_many_in_cache(entries, repo_slug, cache_directory)
+
+
+def set_many_in_cache(
+    cache_entries: dict, repo_slug: str, cache_directory: Path
+) -> None:
+    """Puts several entries in the cache with one lock acquisition and one write.
+    Args:
+        cache_entries (dict): The entries to write, by key.
+        repo_slug (str): The slug of the repository, which is "owner/reponame".
+        cache_directory (Path): The path to the cache directory.
+    """
+    logger.debug(
+        f"set_many_in_cache: {len(cache_entries)} entries {repo_slug} {cache_directory}"
+    )
+    backend = get_cache_backend(repo_slug, cache_directory)
+    lock = CacheLock(backend)
+    lock.acquire()
+    try:
+        backend.write_entries(cache_entries)
+    finally:
+        lock.release()
+    for cache_key, cache_value in cache_entries.items():
+        if not is_placeholder(cache_value):
+            release_lease(cache_key, repo_slug, cache_directory)
+            notify_placeholder_waiters(cache_key, repo_slug, cache_directory)
+
+
+def _reset_transactions_after_fork() -> None:
+    """Forgets the transaction of the parent process in a forked child process."""
+    global _transaction_depth
+    _transaction_depth = 0
+    _pending_writes.clear()
+
+
+os.register_at_fork(after_in_child=_reset_transactions_after_fork)
+
+
+# The counters of the cache statistics, by cache directory.  Times are in seconds.
+CACHE_STATS_COUNTERS = (
+    "hits",
+    "misses",
+    "placeholder_waits",
+    "placeholder_wait_time",
+    "placeholder_timeouts",
+    "leases_reclaimed",
+    "lock_acquisitions",
+    "lock_wait_time",
+    "bytes_read",
+    "bytes_written",
+    "parse_time",
+)
+# The upper bounds of the buckets of the lock wait histogram, in seconds;
+# a last bucket counts the longer waits.
+LOCK_WAIT_BUCKETS = (0.001, 0.01, 0.1, 1, 10, 60)
+
+_cache_stats: Dict[str, dict] = {}
+
+
+def _get_cache_stats(cache_directory: Path) -> dict:
+    """Returns the statistics of this process for a cache directory."""
+    stats_key = str(cache_directory)
+    if stats_key not in _cache_stats:
+        _cache_stats[stats_key] = {counter: 0 for counter in CACHE_STATS_COUNTERS}
+        _cache_stats[stats_key]["lock_wait_histogram"] = [0] * (
+            len(LOCK_WAIT_BUCKETS) + 1
+        )
+    return _cache_stats[stats_key]
+
+
+def record_cache_event(
+    cache_directory: Path, counter: str, amount: Union[int, float] = 1
+) -> None:
+    """Adds to a counter of the cache statistics.
+    Args:
+        cache_directory (Path): The path to the cache directory.
+        counter (str): The counter, one of CACHE_STATS_COUNTERS.
+        amount (Union[int,float], optional) = 1: The amount to add.
+    """
+    _get_cache_stats(cache_directory)[counter] += amount
+
+
+def record_lock_wait(cache_directory: Path, wait_time: float) -> None:
+    """Records the time taken to acquire the lock of a cache.
+    Args:
+        cache_directory (Path): The path to the cache directory.
+        wait_time (float): The time taken, in seconds.
+    """
+    stats = _get_cache_stats(cache_directory)
+    stats["lock_acquisitions"] += 1
+    stats["lock_wait_time"] += wait_time
+    bucket = 0
+    while bucket < len(LOCK_WAIT_BUCKETS) and wait_time > LOCK_WAIT_BUCKETS[bucket]:
+        bucket += 1
+    stats["lock_wait_histogram"][bucket] += 1
+
+
+def flush_cache_stats(stage: str) -> None:
+    """Writes the cache statistics of this process to
+    <CACHE_STATS_DIRECTORY>/<stage>/<pid>.json, for summarize_cache_stats.
+    Args:
+        stage (str): The name of the stage, such as "merge_tester".
+    """
+    stats_path = CACHE_STATS_DIRECTORY / stage / f"{os.getpid()}.json"
+    stats_path.parent.mkdir(parents=True, exist_ok=True)
+    write_file_atomically(stats_path, json.dumps(_cache_stats, indent=4))
+
+
+def flush_cache_stats_after(stage: str) -> Callable:
+    """A decorator for the worker functions of a stage, which flushes the cache
+    statistics of the worker process after each call.
+    Args:
+        stage (str): The name of the stage, such as "merge_tester".
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            finally:
+                flush_cache_stats(stage)
+
+        return wrapper
+
+    return decorator
+
+
+def reset_cache_stats(stage: str) -> None:
+    """Deletes the cache statistics of a previous run of a stage.
+    Args:
+        stage (str): The name of the stage, such as "merge_tester".
+    """
+    for stats_path in (CACHE_STATS_DIRECTORY / stage).glob("*.json"):
+        stats_path.unlink()
+
+
+def summarize_cache_stats(stage: str) -> Dict[str, dict]:
+    """Aggregates the cache statistics of all processes of a stage, logs them, and
+    writes them to <CACHE_STATS_DIRECTORY>/<stage>.json.
+    Args:
+        stage (str): The name of the stage, such as "merge_tester".
+    Returns:
+        Dict[str,dict]: The aggregated statistics, by cache directory.
+    """
+    flush_cache_stats(stage)
+    summary: Dict[str, dict] = {}
+    for stats_path in sorted((CACHE_STATS_DIRECTORY / stage).glob("*.json")):
+        with open(stats_path, "r", encoding="utf-8") as f:
+            process_stats = json.load(f)
+        for stats_key, stats in process_stats.items():
+            if stats_key not in summary:
+                summary[stats_key] = {counter: 0 for counter in CACHE_STATS_COUNTERS}
+                summary[stats_key]["lock_wait_histogram"] = [0] * (
+                    len(LOCK_WAIT_BUCKETS) + 1
+                )
+            for counter in CACHE_STATS_COUNTERS:
+                summary[stats_key][counter] += stats[counter]
+            for bucket, count in enumerate(stats["lock_wait_histogram"]):
+                summary[stats_key]["lock_wait_histogram"][bucket] += count
+    bucket_names = [f"<={bound}s" for bound in LOCK_WAIT_BUCKETS] + [
+        f">{LOCK_WAIT_BUCKETS[-1]}s"
+    ]
+    for stats_key, stats in sorted(summary.items()):
+        histogram = ", ".join(
+            f"{name}: {count}"
+            for name, count in zip(bucket_names, stats["lock_wait_histogram"])
+        )
+        logger.info(
+            f"{stage}: Cache {stats_key}: {stats['hits']} hits, "
+            f"{stats['misses']} misses, {stats['placeholder_waits']} placeholder waits "
+            f"({stats['placeholder_wait_time']:.1f}s, "
+            f"{stats['placeholder_timeouts']} timeouts, "
+            f"{stats['leases_reclaimed']} leases reclaimed), "
+            f"{stats['lock_acquisitions']} lock acquisitions "
+            f"({stats['lock_wait_time']:.1f}s; {histogram}), "
+            f"{stats['bytes_read']} bytes read in {stats['parse_time']:.1f}s, "
+            f"{stats['bytes_written']} bytes written"
+        )
+    summary_path = CACHE_STATS_DIRECTORY / f"{stage}.json"
+    write_file_atomically(summary_path, json.dumps(summary, indent=4, sort_keys=True))
+    return summary
+
+
+def _reset_cache_stats_after_fork() -> None:
+    """Forgets the statistics of the parent process in a forked child process."""
+    _cache_stats.clear()
+
+
+os.register_at_fork(after_in_child=_reset_cache_stats_after_fork)
+
+
+class CacheLock:
+    """The lock of a cache backend, which is also held against the other threads
+    of this process (the lease heartbeat thread): the file locks of the backends
+    only exclude other processes.
+    """
+
+    def __init__(self, backend: "CacheBackend") -> None:
+        """Initializes the lock.
+        Args:
+            backend (CacheBackend): The backend whose lock to take.
+        """
+        self.lock = backend.get_lock()
+        self.cache_directory = backend.cache_directory
+
+    def acquire(self) -> None:
+        """Acquires the lock."""
+        start_time = time.monotonic()
+        _process_cache_lock.acquire()
+        self.lock.acquire()
+        record_lock_wait(self.cache_directory, time.monotonic() - start_time)
+
+    def release(self) -> None:
+        """Releases the lock."""
+        try:
+            self.lock.release()
+        finally:
+            _process_cache_lock.release()
+
+
+# Placeholders written by lookup_in_cache(set_run=True) are leases:
+#     {"__lease__": {"pid": <pid>, "host": <hostname>, "heartbeat": <time>}}
+# While the owner runs, a background thread renews the heartbeat of its leases.
+# A lease whose heartbeat is older than LEASE_DURATION, or whose owner is known
+# to be dead, is stale: a waiter reclaims it instead of waiting for TIMEOUT.
+# Placeholders of older caches are None; they have no owner and never expire.
+LEASE_KEY = "__lease__"
+
+_process_cache_lock = threading.RLock()
+# The leases held by this process, by (cache directory, repo slug, key).
+_held_leases: Dict[Tuple[str, str, str], Tuple[Union[Tuple, str], str, Path]] = {}
+_held_leases_lock = threading.Lock()
+_heartbeat_thread: Union[threading.Thread, None] = None
+
+
+def _reset_leases_after_fork() -> None:
+    """Forgets the leases of the parent process in a forked child process.
+    The heartbeat thread does not survive the fork, and the locks might have been
+    held by it.
+    """
+    global _process_cache_lock, _held_leases_lock, _heartbeat_thread
+    _process_cache_lock = threading.RLock()
+    _held_leases_lock = threading.Lock()
+    _held_leases.clear()
+    _heartbeat_thread = None
+
+
+os.register_at_fork(after_in_child=_reset_leases_after_fork)
+
+
+def is_placeholder(cache_value: Union[str, dict, None]) -> bool:
+    """Returns whether a cache value is a placeholder (None or a lease)."""
+    return cache_value is None or (
+        isinstance(cache_value, dict) and LEASE_KEY in cache_value
+    )
+
+
+def make_lease() -> dict:
+    """Returns a new lease owned by this process."""
+    return {
+        LEASE_KEY: {
+            "pid": os.getpid(),
+            "host": socket.gethostname(),
+            "heartbeat": time.time(),
+        }
+    }
+
+
+def is_own_lease(cache_value: Union[str, dict, None]) -> bool:
+    """Returns whether a cache value is a lease owned by this process."""
+    if not isinstance(cache_value, dict) or LEASE_KEY not in cache_value:
+        return False
+    lease = cache_value[LEASE_KEY]
+    return lease["pid"] == os.getpid() and lease["host"] == socket.gethostname()
+
+
+def _lease_id(
+    cache_key: Union[Tuple, str], repo_slug: str, cache_directory: Path
+) -> Tuple[str, str, str]:
+    return (str(cache_directory), repo_slug, str(cache_key))
+
+
+def is_lease_stale(
+    cache_value: Union[str, dict, None],
+    cache_key: Union[Tuple, str],
+    repo_slug: str,
+    cache_directory: Path,
+) -> bool:
+    """Returns whether a placeholder is a lease that can be reclaimed.
+    Args:
+        cache_value (Union[str,dict,None]): The placeholder.
+        cache_key (Union[Tuple,str]): The key of the placeholder.
+        repo_slug (str): The slug of the repository, which is "owner/reponame".
+        cache_directory (Path): The path to the cache directory.
+    Returns:
+        bool: True if the lease has expired or its owner is dead, False otherwise.
+    """
+    if not isinstance(cache_value, dict) or LEASE_KEY not in cache_value:
+        return False
+    lease = cache_value[LEASE_KEY]
+    if time.time() - lease["heartbeat"] > LEASE_DURATION:
+        return True
+    if lease["host"] != socket.gethostname():
+        return False
+    if lease["pid"] == os.getpid():
+        # A previous process with the same pid died without releasing the lease.
+        with _held_leases_lock:
+            return _lease_id(cache_key, repo_slug, cache_directory) not in _held_leases
+    try:
+        os.kill(lease["pid"], 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def get_lease_remaining_time(cache_value: Union[str, dict, None]) -> float:
+    """Returns the time until a lease expires, in seconds.
+    Args:
+        cache_value (Union[str,dict,None]): The placeholder.
+    Returns:
+        float: The remaining time, or infinity if the placeholder is not a lease.
+    """
+    if not isinstance(cache_value, dict) or LEASE_KEY not in cache_value:
+        return float("inf")
+    lease = cache_value[LEASE_KEY]
+    return max(0.0, lease["heartbeat"] + LEASE_DURATION - time.time())
+
+
+def hold_lease(
+    cache_key: Union[Tuple, str], repo_slug: str, cache_directory: Path
+) -> None:
+    """Records that this process holds the lease of a key, so that the heartbeat
+    thread renews it, and starts the heartbeat thread if needed.
+    Args:
+        cache_key (Union[Tuple,str]): The key of the lease.
+        repo_slug (str): The slug of the repository, which is "owner/reponame".
+        cache_directory (Path): The path to the cache directory.
+    """
+    global _heartbeat_thread
+    with _held_leases_lock:
+        _held_leases[_lease_id(cache_key, repo_slug, cache_directory)] = (
+            cache_key,
+            repo_slug,
+            cache_directory,
+        )
+        if _heartbeat_thread is None:
+            _heartbeat_thread = threading.Thread(
+                target=_renew_leases, name="cache-lease-heartbeat", daemon=True
+            )
+            _heartbeat_thread.start()
+
+
+def release_lease(
+    cache_key: Union[Tuple, str], repo_slug: str, cache_directory: Path
+) -> None:
+    """Stops renewing the lease of a key, if this process holds it.
+    Args:
+        cache_key (Union[Tuple,str]): The key of the lease.
+        repo_slug (str): The slug of the repository, which is "owner/reponame".
+        cache_directory (Path): The path to the cache directory.
+    """
+    with _held_leases_lock:
+        _held_leases.pop(_lease_id(cache_key, repo_slug, cache_directory), None)
+
+
+def _renew_leases() -> None:
+    """The body of the heartbeat thread: renews the leases held by this process."""
+    while True:
+        time.sleep(LEASE_HEARTBEAT_INTERVAL)
+        with _held_leases_lock:
+            held_leases = list(_held_leases.values())
+        for cache_key, repo_slug, cache_directory in held_leases:
+            try:
+                backend = get_cache_backend(repo_slug, cache_directory)
+                lock = CacheLock(backend)
+                lock.acquire()
+                try:
+                    _, cache_data = backend.read_entry(cache_key)
+                    if is_own_lease(cache_data):
+                        backend.write_entries({cache_key: make_lease()})
+                    else:
+                        # The entry was written or reclaimed by another process.
+                        release_lease(cache_key, repo_slug, cache_directory)
+                finally:
+                    lock.release()
+            except Exception as e:
+                logger.warning(
+                    f"_renew_leases: Could not renew the lease of {cache_key} "
+                    f"for {repo_slug}: {e}"
+                )
+
+
 # ====================== Internal functions ======================
 
 
@@ -111,6 +634,130 @@ def get_cache_lock(repo_slug: str, cache_directory: Path):
     return lock
 
 
+def get_waiter_directory(
+    cache_key: Union[Tuple, str], repo_slug: str, cache_directory: Path
+) -> Path:
+    """Returns the directory that holds the FIFOs of the processes that wait
+    for the placeholder of a key to be replaced.
+    Args:
+        cache_key (Union[Tuple,str]): The key of the placeholder.
+        repo_slug (str): The slug of the repository, which is "owner/reponame".
+        cache_directory (Path): The path to the cache directory.
+    Returns:
+        Path: The directory of the FIFOs.
+    """
+    key_hash = hashlib.sha256(str(cache_key).encode("utf-8")).hexdigest()
+    return cache_directory / "waiters" / repo_slug / key_hash
+
+
+def remove_empty_directories(directory: Path, top: Path) -> None:
+    """Removes a directory and its parents, up to top included, while they are empty."""
+    while True:
+        try:
+            directory.rmdir()
+        except OSError:
+            return
+        if directory == top:
+            return
+        directory = directory.parent
+
+
+class PlaceholderWaiter:
+    """A FIFO on which a process waits for a placeholder to be replaced.
+    set_in_cache writes a byte to every FIFO of a key when it stores a value for
+    the key, which wakes up the waiting processes immediately.  The FIFO, and the
+    directories that it leaves empty, are deleted when the waiter is closed, so
+    that nothing is left in the cache directory.
+    """
+
+    def __init__(
+        self, cache_key: Union[Tuple, str], repo_slug: str, cache_directory: Path
+    ) -> None:
+        """Creates the FIFO.
+        Args:
+            cache_key (Union[Tuple,str]): The key of the placeholder.
+            repo_slug (str): The slug of the repository, which is "owner/reponame".
+            cache_directory (Path): The path to the cache directory.
+        """
+        waiter_directory = get_waiter_directory(cache_key, repo_slug, cache_directory)
+        self.waiters_directory = cache_directory / "waiters"
+        self.fifo_path = waiter_directory / f"{os.getpid()}-{uuid.uuid4().hex}.fifo"
+        while True:
+            waiter_directory.mkdir(parents=True, exist_ok=True)
+            try:
+                os.mkfifo(self.fifo_path)
+                break
+            except FileNotFoundError:
+                # Another waiter removed the directory when it became empty.
+                continue
+        self.read_fd = os.open(self.fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+        # Holding a write end keeps the FIFO from reporting end-of-file
+        # after a notifier closes its own write end.
+        self.write_fd = os.open(self.fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+
+    def wait(self, timeout: float) -> bool:
+        """Waits until a notification arrives or the timeout expires.
+        Args:
+            timeout (float): The maximum time to wait, in seconds.
+        Returns:
+            bool: True if a notification arrived, False if the timeout expired.
+        """
+        readable, _, _ = select.select([self.read_fd], [], [], timeout)
+        if not readable:
+            return False
+        try:
+            os.read(self.read_fd, 4096)
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self) -> None:
+        """Deletes the FIFO, and the directories that it leaves empty."""
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+        self.fifo_path.unlink(missing_ok=True)
+        remove_empty_directories(self.fifo_path.parent, self.waiters_directory)
+
+    def __enter__(self) -> "PlaceholderWaiter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def notify_placeholder_waiters(
+    cache_key: Union[Tuple, str], repo_slug: str, cache_directory: Path
+) -> None:
+    """Wakes up the processes that wait for the placeholder of a key.
+    FIFOs left behind by processes that died are deleted.
+    Args:
+        cache_key (Union[Tuple,str]): The key whose value was just written.
+        repo_slug (str): The slug of the repository, which is "owner/reponame".
+        cache_directory (Path): The path to the cache directory.
+    """
+    waiter_directory = get_waiter_directory(cache_key, repo_slug, cache_directory)
+    if not waiter_directory.is_dir():
+        return
+    for fifo_path in waiter_directory.glob("*.fifo"):
+        try:
+            fd = os.open(fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+        except FileNotFoundError:
+            continue
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # No process has the FIFO open for reading.
+                fifo_path.unlink(missing_ok=True)
+                remove_empty_directories(waiter_directory, cache_directory / "waiters")
+            continue
+        try:
+            os.write(fd, b"\n")
+        except BlockingIOError:
+            # The FIFO is full, so the waiter has a pending notification already.
+            pass
+        finally:
+            os.close(fd)
+
+
 def get_cache_path(repo_slug: str, cache_directory: Path) -> Path:
     """Returns the path to the cache file.
     Args:
@@ -136,8 +783,8 @@ def is_in_cache(
     Returns:
         bool: True if the repository is in the cache, False otherwise.
     """
-    cache = load_cache(repo_slug, cache_directory)
-    return cache_key in cache
+    is_present, _ = get_cache_backend(repo_slug, cache_directory).read_entry(cache_key)
+    return is_present
 
 
 def load_cache(repo_slug: str, cache_directory: Path) -> dict:
@@ -148,28 +795,570 @@ def load_cache(repo_slug: str, cache_directory: Path) -> dict:
     Returns:
         dict: The cache.
     """
-    cache_path = get_cache_path(repo_slug, cache_directory)
-    if not cache_path.exists():
-        return {}
-    with open(cache_path, "r", encoding="utf-8") as f:
-        cache_data = json.load(f)
-        return cache_data
+    return get_cache_backend(repo_slug, cache_directory).load()
 
 
-def write_cache(
-    cache: dict,
+def get_cache_backend(
     repo_slug: str,
     cache_directory: Path,
-) -> None:
-    """Writes the cache to disk.
+    backend_name: str = CACHE_BACKEND,
+    encoding: str = CACHE_ENCODING,
+) -> "CacheBackend":
+    """Returns the backend that stores the cache of a repository.
     Args:
-        cache (dict): The cache to write.
         repo_slug (str): The slug of the repository, which is "owner/reponame".
         cache_directory (Path): The path to the cache directory.
+        backend_name (str, optional) = CACHE_BACKEND: The name of the backend.
+        encoding (str, optional) = CACHE_ENCODING: The encoding of the files written
+            by the backend.
+    Returns:
+        CacheBackend: The backend.
     """
-    cache_path = get_cache_path(repo_slug, cache_directory)
-    cache_path.parent.mkdir(parents=True, exist_ok=True)
-    output = json.dumps(cache, indent=4, sort_keys=True)
-    with open(cache_path, "w", encoding="utf-8") as f:
-        f.write(output)
-        f.flush()
+    if backend_name not in CACHE_BACKENDS:
+        raise ValueError(f"Unknown cache backend: {backend_name}")
+    return CACHE_BACKENDS[backend_name](repo_slug, cache_directory, encoding)
+
+
+def get_stored_key(cache_key: Union[Tuple, str, list]) -> str:
+    """Returns the key under which an entry is stored by the sharded and SQLite
+    backends, the string of the key, so that a key read back from the storage
+    compares equal to the key used by the callers.  A tuple key that was stored
+    as a JSON list is converted back to a tuple first.
+    Args:
+        cache_key (Union[Tuple,str,list]): The key of the entry.
+    Returns:
+        str: The stored key.
+    """
+    if isinstance(cache_key, list):
+        cache_key = tuple(cache_key)
+    return str(cache_key)
+
+
+class CacheBackend:
+    """The storage of the cache of one repository.
+    A backend only stores entries; the placeholder protocol of lookup_in_cache
+    is implemented on top of it.  A placeholder is an entry whose value is None.
+    """
+
+    # Whether read_entry can be called without holding the lock of the backend.
+    lock_free_reads: bool = False
+
+    def __init__(
+        self, repo_slug: str, cache_directory: Path, encoding: str = CACHE_ENCODING
+    ) -> None:
+        """Initializes the backend.
+        Args:
+            repo_slug (str): The slug of the repository, which is "owner/reponame".
+            cache_directory (Path): The path to the cache directory.
+            encoding (str, optional) = CACHE_ENCODING: The encoding of the files
+                written by the backend (see encode_cache_data).
+        """
+        if encoding not in CACHE_ENCODINGS:
+            raise ValueError(f"Unknown cache encoding: {encoding}")
+        self.repo_slug = repo_slug
+        self.cache_directory = cache_directory
+        self.encoding = encoding
+
+    def get_lock(self):
+        """Returns the lock that serializes the writers of this cache.
+        Initially the lock is unlocked; the caller must explictly
+        lock and unlock the lock.
+        """
+        return get_cache_lock(self.repo_slug, self.cache_directory)
+
+    def read_entry(
+        self, cache_key: Union[Tuple, str]
+    ) -> Tuple[bool, Union[str, dict, None]]:
+        """Reads a single entry.
+        Args:
+            cache_key (Union[Tuple,str]): The key to read.
+        Returns:
+            bool: True if the key is in the cache, False otherwise.
+            Union[str,dict,None]: The value of the entry, or None if the key is not
+                in the cache.  The value is also None for a placeholder.
+        """
+        raise NotImplementedError
+
+    def write_entries(self, entries: dict) -> None:
+        """Writes entries, replacing existing entries with the same keys.
+        The caller must hold the lock of the backend.
+        Args:
+            entries (dict): The entries to write.
+        """
+        raise NotImplementedError
+
+    def load(self) -> dict:
+        """Reads every entry.
+        Returns:
+            dict: The cache.
+        """
+        raise NotImplementedError
+
+    def delete(self) -> None:
+        """Deletes every entry."""
+        raise NotImplementedError
+
+    @classmethod
+    def find_repo_caches(cls, cache_root: Path) -> List[Tuple[str, Path]]:
+        """Finds every repository cache stored by this backend.
+        Args:
+            cache_root (Path): The root of the caches, such as "cache".
+        Returns:
+            List[Tuple[str,Path]]: The repository slug and the cache directory
+                of each repository cache.
+        """
+        raise NotImplementedError
+
+
+class JsonFileBackend(CacheBackend):
+    """Stores the cache of a repository in one JSON file, <cache_directory>/<repo_slug>.json.
+    Parsed files are kept in a process-local LRU (see read_json_cache_file),
+    so repeated lookups in the same file do not parse it again.
+    """
+
+    lock_free_reads = True
+
+    def read_entry(
+        self, cache_key: Union[Tuple, str]
+    ) -> Tuple[bool, Union[str, dict, None]]:
+        cache_path = get_cache_path(self.repo_slug, self.cache_directory)
+        cache = read_json_cache_file(cache_path, self.cache_directory)
+        if cache_key not in cache:
+            return False, None
+        # Copy the value, so that callers cannot modify the parsed file.
+        return True, copy.deepcopy(cache[cache_key])
+
+    def write_entries(self, entries: dict) -> None:
+        cache_path = get_cache_path(self.repo_slug, self.cache_directory)
+        cache = dict(read_json_cache_file(cache_path, self.cache_directory))
+        cache.update(entries)
+        output = encode_cache_data(cache, self.encoding)
+        write_file_atomically(cache_path, output)
+        record_cache_event(self.cache_directory, "bytes_written", len(output))
+        remember_json_cache_file(cache_path, cache, output)
+
+    def load(self) -> dict:
+        cache_path = get_cache_path(self.repo_slug, self.cache_directory)
+        return dict(read_json_cache_file(cache_path, self.cache_directory))
+
+    def delete(self) -> None:
+        get_cache_path(self.repo_slug, self.cache_directory).unlink(missing_ok=True)
+
+    @classmethod
+    def find_repo_caches(cls, cache_root: Path) -> List[Tuple[str, Path]]:
+        repo_caches = []
+        for cache_file in cache_root.glob("**/*.json"):
+            if "shards" in cache_file.parts or "locks" in cache_file.parts:
+                continue
+            repo_slug = cache_file.parent.name + "/" + cache_file.stem
+            repo_caches.append((repo_slug, cache_file.parent.parent))
+        return repo_caches
+
+
+# The encodings of cache files.  The first bytes of a zstd frame.
+CACHE_ENCODINGS = ("json", "compact", "zstd")
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+ZSTD_LEVEL = 3
+
+
+def encode_cache_data(cache_data: dict, encoding: str) -> bytes:
+    """Encodes the content of a cache file.
+    Args:
+        cache_data (dict): The content of the file.
+        encoding (str): "json" for indented JSON with sorted keys (the format of
+            the archived cache), "compact" for JSON without whitespace, or "zstd"
+            for compact JSON compressed with zstd.
+    Returns:
+        bytes: The encoded content.
+    """
+    if encoding == "json":
+        return json.dumps(cache_data, indent=4, sort_keys=True).encode("utf-8")
+    if orjson is not None:
+        output = orjson.dumps(cache_data)
+    else:
+        output = json.dumps(cache_data, separators=(",", ":")).encode("utf-8")
+    if encoding == "zstd":
+        if zstandard is None:
+            raise ValueError("The zstd cache encoding requires the zstandard package")
+        output = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(output)
+    return output
+
+
+def decode_cache_data(raw_data: bytes) -> dict:
+    """Decodes the content of a cache file in any encoding.
+    Args:
+        raw_data (bytes): The encoded content.
+    Returns:
+        dict: The content of the file.
+    """
+    if raw_data.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise ValueError("Reading a zstd cache file requires the zstandard package")
+        raw_data = zstandard.ZstdDecompressor().decompress(raw_data)
+    if orjson is not None:
+        return orjson.loads(raw_data)
+    return json.loads(raw_data)
+
+
+def write_file_atomically(path: Path, content: Union[str, bytes]) -> None:
+    """Replaces the content of a file atomically.
+    The content is written to a temporary file in the same directory, which is
+    synced to disk and then renamed over the file, so a reader sees either the
+    old or the new content, never a partially written file.
+    Args:
+        path (Path): The path to the file.
+        content (Union[str,bytes]): The new content of the file.
+    """
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    temporary_path = path.parent / f".{path.name}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+    fd = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with open(fd, "wb") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, path)
+    except BaseException:
+        temporary_path.unlink(missing_ok=True)
+        raise
+
+
+# The maximum total size of the parsed JSON cache files that a process keeps in
+# memory, measured as the size of their JSON text; the parsed objects take a few
+# times more.  The most recently used file is kept even if it is larger, since
+# it would otherwise be parsed again on every lookup.
+PARSED_CACHE_FILES_SIZE_LIMIT = 16 * 1024 * 1024  # 16 MiB
+# A file modified less than this long before it was parsed might be modified
+# again without a visible change of its modification time, so its parsed
+# content is not trusted ("racy" files, as in git's index).
+RACY_WINDOW_NS = 1_000_000_000  # 1 second, in nanoseconds
+
+# Maps the path of a JSON cache file to its parsed content, to the
+# (mtime_ns, size, inode) signature and parse time that validate the content,
+# and to the size of its JSON text.
+_parsed_cache_files: "OrderedDict[Path, Tuple[Tuple[int, int, int], int, dict, int]]" = OrderedDict()
+
+
+def read_json_cache_file(cache_path: Path, cache_directory: Path) -> dict:
+    """Returns the parsed content of a JSON cache file.
+    The content is served from the process-local LRU if the file has not changed
+    since it was parsed; otherwise the file is parsed and the LRU is updated.
+    The returned dictionary is shared with the LRU and must not be modified.
+    Args:
+        cache_path (Path): The path to the cache file.
+        cache_directory (Path): The cache directory of the file, for the statistics.
+    Returns:
+        dict: The content of the file, or an empty dictionary if it does not exist.
+    """
+    try:
+        stat = cache_path.stat()
+    except FileNotFoundError:
+        _parsed_cache_files.pop(cache_path, None)
+        return {}
+    signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    # The heartbeat thread can update the LRU concurrently, so the entry is read
+    # with a single lookup.
+    parsed_entry = _parsed_cache_files.get(cache_path)
+    if parsed_entry is not None:
+        parsed_signature, parsed_time, cache_data, _ = parsed_entry
+        if (
+            parsed_signature == signature
+            and stat.st_mtime_ns + RACY_WINDOW_NS < parsed_time
+        ):
+            try:
+                _parsed_cache_files.move_to_end(cache_path)
+            except KeyError:
+                pass
+            return cache_data
+    parsed_time = time.time_ns()
+    with open(cache_path, "rb") as f:
+        raw_data = f.read()
+    cache_data = decode_cache_data(raw_data)
+    record_cache_event(cache_directory, "bytes_read", len(raw_data))
+    record_cache_event(
+        cache_directory, "parse_time", (time.time_ns() - parsed_time) / 1e9
+    )
+    _remember_parsed(
+        cache_path, signature, parsed_time, cache_data, get_decoded_size(raw_data)
+    )
+    return cache_data
+
+
+def remember_json_cache_file(
+    cache_path: Path, cache_data: dict, raw_data: bytes
+) -> None:
+    """Records the content that this process has just written to a JSON cache file.
+    Args:
+        cache_path (Path): The path to the cache file.
+        cache_data (dict): The content of the file.
+        raw_data (bytes): The encoded content of the file.
+    """
+    stat = cache_path.stat()
+    signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    # The file was renamed into place whole, and any later write replaces it with
+    # another inode, so the content is not racy: it is recorded as parsed after
+    # the racy window, and the next lookup is served from the LRU.
+    _remember_parsed(
+        cache_path,
+        signature,
+        stat.st_mtime_ns + RACY_WINDOW_NS + 1,
+        cache_data,
+        get_decoded_size(raw_data),
+    )
+
+
+def _remember_parsed(
+    cache_path: Path,
+    signature: Tuple[int, int, int],
+    parsed_time: int,
+    cache_data: dict,
+    size: int,
+) -> None:
+    """Puts a parsed JSON cache file in the LRU, evicting the least recently used
+    ones while the LRU is larger than PARSED_CACHE_FILES_SIZE_LIMIT."""
+    _parsed_cache_files[cache_path] = (signature, parsed_time, cache_data, size)
+    _parsed_cache_files.move_to_end(cache_path)
+    total_size = sum(entry[3] for entry in list(_parsed_cache_files.values()))
+    while total_size > PARSED_CACHE_FILES_SIZE_LIMIT and len(_parsed_cache_files) > 1:
+        _, evicted_entry = _parsed_cache_files.popitem(last=False)
+        total_size -= evicted_entry[3]
+
+
+def get_decoded_size(raw_data: bytes) -> int:
+    """Returns the size of the JSON text of an encoded cache file.
+    Args:
+        raw_data (bytes): The encoded content of the file.
+    Returns:
+        int: The size in bytes.  For a zstd frame it is the content size recorded
+            in the frame, or the size of the frame if it is not recorded.
+    """
+    if raw_data.startswith(ZSTD_MAGIC) and zstandard is not None:
+        content_size = zstandard.frame_content_size(raw_data)
+        if content_size >= 0:
+            return content_size
+    return len(raw_data)
+
+
+class ShardedBackend(CacheBackend):
+    """Stores each entry of the cache of a repository in its own JSON file,
+    in <cache_directory>/shards/<repo_slug>/.
+    The file name is the sha256 of the key, so that any key is a valid file name.
+    The first two characters of the hash are used as a subdirectory, so that
+    no directory contains too many files.  Keys are stored as strings (see
+    get_stored_key), as in the SQLite backend.
+    """
+
+    lock_free_reads = True
+
+    def get_shard_directory(self) -> Path:
+        """Returns the directory that holds the per-key files of the repository."""
+        return self.cache_directory / "shards" / self.repo_slug
+
+    def get_shard_path(self, cache_key: Union[Tuple, str]) -> Path:
+        """Returns the path to the file that holds a single entry.
+        Args:
+            cache_key (Union[Tuple,str]): The key of the entry.
+        Returns:
+            Path: The path to the file of the entry.
+        """
+        key_hash = hashlib.sha256(get_stored_key(cache_key).encode("utf-8")).hexdigest()
+        return self.get_shard_directory() / key_hash[:2] / (key_hash + ".json")
+
+    def read_entry(
+        self, cache_key: Union[Tuple, str]
+    ) -> Tuple[bool, Union[str, dict, None]]:
+        shard_path = self.get_shard_path(cache_key)
+        if not shard_path.exists():
+            return False, None
+        with open(shard_path, "rb") as f:
+            raw_data = f.read()
+        record_cache_event(self.cache_directory, "bytes_read", len(raw_data))
+        return True, decode_cache_data(raw_data)["value"]
+
+    def write_entries(self, entries: dict) -> None:
+        for cache_key, cache_value in entries.items():
+            shard_path = self.get_shard_path(cache_key)
+            shard_path.parent.mkdir(parents=True, exist_ok=True)
+            output = encode_cache_data(
+                {"key": get_stored_key(cache_key), "value": cache_value},
+                self.encoding,
+            )
+            write_file_atomically(shard_path, output)
+            record_cache_event(self.cache_directory, "bytes_written", len(output))
+
+    def load(self) -> dict:
+        cache_data = {}
+        for shard_path in self.get_shard_directory().glob("*/*.json"):
+            with open(shard_path, "rb") as f:
+                raw_data = f.read()
+            record_cache_event(self.cache_directory, "bytes_read", len(raw_data))
+            shard = decode_cache_data(raw_data)
+            cache_data[get_stored_key(shard["key"])] = shard["value"]
+        return cache_data
+
+    def delete(self) -> None:
+        for shard_path in self.get_shard_directory().glob("*/*.json"):
+            shard_path.unlink(missing_ok=True)
+            remove_empty_directories(shard_path.parent, self.cache_directory / "shards")
+
+    @classmethod
+    def find_repo_caches(cls, cache_root: Path) -> List[Tuple[str, Path]]:
+        repo_caches = []
+        for shards_root in cache_root.glob("**/shards"):
+            for repo_dir in shards_root.glob("*/*"):
+                repo_slug = repo_dir.parent.name + "/" + repo_dir.name
+                repo_caches.append((repo_slug, shards_root.parent))
+        return repo_caches
+
+
+# The SQLite connections of this process, by thread and database path.  Each
+# thread has its own connection, so that the transactions of the main thread and
+# the writes of the lease heartbeat thread are not mixed on one connection, and
+# connections are not shared with forked worker processes, so the key includes
+# the process id.
+_sqlite_connections: Dict[Tuple[int, int, Path], sqlite3.Connection] = {}
+_sqlite_tables: Set[Tuple[int, int, Path, str]] = set()
+
+
+class SQLiteTransaction:
+    """A lock that holds a write transaction on a SQLite database.
+    Only one process at a time can hold it; readers are never blocked.
+    """
+
+    def __init__(self, connection: sqlite3.Connection) -> None:
+        """Initializes the lock.
+        Args:
+            connection (sqlite3.Connection): The connection to the database.
+        """
+        self.connection = connection
+
+    def acquire(self) -> None:
+        """Starts the write transaction, waiting for other writers to finish."""
+        self.connection.execute("BEGIN IMMEDIATE")
+
+    def release(self) -> None:
+        """Commits the write transaction, or rolls it back if it cannot be
+        committed, so that the connection is never left in a transaction."""
+        try:
+            self.connection.execute("COMMIT")
+        except sqlite3.Error:
+            if self.connection.in_transaction:
+                self.connection.execute("ROLLBACK")
+            raise
+
+    def __enter__(self) -> "SQLiteTransaction":
+        self.acquire()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.release()
+
+
+class SQLiteBackend(CacheBackend):
+    """Stores the caches in a SQLite database, <cache_directory>/../cache.sqlite3.
+    Each cache directory (sha_cache_entry, test_cache, ...) is a table keyed by
+    (repo_slug, key); values are compact JSON text, whatever the encoding of the
+    backend.  The database is in WAL mode, so
+    readers see the last committed entries without taking a lock.
+    """
+
+    lock_free_reads = True
+
+    def __init__(
+        self, repo_slug: str, cache_directory: Path, encoding: str = CACHE_ENCODING
+    ) -> None:
+        super().__init__(repo_slug, cache_directory, encoding)
+        self.database_path = cache_directory.parent / "cache.sqlite3"
+        self.table = '"' + cache_directory.name.replace('"', '""') + '"'
+        self.connection = self.connect()
+
+    def connect(self) -> sqlite3.Connection:
+        """Returns the connection of this thread to the database,
+        creating the database and the table if needed.
+        """
+        connection_key = (os.getpid(), threading.get_ident(), self.database_path)
+        if connection_key not in _sqlite_connections:
+            self.database_path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(
+                self.database_path,
+                timeout=TIMEOUT,
+                isolation_level=None,
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            _sqlite_connections[connection_key] = connection
+        connection = _sqlite_connections[connection_key]
+        if connection_key + (self.table,) not in _sqlite_tables:
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} "
+                "(repo_slug TEXT NOT NULL, key TEXT NOT NULL, value TEXT, "
+                "PRIMARY KEY (repo_slug, key)) WITHOUT ROWID"
+            )
+            _sqlite_tables.add(connection_key + (self.table,))
+        return connection
+
+    def get_lock(self) -> SQLiteTransaction:
+        return SQLiteTransaction(self.connection)
+
+    def read_entry(
+        self, cache_key: Union[Tuple, str]
+    ) -> Tuple[bool, Union[str, dict, None]]:
+        row = self.connection.execute(
+            f"SELECT value FROM {self.table} WHERE repo_slug = ? AND key = ?",
+            (self.repo_slug, get_stored_key(cache_key)),
+        ).fetchone()
+        if row is None:
+            return False, None
+        record_cache_event(self.cache_directory, "bytes_read", len(row[0]))
+        return True, json.loads(row[0])
+
+    def write_entries(self, entries: dict) -> None:
+        rows = [
+            (self.repo_slug, get_stored_key(cache_key), json.dumps(cache_value))
+            for cache_key, cache_value in entries.items()
+        ]
+        self.connection.executemany(
+            f"INSERT OR REPLACE INTO {self.table} (repo_slug, key, value) "
+            "VALUES (?, ?, ?)",
+            rows,
+        )
+        record_cache_event(
+            self.cache_directory, "bytes_written", sum(len(row[2]) for row in rows)
+        )
+
+    def load(self) -> dict:
+        rows = self.connection.execute(
+            f"SELECT key, value FROM {self.table} WHERE repo_slug = ?",
+            (self.repo_slug,),
+        )
+        return {cache_key: json.loads(value) for cache_key, value in rows}
+
+    def delete(self) -> None:
+        self.connection.execute(
+            f"DELETE FROM {self.table} WHERE repo_slug = ?", (self.repo_slug,)
+        )
+
+    @classmethod
+    def find_repo_caches(cls, cache_root: Path) -> List[Tuple[str, Path]]:
+        repo_caches = []
+        for database_path in cache_root.glob("**/cache.sqlite3"):
+            connection = sqlite3.connect(database_path)
+            tables = connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            ).fetchall()
+            for (table,) in tables:
+                quoted_table = '"' + table.replace('"', '""') + '"'
+                for (repo_slug,) in connection.execute(
+                    f"SELECT DISTINCT repo_slug FROM {quoted_table}"
+                ):
+                    repo_caches.append((repo_slug, database_path.parent / table))
+            connection.close()
+        return repo_caches
+
+
+CACHE_BACKENDS = {
+    "json": JsonFileBackend,
+    "sharded": ShardedBackend,
+    "sqlite": SQLiteBackend,
+}
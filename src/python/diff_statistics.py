@@ -1,27 +1,43 @@
 # -*- coding: utf-8 -*-
-from pathlib import Path
-from typing import Union, Set
+"""Computes the diff statistics of a merge for merge_analyzer.py.
+A DiffStatistics computes the merge base once, the changed files of each edge
+(left-right, base-left and base-right) once, and streams the patch from left to
+right once with context and once without (git does not always split the changes
+the same way with and without context, so the hunks without context cannot be
+derived from the patch with context), and derives every statistic of
+DIFF_STATISTICS from them.  The changed lines are counted on the patch with
+context rather than with a --numstat pass: the patch is read anyway for
+imports_involved, which also looks at the context lines, so a --numstat pass
+would add a third pass instead of replacing one.  The patches are read line by line as git writes
+them, and are never held in memory.  The values are those of the former
+implementation, which ran a git command per statistic:
+- a set of changed files contains the empty string when it is not empty, since
+  it was the set of the lines of `git diff --name-only`, which ends with a newline;
+- the number of hunks, which was counted by `git diff --unified=0 | grep -c '^@@'`,
+  is "Error" when there is no hunk, since grep then failed;
+- num_diff_lines and imports_involved are None when the patch is not valid
+  UTF-8, since the whole patch was decoded.  For that reason the pass does not
+  stop at the first "import ", though it stops looking for it.
+"""
+
+from typing import Dict, Set, Tuple, Union
 
 from loguru import logger
 
 from repo import Repository
 
+DIFF_STATISTICS = (
+    "num_diff_files",
+    "union_diff_files",
+    "num_intersecting_files",
+    "num_diff_lines",
+    "num_diff_hunks",
+    "imports_involved",
+    "non_java_involved",
+    "diff contains java file",
+)
 
-def get_diff(
-    repo: Repository, left_sha: str, right_sha: str, diff_log_file: Union[None, Path]
-) -> str:
-    """
-    Computes the git diff between two commits.
-    Args:
-        repo (Repository): The repository object.
-        left_sha (str): The left sha.
-        right_sha (str): The right sha.
-    Returns:
-        str: A string containing the diff result.
-    """
-    command = f"git diff {left_sha} {right_sha}"
-    stdout, _ = repo.run_command(command)
-    return stdout
+DIFF_STATISTIC_VALUE = Union[int, bool, str, None]
 
 
 def get_diff_files(repo: Repository, left_sha: str, right_sha: str) -> set:
@@ -34,210 +50,155 @@ def get_diff_files(repo: Repository, left_sha: str, right_sha: str) -> set:
     Returns:
         set: A set containing the files that differ.
     """
-    # Using git diff to compare the two SHAs
-    command = f"git diff --name-only {left_sha} {right_sha}"
-    stdout, _ = repo.run_command(command)
-    return set(stdout.split("\n")) if stdout else set()
-
-
-def compute_num_diff_hunks(repo: Repository, left_sha: str, right_sha: str) -> int:
-    """
-    Compute the number of hunks that are different between two commits using git diff.
-    Args:
-        repo (Repository): The repository object.
-        left_sha (str): The left sha.
-        right_sha (str): The right sha.
-    Returns:
-        int: The number of hunks that are different between the two commits.
-    """
-    try:
-        diff, _ = repo.run_command(
-            f"git diff --unified=0 {left_sha} {right_sha} | grep -c '^@@'"
-        )
-    except Exception as e:
-        logger.error(
-            f"compute_num_diff_hunks: {left_sha} {right_sha} {repo.repo_slug} {e}"
-        )
-        return "Error"
-    return int(diff)
-
-
-def get_diff_files_merge(
-    repo: Repository,
-    left_sha: str,
-    right_sha: str,
-) -> Set[str]:
-    """
-    Computes the intersection of files that are different between a three-way merge using git diff.
-    Args:
-        repo (Repository): The repository object.
-        merge_idx (str): The merge index, such as 42-123.
-        repo_slug (str): The repository slug.
-        left_sha (str): The left sha.
-        right_sha (str): The right sha.
-        cache_dir (Path): The path to the cache directory.
-    Returns:
-        Set[str]: A set containing the files that differ.
-    """
-    command = f"git merge-base {left_sha} {right_sha}"
-    base_sha = repo.run_command(command)[0].strip()
-    left_right_files = get_diff_files(repo, left_sha, right_sha)
-    base_right_files = get_diff_files(repo, base_sha, right_sha)
-    base_left_files = get_diff_files(repo, base_sha, left_sha)
-
-    # Check that at least one java file is contained in all 3 diffs
-    common_files = left_right_files & base_right_files & base_left_files
-
-    return common_files
-
-
-def diff_contains_java_file(
-    repo: Repository, left_sha: str, right_sha: str
-) -> Union[bool, None]:
-    """
-    Computes whether the diff between two commits contains a java file.
-    Args:
-        repo (Repository): The repository object.
-        left_sha (str): The left sha.
-        right_sha (str): The right sha.
-    Returns:
-        bool: True if the diff contains a java file, False otherwise.
-    """
-    try:
-        merge_diff = get_diff_files_merge(repo, left_sha, right_sha)
-    except Exception as e:
-        logger.error(
-            f"diff_contains_java_file: {left_sha} {right_sha} {repo.repo_slug} {e}"
-        )
-        return None
-    return any(file.endswith(".java") for file in merge_diff)
-
-
-def diff_contains_non_java_file(
-    repo: Repository, left_sha: str, right_sha: str
-) -> Union[bool, None]:
-    """
-    Computes whether the diff between two commits contains a non-Java file.
-    Args:
-        repo (Repository): The repository object.
-        left_sha (str): The left sha.
-        right_sha (str): The right sha.
-    Returns:
-        bool: True if the diff contains a non-Java file, False otherwise.
-    """
-    try:
-        merge_diff = get_diff_files(repo, left_sha, right_sha)
-    except Exception as e:
-        logger.error(
-            f"diff_contains_non_java_file: {left_sha} {right_sha} {repo.repo_slug} {e}"
-        )
-        return None
-    return any(not file.endswith(".java") for file in merge_diff)
-
-
-def compute_num_different_files(
-    repo: Repository, left_sha: str, right_sha: str
-) -> Union[int, None]:
-    """
-    Computes the number of files that are different between two commits.
-    Args:
-        repo (Repository): The repository object.
-        left_sha (str): The left sha.
-        right_sha (str): The right sha.
-    Returns:
-        int: The number of files that are different between the two commits.
-    """
-    try:
-        diff_file = get_diff_files(repo, left_sha, right_sha)
-    except Exception as e:
-        logger.error(
-            f"compute_num_different_files: {left_sha} {right_sha} {repo.repo_slug} {e}"
-        )
-        return None
-    return len(diff_file)
-
-
-def compute_union_of_different_files_three_way(
-    repo: Repository, base_sha: str, left_sha: str, right_sha: str
-) -> int:
-    """
-    Computes the union of files that are different between a three-way merge using git diff.
-    Args:
-        repo (Repository): The repository object.
-        base_sha (str): The base sha.
-        left_sha (str): The left sha.
-        right_sha (str): The right sha.
-    Returns:
-        int: The number of files that are invovled in a git diff between the two commits.
-    """
-    base_left_files = get_diff_files(repo, base_sha, left_sha)
-    base_right_files = get_diff_files(repo, base_sha, right_sha)
-
-    return len(base_left_files.union(base_right_files))
-
-
-def compute_intersection_of_diff(
-    repo: Repository, base_sha: str, left_sha: str, right_sha: str
-) -> int:
-    """
-    Computes the intersection of files that are different between a three-way merge using git diff.
-    Args:
-        repo (Repository): The repository object.
-        base_sha (str): The base sha.
-        left_sha (str): The left sha.
-        right_sha (str): The right sha.
-    Returns:
-        int: The number of common files between the two commits in a git diff.
-    """
-    base_left_files = get_diff_files(repo, base_sha, left_sha)
-    base_right_files = get_diff_files(repo, base_sha, right_sha)
-
-    return len(base_left_files.intersection(base_right_files))
-
-
-def compute_num_different_lines(
-    repo: Repository, left_sha: str, right_sha: str
-) -> Union[int, None]:
-    """
-    Computes the number of lines that are different between two commits.
-    Args:
-        repo (Repository): The repository object.
-        left_sha (str): The left sha.
-        right_sha (str): The right sha.
-    Returns:
-        int: The number of lines that are different between the two commits.
-    """
-    try:
-        diff = get_diff(repo, left_sha, right_sha, None)
-    except Exception as e:
-        logger.error(
-            f"compute_num_different_lines: {left_sha} {right_sha} {repo.repo_slug} {e}"
-        )
-        return None
-    return sum(
-        1
-        for line in diff.splitlines()
-        if line.startswith(("+", "-")) and not line.startswith(("+++ ", "--- "))
-    )
-
-
-def compute_are_imports_involved(
-    repo: Repository, left_sha: str, right_sha: str
-) -> Union[bool, None]:
-    """
-    Computes whether the diff between two commits contains an import statement.
-    Args:
-        repo (Repository): The repository object.
-        left_sha (str): The left sha.
-        right_sha (str): The right sha.
-    Returns:
-        bool: True if the diff contains an import statement, False otherwise.
-    """
-    try:
-        diff = get_diff(repo, left_sha, right_sha, None)
-    except Exception as e:
-        logger.error(
-            f"compute_imports_involved: {left_sha} {right_sha} {repo.repo_slug} {e}"
-        )
-        return None
-    return "import " in diff
+    files = repo.get_git_query_service().changed_paths(left_sha, right_sha)
+    # The set of the lines of `git diff --name-only` included the empty string
+    # after its last newline; it is kept, so that the statistics do not change.
+    return set(files) | {""} if files else set()
+
+
+class DiffStatistics:
+    """The diff statistics of a merge.  The diffs are computed on first use."""
+
+    def __init__(self, repo: Repository, left_sha: str, right_sha: str) -> None:
+        """Initializes the statistics.
+        Args:
+            repo (Repository): The repository object.
+            left_sha (str): The left sha.
+            right_sha (str): The right sha.
+        """
+        self.repo = repo
+        self.left_sha = left_sha
+        self.right_sha = right_sha
+        self.base_sha: Union[str, None] = None
+        self.diff_files: Dict[Tuple[str, str], Set[str]] = {}
+        # num_diff_lines and imports_involved, computed in one pass.
+        self.patch_statistics: Union[Dict[str, DIFF_STATISTIC_VALUE], None] = None
+        self.num_hunks: Union[int, None] = None
+
+    def get_base_sha(self) -> str:
+        """Returns the merge base of the left and right commits.
+        Raises:
+            ValueError: If they have no merge base.
+        """
+        if self.base_sha is None:
+            self.base_sha = self.repo.get_git_query_service().merge_base(
+                self.left_sha, self.right_sha
+            )
+            if self.base_sha is None:
+                raise ValueError(
+                    f"No merge base of {self.left_sha} and {self.right_sha}"
+                )
+        return self.base_sha
+
+    def get_diff_files(self, from_sha: str, to_sha: str) -> Set[str]:
+        """Returns the files that differ between two commits, as get_diff_files."""
+        if (from_sha, to_sha) not in self.diff_files:
+            self.diff_files[(from_sha, to_sha)] = get_diff_files(
+                self.repo, from_sha, to_sha
+            )
+        return self.diff_files[(from_sha, to_sha)]
+
+    def scan_diff(self) -> Dict[str, DIFF_STATISTIC_VALUE]:
+        """Computes num_diff_lines and imports_involved in one pass over the diff
+        between the left and right commits.
+        Raises:
+            UnicodeDecodeError: If the diff is not valid UTF-8.
+        """
+        if self.patch_statistics is None:
+            num_lines = 0
+            imports_involved = False
+            for line in self.repo.get_git_query_service().diff_lines(
+                self.left_sha, self.right_sha, "-p"
+            ):
+                text = line.decode("utf-8")
+                if not imports_involved:
+                    imports_involved = "import " in text
+                # As for the whole diff, str.splitlines also splits at carriage
+                # returns and other line boundaries.
+                num_lines += sum(
+                    1
+                    for part in text.splitlines()
+                    if part.startswith(("+", "-"))
+                    and not part.startswith(("+++ ", "--- "))
+                )
+            self.patch_statistics = {
+                "num_diff_lines": num_lines,
+                "imports_involved": imports_involved,
+            }
+        return self.patch_statistics
+
+    def count_hunks(self) -> int:
+        """Counts the lines of the diff without context between the left and right
+        commits that start with "@@", as `grep -c '^@@'` did, without decoding it."""
+        if self.num_hunks is None:
+            self.num_hunks = sum(
+                1
+                for line in self.repo.get_git_query_service().diff_lines(
+                    self.left_sha, self.right_sha, "-p", "--unified=0"
+                )
+                if line.startswith(b"@@")
+            )
+        return self.num_hunks
+
+    def compute(self, name: str) -> DIFF_STATISTIC_VALUE:
+        """Computes a statistic.
+        Args:
+            name (str): The statistic, one of DIFF_STATISTICS.
+        Returns:
+            DIFF_STATISTIC_VALUE: The value of the statistic: None, "Error" (for
+                num_diff_hunks) or "Error while retrieving base sha" (for
+                union_diff_files and num_intersecting_files) if it cannot be
+                computed.
+        """
+        if name in ("union_diff_files", "num_intersecting_files"):
+            try:
+                base_sha = self.get_base_sha()
+            except Exception as e:
+                logger.error(
+                    f"DiffStatistics: Error while computing the merge base: {e}"
+                )
+                return "Error while retrieving base sha"
+            base_left_files = self.get_diff_files(base_sha, self.left_sha)
+            base_right_files = self.get_diff_files(base_sha, self.right_sha)
+            if name == "union_diff_files":
+                return len(base_left_files | base_right_files)
+            return len(base_left_files & base_right_files)
+        try:
+            return self.compute_from_diffs(name)
+        except Exception as e:
+            logger.error(
+                f"DiffStatistics: {name}: {self.left_sha} {self.right_sha} "
+                f"{self.repo.repo_slug} {e}"
+            )
+            return "Error" if name == "num_diff_hunks" else None
+
+    def compute_from_diffs(self, name: str) -> DIFF_STATISTIC_VALUE:
+        """Computes a statistic other than union_diff_files and
+        num_intersecting_files.
+        Raises:
+            Exception: If the statistic cannot be computed.
+        """
+        if name == "num_diff_files":
+            return len(self.get_diff_files(self.left_sha, self.right_sha))
+        if name == "non_java_involved":
+            return any(
+                not file.endswith(".java")
+                for file in self.get_diff_files(self.left_sha, self.right_sha)
+            )
+        if name == "diff contains java file":
+            base_sha = self.get_base_sha()
+            # The files that differ on each of the three edges of the merge.
+            common_files = (
+                self.get_diff_files(self.left_sha, self.right_sha)
+                & self.get_diff_files(base_sha, self.right_sha)
+                & self.get_diff_files(base_sha, self.left_sha)
+            )
+            return any(file.endswith(".java") for file in common_files)
+        if name in ("num_diff_lines", "imports_involved"):
+            return self.scan_diff()[name]
+        if name == "num_diff_hunks":
+            num_hunks = self.count_hunks()
+            if num_hunks == 0:
+                raise ValueError("No hunk")
+            return num_hunks
+        raise ValueError(f"Unknown diff statistic: {name}")
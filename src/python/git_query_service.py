@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""Answers git queries about a repository without starting a git process per query.
+A GitQueryService keeps long-lived git processes on the git directory of a clone:
+- `git cat-file --batch-check` and `git cat-file --batch` resolve revisions and
+  read objects;
+- `git diff-tree --stdin -r -M <options>`, one per set of options, diffs two
+  commits like `git diff [<options>] <commit> <commit>` does.
+Each query is written to the standard input of a process, and its answer is read
+from the standard output.  diff-tree echoes the lines of its input that are not
+object ids, so a unique marker line written after each query ends its answer.
+Merge bases are computed with `git merge-base` and memoized; a service made with
+the merge base index of its repository (see merge_base_index.py) consults it
+first, and adds the merge bases that it computes.
+get_git_query_service returns the service of a git directory, which is shared
+by all code of a process; at most MAX_SERVICES services are kept open.
+"""
+
+import atexit
+import os
+import subprocess
+import uuid
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple, Union
+from merge_base_index import MergeBaseIndex, is_commit_id
+
+MAX_SERVICES = 8
+MAX_MEMOIZED_MERGE_BASES = 100000
+
+# The services of this process, by git directory, in order of last use.
+_services: Dict[Path, "GitQueryService"] = {}
+
+
+class GitQueryService:
+    """Long-lived git processes that answer queries about a git directory."""
+
+    def __init__(
+        self,
+        git_directory: Path,
+        merge_base_index: Union[MergeBaseIndex, None] = None,
+    ) -> None:
+        """Initializes the service.  The processes are started on first use.
+        Args:
+            git_directory (Path): The git directory, e.g. the .git of a clone.
+            merge_base_index (Union[MergeBaseIndex,None], optional) = None: The
+                merge base index of the repository, if any.
+        """
+        self.git_directory = git_directory
+        self.merge_base_index = merge_base_index
+        self.processes: Dict[Tuple[str, ...], subprocess.Popen] = {}
+        self.merge_bases: Dict[Tuple[str, str], Union[str, None]] = {}
+        # A line that ends the answers of diff-tree, and that diff-tree echoes.
+        self.end_marker = f"__END_OF_ANSWER_{uuid.uuid4().hex}__\n".encode("ascii")
+
+    def get_process(self, *args: str) -> subprocess.Popen:
+        """Returns the running git process with the given arguments, starting it
+        if needed."""
+        process = self.processes.get(args)
+        if process is None or process.poll() is not None:
+            process = subprocess.Popen(
+                ["git", "--git-dir", str(self.git_directory), *args],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )
+            self.processes[args] = process
+        return process
+
+    def query(self, args: Tuple[str, ...], request: bytes) -> subprocess.Popen:
+        """Writes a request to a git process and returns the process, whose
+        standard output has the answer.
+        Raises:
+            subprocess.CalledProcessError: If the process has exited.
+        """
+        process = self.get_process(*args)
+        assert process.stdin is not None
+        try:
+            process.stdin.write(request)
+            process.stdin.flush()
+        except BrokenPipeError as e:
+            self.processes.pop(args, None)
+            raise subprocess.CalledProcessError(
+                process.wait(), ["git", *args], stderr=str(e)
+            )
+        return process
+
+    def read_line(self, args: Tuple[str, ...], process: subprocess.Popen) -> bytes:
+        """Reads a line of the answer of a git process.
+        Raises:
+            subprocess.CalledProcessError: If the process exited before answering.
+        """
+        assert process.stdout is not None
+        line = process.stdout.readline()
+        if not line:
+            self.processes.pop(args, None)
+            raise subprocess.CalledProcessError(process.wait(), ["git", *args])
+        return line
+
+    def resolve(self, revision: str) -> Union[str, None]:
+        """Returns the id of the object that a revision names, such as
+        "<commit>^{tree}", or None if there is none."""
+        args = ("cat-file", "--batch-check")
+        process = self.query(args, revision.encode("utf-8") + b"\n")
+        # The answer is "<object> <type> <size>", or "<revision> missing".
+        answer = self.read_line(args, process).split()
+        if len(answer) != 3 or answer[-1] in (b"missing", b"ambiguous"):
+            return None
+        return answer[0].decode("ascii")
+
+    def read_object(self, revision: str) -> Union[bytes, None]:
+        """Returns the content of the object that a revision names, such as a blob
+        "<commit>:<path>", or None if there is none."""
+        args = ("cat-file", "--batch")
+        process = self.query(args, revision.encode("utf-8") + b"\n")
+        answer = self.read_line(args, process).split()
+        if len(answer) != 3 or answer[-1] in (b"missing", b"ambiguous"):
+            return None
+        assert process.stdout is not None
+        content = process.stdout.read(int(answer[2]))
+        process.stdout.read(1)  # The newline after the content.
+        return content
+
+    def merge_base(self, left: str, right: str) -> Union[str, None]:
+        """Returns the merge base of two commits, as `git merge-base` prints it, or
+        None if they have none.  The merge bases are memoized."""
+        key = (left, right)
+        if key in self.merge_bases:
+            return self.merge_bases[key]
+        # Only commit ids are indexed: what other revisions name changes.
+        indexed = (
+            self.merge_base_index is not None
+            and is_commit_id(left)
+            and is_commit_id(right)
+        )
+        if indexed and key in self.merge_base_index:
+            merge_base = self.merge_base_index.get(left, right)
+        else:
+            process = subprocess.run(
+                [
+                    "git",
+                    "--git-dir",
+                    str(self.git_directory),
+                    "merge-base",
+                    left,
+                    right,
+                ],
+                capture_output=True,
+                text=True,
+                check=False,
+            )
+            if process.returncode not in (0, 1):
+                raise subprocess.CalledProcessError(
+                    process.returncode, process.args, process.stdout, process.stderr
+                )
+            merge_base = process.stdout.strip() or None
+            if indexed:
+                self.merge_base_index.add({key: merge_base})
+        if len(self.merge_bases) >= MAX_MEMOIZED_MERGE_BASES:
+            del self.merge_bases[next(iter(self.merge_bases))]
+        self.merge_bases[key] = merge_base
+        return merge_base
+
+    def diff(self, left: str, right: str, *options: str) -> bytes:
+        """Diffs two commits like `git diff [<options>] <left> <right>`, which
+        detects renames.
+        Args:
+            left (str): The left commit.
+            right (str): The right commit.
+            options (str): Options of diff-tree, e.g. "--name-only" or "-p".
+        Returns:
+            bytes: The output of the diff.
+        Raises:
+            subprocess.CalledProcessError: If a commit does not exist.
+        """
+        return b"".join(self.diff_lines(left, right, *options))
+
+    def diff_lines(self, left: str, right: str, *options: str) -> Iterator[bytes]:
+        """Diffs two commits like diff, yielding the lines of the output as they
+        are read, so that the output is never held in memory.  If the iteration
+        is stopped early, the diff-tree process is stopped, instead of reading
+        the rest of its output.
+        Args:
+            left (str): The left commit.
+            right (str): The right commit.
+            options (str): Options of diff-tree, e.g. "--name-only" or "-p".
+        Returns:
+            Iterator[bytes]: The lines of the output, with their newlines.
+        Raises:
+            subprocess.CalledProcessError: If a commit does not exist.
+        """
+        trees = [self.resolve(commit + "^{tree}") for commit in (left, right)]
+        if trees[0] is None or trees[1] is None:
+            raise subprocess.CalledProcessError(
+                128, ["git", "diff", *options, left, right], stderr="bad revision"
+            )
+        args = ("diff-tree", "--stdin", "-r", "-M", *options)
+        request = f"{trees[0]} {trees[1]}\n".encode("ascii") + self.end_marker
+        process = self.query(args, request)
+        # The answer starts with the line "<tree> <tree>".
+        self.read_line(args, process)
+        finished = False
+        try:
+            while True:
+                line = self.read_line(args, process)
+                if line == self.end_marker:
+                    finished = True
+                    return
+                yield line
+        finally:
+            if not finished and self.processes.get(args) is process:
+                del self.processes[args]
+                process.kill()
+                process.communicate()
+
+    def changed_paths(self, left: str, right: str) -> List[str]:
+        """Returns the paths that `git diff --name-only <left> <right>` prints."""
+        return self.diff(left, right, "--name-only").decode("utf-8").splitlines()
+
+    def close(self) -> None:
+        """Stops the git processes."""
+        for process in self.processes.values():
+            if process.stdin is not None:
+                process.stdin.close()
+            process.wait()
+        self.processes.clear()
+
+
+def get_git_query_service(
+    git_directory: Path, merge_base_index: Union[MergeBaseIndex, None] = None
+) -> GitQueryService:
+    """Returns the service of a git directory, starting it if needed.
+    Args:
+        git_directory (Path): The git directory, e.g. the .git of a clone.
+        merge_base_index (Union[MergeBaseIndex,None], optional) = None: The merge
+            base index of the repository, if any.
+    Returns:
+        GitQueryService: The service, shared by all callers of this process.
+    """
+    git_directory = git_directory.resolve()
+    service = _services.pop(git_directory, None)
+    if service is None:
+        if len(_services) >= MAX_SERVICES:
+            _services.pop(next(iter(_services))).close()
+        service = GitQueryService(git_directory, merge_base_index)
+    elif service.merge_base_index is None:
+        service.merge_base_index = merge_base_index
+    _services[git_directory] = service
+    return service
+
+
+def close_services() -> None:
+    """Stops the services of this process."""
+    for service in _services.values():
+        service.close()
+    _services.clear()
+
+
+atexit.register(close_services)
+# A child process must not use the pipes of the services of its parent.
+os.register_at_fork(after_in_child=_services.clear)
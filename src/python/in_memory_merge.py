@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""Merges two commits with `git merge-tree --write-tree`, without a working copy.
+The merge tools of MERGE_TREE_TOOLS run `git merge` with the ort strategy (see
+gitmerge.sh), which is also the merge that `git merge-tree --write-tree` does in
+the object store: its result tree, including the conflict markers of a failed
+merge, is the working tree that the tool leaves.  Repository.merge uses it for
+these tools when its caller does not need the working copy, and the result is
+only checked out (by checkout_merge) when it must be tested.
+The merge runs in a scratch bare repository that borrows the objects of the
+clone, so that nothing is written to the clone.  As in gitmerge.sh, the left
+commit is HEAD, the right commit is the branch RIGHT_BRANCH_NAME, and the
+conflict style is diff3, so the conflict markers are the same.
+Trees with submodules or .gitattributes, and clones that convert line endings on
+checkout, are not merged in memory: their checkouts are not the blobs of the
+tree.  Neither are the recursive and resolve strategies, which merge-tree does
+not implement.
+"""
+
+import subprocess
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+from variables import LEFT_BRANCH_NAME, RIGHT_BRANCH_NAME
+from workdir_reaper import trash_workdir
+
+# The merge tools that are a plain `git merge -s ort`, and their strategy options.
+MERGE_TREE_TOOLS: Dict[str, List[str]] = {
+    "gitmerge_ort": [],
+    "gitmerge_ort_ignorespace": ["ignore-space-change"],
+}
+
+# Whether `git merge-tree` accepts strategy options (-X), which git 2.44 added.
+_merge_tree_takes_options: Union[bool, None] = None
+
+
+class InMemoryMerge:
+    """The result of a merge in the scratch repository."""
+
+    def __init__(
+        self,
+        git_directory: Path,
+        left_commit: str,
+        right_commit: str,
+        tree: str,
+        success: bool,
+    ) -> None:
+        """Initializes the result.
+        Args:
+            git_directory (Path): The scratch repository, which has the objects.
+            left_commit (str): The id of the left commit.
+            right_commit (str): The id of the right commit.
+            tree (str): The id of the merged tree.
+            success (bool): Whether the merge had no conflict.
+        """
+        self.git_directory = git_directory
+        self.left_commit = left_commit
+        self.right_commit = right_commit
+        self.tree = tree
+        self.success = success
+
+
+def git(git_directory: Path, *args: str) -> str:
+    """Runs a git command in a repository and returns its output.
+    Raises:
+        subprocess.CalledProcessError: If the command fails.
+    """
+    return subprocess.run(
+        ["git", "--git-dir", str(git_directory), *args],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+
+
+def merge_tree_takes_options() -> bool:
+    """Returns whether `git merge-tree` accepts strategy options."""
+    global _merge_tree_takes_options
+    if _merge_tree_takes_options is None:
+        usage = subprocess.run(
+            ["git", "merge-tree", "-h"], capture_output=True, text=True, check=False
+        )
+        _merge_tree_takes_options = "--strategy-option" in usage.stdout + usage.stderr
+    return _merge_tree_takes_options
+
+
+def can_merge_in_memory(tool_name: str) -> bool:
+    """Returns whether a merge tool can be run with `git merge-tree`."""
+    if tool_name not in MERGE_TREE_TOOLS:
+        return False
+    return not MERGE_TREE_TOOLS[tool_name] or merge_tree_takes_options()
+
+
+def converts_line_endings(repo_path: Path) -> bool:
+    """Returns whether checkouts in a clone convert line endings."""
+    autocrlf = subprocess.run(
+        ["git", "config", "--get", "core.autocrlf"],
+        cwd=repo_path,
+        capture_output=True,
+        text=True,
+        check=False,
+    ).stdout.strip()
+    return autocrlf.lower() in ("true", "input", "yes", "on", "1")
+
+
+def create_scratch_repository(git_directory: Path, repo_path: Path) -> Path:
+    """Creates an empty scratch bare repository that borrows the objects of a
+    clone, replacing the previous one.
+    Args:
+        git_directory (Path): The scratch repository.
+        repo_path (Path): The clone in REPOS_PATH.
+    Returns:
+        Path: The scratch repository.
+    """
+    trash_workdir(git_directory)
+    git_directory.parent.mkdir(parents=True, exist_ok=True)
+    subprocess.run(
+        ["git", "init", "--quiet", "--bare", str(git_directory)],
+        check=True,
+        capture_output=True,
+    )
+    (git_directory / "objects" / "info" / "alternates").write_text(
+        str((repo_path / ".git" / "objects").resolve()) + "\n", encoding="utf-8"
+    )
+    git(git_directory, "config", "gc.auto", "0")
+    return git_directory
+
+
+def resolve_commit(git_directory: Path, commit: str) -> Union[str, None]:
+    """Returns the id of a commit, or None if it is not in the repository."""
+    try:
+        return git(
+            git_directory, "rev-parse", "--verify", "--quiet", commit + "^{commit}"
+        )
+    except subprocess.CalledProcessError:
+        return None
+
+
+def is_checkout_of_blobs(entries: List[Tuple[bytes, bytes, bytes]]) -> bool:
+    """Returns whether the checkout of a tree is exactly the blobs of the tree:
+    it has no submodule and no .gitattributes.
+    Args:
+        entries (List[Tuple[bytes,bytes,bytes]]): The entries of the tree, as
+            returned by tree_fingerprint.list_tree.
+    """
+    return not any(
+        mode == b"160000" or path.rsplit(b"/", 1)[-1] == b".gitattributes"
+        for mode, _, path in entries
+    )
+
+
+def merge_in_memory(
+    git_directory: Path,
+    tool_name: str,
+    left_commit: str,
+    right_commit: str,
+    timeout: int,
+) -> Tuple[Union[InMemoryMerge, None], List[str], subprocess.CompletedProcess]:
+    """Merges two commits with `git merge-tree --write-tree`.
+    Args:
+        git_directory (Path): The scratch repository.
+        tool_name (str): The merge tool, which must be in MERGE_TREE_TOOLS.
+        left_commit (str): The id of the left commit.
+        right_commit (str): The id of the right commit.
+        timeout (int): The timeout limit, in seconds.
+    Returns:
+        Union[InMemoryMerge,None]: The result, or None if merge-tree failed
+            without merging, e.g. for unrelated histories.
+        List[str]: The command.
+        subprocess.CompletedProcess: The process, for its output.
+    Raises:
+        subprocess.TimeoutExpired: If the merge times out.
+    """
+    git(git_directory, "update-ref", "--no-deref", "HEAD", left_commit)
+    git(git_directory, "update-ref", "refs/heads/" + RIGHT_BRANCH_NAME, right_commit)
+    command = [
+        "git",
+        "--git-dir",
+        str(git_directory),
+        "-c",
+        "merge.conflictstyle=diff3",
+        "merge-tree",
+        "--write-tree",
+        *("-X" + option for option in MERGE_TREE_TOOLS[tool_name]),
+        "HEAD",
+        RIGHT_BRANCH_NAME,
+    ]
+    process = subprocess.run(command, capture_output=True, timeout=timeout, check=False)
+    # The exit code is 0 for a clean merge and 1 for conflicts.
+    if process.returncode not in (0, 1):
+        return None, command, process
+    tree = process.stdout.split(b"\n", 1)[0].decode("ascii")
+    result = InMemoryMerge(
+        git_directory, left_commit, right_commit, tree, process.returncode == 0
+    )
+    return result, command, process
+
+
+def commit_merge(merge: InMemoryMerge) -> str:
+    """Commits the merged tree, with the message of `git merge`.
+    Args:
+        merge (InMemoryMerge): The merge.
+    Returns:
+        str: The id of the merge commit, which is also the branch "merged" of the
+            scratch repository.
+    """
+    commit = git(
+        merge.git_directory,
+        "commit-tree",
+        merge.tree,
+        "-p",
+        merge.left_commit,
+        "-p",
+        merge.right_commit,
+        "-m",
+        f"Merge branch '{RIGHT_BRANCH_NAME}' into {LEFT_BRANCH_NAME}",
+    )
+    git(merge.git_directory, "update-ref", "refs/heads/merged", commit)
+    return commit
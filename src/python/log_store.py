@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Stores the merge and test logs compressed and deduplicated by content.
+Each repository has an append-only pack file, <store_directory>/<repo_slug>.pack,
+holding the compressed logs, and an index, <store_directory>/<repo_slug>.idx,
+with one line per log: "<sha256 of the log> <offset> <length> <compression>".
+A log that is already in the pack is not written again.
+The caches refer to a stored log as "<path to the pack>#<sha256>"; read_log
+also accepts the path of a plain log file, as found in older caches.
+usage: python3 log_store.py <log reference> [<log reference> ...]
+prints the logs.
+"""
+
+import argparse
+import hashlib
+import zlib
+from pathlib import Path
+from typing import Dict, Tuple
+import fasteners
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# The parsed index of each pack file, with the size of the index when it was parsed.
+_parsed_indexes: Dict[Path, Tuple[int, Dict[str, Tuple[int, int, str]]]] = {}
+
+
+def get_pack_path(repo_slug: str, store_directory: Path) -> Path:
+    """Returns the path to the pack file of a repository.
+    Args:
+        repo_slug (str): The slug of the repository, which is "owner/reponame".
+        store_directory (Path): The directory of the log store.
+    Returns:
+        Path: The path to the pack file.
+    """
+    return store_directory / (repo_slug + ".pack")
+
+
+def read_index(pack_path: Path) -> Dict[str, Tuple[int, int, str]]:
+    """Reads the index of a pack file.
+    The index is append-only, so only the lines added since the last call are parsed.
+    Args:
+        pack_path (Path): The path to the pack file.
+    Returns:
+        Dict[str,Tuple[int,int,str]]: The offset, length and compression of each
+            log in the pack, by sha256.
+    """
+    index_path = pack_path.with_suffix(".idx")
+    parsed_size, index = _parsed_indexes.get(pack_path, (0, {}))
+    if not index_path.exists():
+        return index
+    with open(index_path, "rb") as f:
+        f.seek(parsed_size)
+        new_lines = f.read()
+    # A line that is being written is parsed by a later call.
+    complete_size = new_lines.rfind(b"\n") + 1
+    for line in new_lines[:complete_size].decode("utf-8", "replace").splitlines():
+        fields = line.split()
+        # The fragment of a line whose writer crashed is followed by a newline
+        # (see store_log), and skipped.
+        if len(fields) != 4 or not (fields[1].isdigit() and fields[2].isdigit()):
+            continue
+        digest, offset, length, compression = fields
+        index[digest] = (int(offset), int(length), compression)
+    _parsed_indexes[pack_path] = (parsed_size + complete_size, index)
+    return index
+
+
+def compress_log(data: bytes) -> Tuple[bytes, str]:
+    """Compresses a log with zstd if available, and with zlib otherwise.
+    Returns:
+        bytes: The compressed log.
+        str: The name of the compression.
+    """
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data), "zstd"
+    return zlib.compress(data, ZLIB_LEVEL), "zlib"
+
+
+def decompress_log(data: bytes, compression: str) -> bytes:
+    """Decompresses a log compressed by compress_log."""
+    if compression == "zlib":
+        return zlib.decompress(data)
+    if zstandard is None:
+        raise ValueError("Reading a zstd-compressed log requires the zstandard package")
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+def store_log(log: str, repo_slug: str, store_directory: Path) -> str:
+    """Stores a log, unless the same log is already stored.
+    Args:
+        log (str): The content of the log.
+        repo_slug (str): The slug of the repository, which is "owner/reponame".
+        store_directory (Path): The directory of the log store.
+    Returns:
+        str: The reference to the log, to be read with read_log.
+    """
+    data = log.encode("utf-8", "replace")
+    digest = hashlib.sha256(data).hexdigest()
+    pack_path = get_pack_path(repo_slug, store_directory)
+    reference = f"{pack_path}#{digest}"
+    if digest in read_index(pack_path):
+        return reference
+    pack_path.parent.mkdir(parents=True, exist_ok=True)
+    with fasteners.InterProcessLock(pack_path.with_suffix(".lock")):
+        if digest in read_index(pack_path):
+            return reference
+        compressed_data, compression = compress_log(data)
+        with open(pack_path, "ab") as f:
+            offset = f.tell()
+            f.write(compressed_data)
+        # The index line is written after the log, so that readers never find
+        # a log that is not completely in the pack.
+        entry = f"{digest} {offset} {len(compressed_data)} {compression}\n"
+        with open(pack_path.with_suffix(".idx"), "ab+") as f:
+            # After a writer crashed in the middle of a line, the entry starts on
+            # a new line.
+            if f.seek(0, 2) > 0:
+                f.seek(-1, 2)
+                if f.read(1) != b"\n":
+                    entry = "\n" + entry
+            f.write(entry.encode("utf-8"))
+    return reference
+
+
+def read_log(reference: str) -> str:
+    """Reads a log.
+    Args:
+        reference (str): A reference returned by store_log, or the path to a log file.
+    Returns:
+        str: The content of the log.
+    """
+    pack_name, _, digest = reference.rpartition("#")
+    if not pack_name.endswith(".pack"):
+        with open(reference, "r", encoding="utf-8") as f:
+            return f.read()
+    pack_path = Path(pack_name)
+    index = read_index(pack_path)
+    if digest not in index:
+        raise KeyError(f"Log {digest} is not in {pack_path}")
+    offset, length, compression = index[digest]
+    with open(pack_path, "rb") as f:
+        f.seek(offset)
+        compressed_data = f.read(length)
+    return decompress_log(compressed_data, compression).decode("utf-8")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "references",
+        help="References to logs (<pack>#<sha256>) or paths to log files",
+        nargs="+",
+    )
+    args = parser.parse_args()
+    for log_reference in args.references:
+        print(read_log(log_reference))
@@ -7,6 +7,8 @@ usage: python3 merge_analyzer.py --repos_head_passes_csv <path_to_repos_head_pas
                                 --cache_dir <cache_dir>
 This script analyzes the merges i.e. it checks if the parents pass tests and it
 computes statistics between merges.
+The statistics are computed from the objects of the clone in REPOS_PATH, without
+a working copy; working copies are only made to test the parents.
 The output is written in output_dir and consists of the same merges as the input
 but with the test results and statistics.
 """
@@ -19,7 +21,13 @@ from typing import Tuple
 import random
 import pandas as pd
 from repo import Repository, TEST_STATE
-from cache_utils import set_in_cache, lookup_in_cache
+from cache_utils import (
+    set_in_cache,
+    lookup_in_cache,
+    flush_cache_stats_after,
+    reset_cache_stats,
+    summarize_cache_stats,
+)
 from test_repo_heads import num_processes
 from variables import TIMEOUT_TESTING_PARENT, N_TESTS
 import matplotlib.pyplot as plt
@@ -32,16 +40,7 @@ from rich.progress import (
     TimeRemainingColumn,
     TextColumn,
 )
-from diff_statistics import (
-    compute_num_different_files,
-    compute_num_different_lines,
-    compute_are_imports_involved,
-    diff_contains_non_java_file,
-    diff_contains_java_file,
-    compute_num_diff_hunks,
-    compute_union_of_different_files_three_way,
-    compute_intersection_of_diff,
-)
+from diff_statistics import DIFF_STATISTICS, DiffStatistics
 
 
 def is_test_passed(test_state: str) -> bool:
@@ -49,6 +48,7 @@ def is_test_passed(test_state: str) -> bool:
     return test_state == TEST_STATE.Tests_passed.name
 
 
+@flush_cache_stats_after("merge_analyzer")
 def merge_analyzer(
     args: Tuple[str, str, pd.Series, Path],
 ) -> pd.Series:
@@ -75,54 +75,24 @@ def merge_analyzer(
             f"merge_analyzer: Expected a dictionary, got a string: {cache_data}"
         )
 
-    repo = None
-    stats = (
-        ("num_diff_files", compute_num_different_files),
-        ("union_diff_files", compute_union_of_different_files_three_way),
-        ("num_intersecting_files", compute_intersection_of_diff),
-        ("num_diff_lines", compute_num_different_lines),
-        ("num_diff_hunks", compute_num_diff_hunks),
-        ("imports_involved", compute_are_imports_involved),
-        ("non_java_involved", diff_contains_non_java_file),
-        ("diff contains java file", diff_contains_java_file),
-    )
-    repo = None
-    for name, func in stats:
+    statistics = None
+    for name in DIFF_STATISTICS:
         if name not in cache_data:
-            if repo is None:
+            if statistics is None:
+                # The statistics only read the objects of the clone in REPOS_PATH,
+                # so no working copy is made and there is no workdir to delete.
                 repo = Repository(
                     merge_idx,
                     repo_slug,
                     cache_directory=cache_directory,
-                    workdir_id=repo_slug
-                    + "/stats-"
-                    + merge_data["left"]
-                    + "-"
-                    + merge_data["right"],
-                )
-            # Pass in base sha for union and intersection stats.
-            if name == "union_diff_files" or name == "num_intersecting_files":
-                command = (
-                    "git merge-base "
-                    + str(merge_data["left"])
-                    + " "
-                    + str(merge_data["right"])
+                    delete_workdir=False,
+                    lazy_clone=True,
                 )
-                try:
-                    base_sha = repo.run_command(command)[0].strip()
-                except Exception as e:
-                    logger.error(
-                        f"merge_analyzer: Error while running command: {command}"
-                    )
-                    logger.error(f"merge_analyzer: Error: {e}")
-                    cache_data[name] = "Error while retrieving base sha"
-                    write = True
-                    continue
-                cache_data[name] = func(
-                    repo, base_sha, merge_data["left"], merge_data["right"]
+                # The merge base and the diffs are computed once for all statistics.
+                statistics = DiffStatistics(
+                    repo, merge_data["left"], merge_data["right"]
                 )
-            else:
-                cache_data[name] = func(repo, merge_data["left"], merge_data["right"])
+            cache_data[name] = statistics.compute(name)
             merge_data[name] = cache_data[name]
             write = True
 
@@ -312,6 +282,7 @@ if __name__ == "__main__":
     logger.info("merge_analyzer: Number of new merges: " + str(len(merger_arguments)))
 
     logger.info("merge_analyzer: Started Merging")
+    reset_cache_stats("merge_analyzer")
     with multiprocessing.Pool(processes=num_processes()) as pool:
         with Progress(
             SpinnerColumn(),
@@ -326,6 +297,7 @@ if __name__ == "__main__":
                 merger_results.append(result)
                 progress.update(task, advance=1)
     logger.info("merge_analyzer: Finished Merging")
+    summarize_cache_stats("merge_analyzer")
 
     repo_result = {repo_slug: [] for repo_slug in repos["repository"]}
     logger.info("merge_analyzer: Constructing Output")
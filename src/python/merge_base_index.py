@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Persistent index of the merge bases of each repository.
+The merge base of two commits never changes, since commits are immutable, so it
+is computed once per pair for all stages and all runs.  The index of a
+repository is MERGE_BASE_INDEX_PATH/<owner>/<repo>.txt, whose lines are
+"<left> <right> <base>", where <base> is "-" if the commits have no merge base.
+The base is the one `git merge-base <left> <right>` prints.
+Lines are only appended, under a lock, so readers never take the lock; a line
+that is not complete, e.g. after a crash, is ignored, and the next line starts
+after it on a new line.  A reader reads the lines
+appended by other processes when it looks up a pair that it does not know.
+precompute_merge_bases.py fills the index with the merge bases of the sampled
+merges, and GitQueryService.merge_base consults it before running
+`git merge-base` and adds the merge bases that it computes.
+FindMergeCommits.java reads the same files.
+"""
+
+import re
+from pathlib import Path
+from typing import Dict, Tuple, Union
+import fasteners
+from variables import MERGE_BASE_INDEX_PATH
+
+# The value of a pair of commits that have no merge base, in the files.
+NO_MERGE_BASE = "-"
+
+# A full commit id, the only revisions that are indexed.
+COMMIT_ID_PATTERN = re.compile(r"[0-9a-f]{40}")
+
+# The indexes of this process, by repository slug.
+_indexes: Dict[str, "MergeBaseIndex"] = {}
+
+
+class MergeBaseIndex:
+    """The merge bases of the pairs of commits of a repository."""
+
+    def __init__(self, path: Path) -> None:
+        """Initializes the index.  The file is read on first use.
+        Args:
+            path (Path): The file of the index.
+        """
+        self.path = path
+        self.merge_bases: Dict[Tuple[str, str], Union[str, None]] = {}
+        # The number of bytes of the file that have been read.
+        self.offset = 0
+
+    def get_lock(self) -> fasteners.InterProcessLock:
+        """Returns the lock that serializes the appends to the file."""
+        return fasteners.InterProcessLock(self.path.with_suffix(".lock"))
+
+    def refresh(self) -> None:
+        """Reads the lines appended to the file since the last read."""
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(self.offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        # A line without its newline is still being written.
+        data = data[: data.rfind(b"\n") + 1]
+        self.offset += len(data)
+        for line in data.decode("ascii", errors="replace").splitlines():
+            fields = line.split()
+            if len(fields) != 3 or not all(
+                is_commit_id(field) or field == NO_MERGE_BASE for field in fields
+            ):
+                continue
+            left, right, base = fields
+            self.merge_bases[(left, right)] = None if base == NO_MERGE_BASE else base
+
+    def __contains__(self, pair: Tuple[str, str]) -> bool:
+        """Returns whether the merge base of a pair (left, right) is in the index."""
+        if pair not in self.merge_bases:
+            self.refresh()
+        return pair in self.merge_bases
+
+    def get(self, left: str, right: str) -> Union[str, None]:
+        """Returns the merge base of two commits, or None if they have none.
+        Raises:
+            KeyError: If the pair is not in the index.
+        """
+        if (left, right) not in self:
+            raise KeyError((left, right))
+        return self.merge_bases[(left, right)]
+
+    def add(self, merge_bases: Dict[Tuple[str, str], Union[str, None]]) -> None:
+        """Adds merge bases to the index.
+        Args:
+            merge_bases (Dict[Tuple[str,str],Union[str,None]]): The merge base of
+                each pair (left, right), or None if the commits have none.
+        """
+        self.refresh()
+        new_merge_bases = {
+            pair: base
+            for pair, base in merge_bases.items()
+            if pair not in self.merge_bases
+        }
+        if not new_merge_bases:
+            return
+        lines = "".join(
+            f"{left} {right} {NO_MERGE_BASE if base is None else base}\n"
+            for (left, right), base in new_merge_bases.items()
+        )
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.get_lock():
+            with open(self.path, "ab+") as f:
+                # After a writer crashed in the middle of a line, the lines start
+                # on a new line.
+                if f.seek(0, 2) > 0:
+                    f.seek(-1, 2)
+                    if f.read(1) != b"\n":
+                        lines = "\n" + lines
+                f.write(lines.encode("ascii"))
+        self.merge_bases.update(new_merge_bases)
+
+
+def is_commit_id(revision: str) -> bool:
+    """Returns whether a revision is a full commit id, which always names the same
+    commit."""
+    return COMMIT_ID_PATTERN.fullmatch(revision) is not None
+
+
+def get_merge_base_index_path(repo_slug: str) -> Path:
+    """Returns the file of the index of a repository.
+    Args:
+        repo_slug (str): The slug of the repository, which is "owner/reponame".
+    Returns:
+        Path: The file, which need not exist.
+    """
+    return MERGE_BASE_INDEX_PATH / (repo_slug.lower() + ".txt")
+
+
+def get_merge_base_index(repo_slug: str) -> MergeBaseIndex:
+    """Returns the index of a repository, which is shared by all code of this
+    process.
+    Args:
+        repo_slug (str): The slug of the repository, which is "owner/reponame".
+    Returns:
+        MergeBaseIndex: The index.
+    """
+    repo_slug = repo_slug.lower()
+    if repo_slug not in _indexes:
+        _indexes[repo_slug] = MergeBaseIndex(get_merge_base_index_path(repo_slug))
+    return _indexes[repo_slug]
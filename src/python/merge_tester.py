@@ -21,6 +21,11 @@ import time
 import psutil
 import pandas as pd
 from repo import Repository, MERGE_TOOL, TEST_STATE, MERGE_STATE
+from cache_utils import (
+    flush_cache_stats_after,
+    reset_cache_stats,
+    summarize_cache_stats,
+)
 from test_repo_heads import num_processes
 from variables import TIMEOUT_TESTING_MERGE, TIMEOUT_MERGING, N_TESTS
 from loguru import logger
@@ -34,6 +39,7 @@ from rich.progress import (
 )
 
 
+@flush_cache_stats_after("merge_tester")
 def merge_tester(args: Tuple[str, str, pd.Series, Path]) -> pd.Series:
     """Tests a merge with each merge tool.
     Args:
@@ -64,10 +70,8 @@ def merge_tester(args: Tuple[str, str, pd.Series, Path]) -> pd.Series:
             merge_idx,
             repo_slug,
             cache_directory=cache_directory,
-            workdir_id=repo_slug
-            + f"/merge-tester-{merge_tool.name}-"
-            + f'{merge_data["left"]}-{merge_data["right"]}',
             lazy_clone=True,
+            use_pool=True,
         )
         (
             result,
@@ -106,6 +110,8 @@ def merge_tester(args: Tuple[str, str, pd.Series, Path]) -> pd.Series:
 
         merge_data[merge_tool.name] = result.name
         merge_data[f"{merge_tool.name}_merge_fingerprint"] = merge_fingerprint
+        # Return the working copy to the pool before the next tool takes one.
+        del repo
         if result == TEST_STATE.Tests_timedout:
             break
     logger.info(
@@ -187,6 +193,7 @@ def main():
     )
 
     logger.info("merge_tester: Started Testing")
+    reset_cache_stats("merge_tester")
     with multiprocessing.Pool(processes=num_processes()) as pool:
         with Progress(
             SpinnerColumn(),
@@ -203,6 +210,7 @@ def main():
                 merge_tester_results.append(result)
                 progress.update(task, advance=1)
     logger.info("merge_tester: Finished Testing")
+    summarize_cache_stats("merge_tester")
 
     repo_result = {repo_slug: [] for repo_slug in repos["repository"]}
     logger.info("merge_tester: Started Writing Output")
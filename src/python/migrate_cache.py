@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Converts a cache directory from one storage backend or encoding to another.
+usage: python3 migrate_cache.py --cache_dir <cache_dir> --from <backend> --to <backend>
+                                [--encoding <encoding>] [--delete_source]
+The backends are described in cache_utils.py:
+- "json": one JSON file per repository, <cache>/<owner>/<repo>.json.
+- "sharded": one JSON file per key, <cache>/shards/<owner>/<repo>/.
+- "sqlite": one database, <cache>/cache.sqlite3, with one table per cache.
+Every cache below cache_dir (sha_cache_entry, test_cache, merge_analysis, ...)
+is converted.  Repositories are converted in parallel; each repository is
+written while holding the lock of the target backend.
+Converting to "json" exports a cache in the format of the archived cache;
+converting from "json" imports such an archive.
+--encoding selects the encoding of the written files (see encode_cache_data in
+cache_utils.py); with the same --from and --to backend, the files are re-encoded
+in place, e.g. to compress an existing cache:
+    python3 migrate_cache.py --from json --to json --encoding zstd
+After converting, run the pipeline with AST_CACHE_BACKEND=<backend> and
+AST_CACHE_ENCODING=<encoding>.
+"""
+
+import argparse
+import multiprocessing
+from pathlib import Path
+from typing import Tuple
+from loguru import logger
+from rich.progress import (
+    Progress,
+    SpinnerColumn,
+    BarColumn,
+    TimeElapsedColumn,
+    TimeRemainingColumn,
+    TextColumn,
+)
+from cache_utils import CACHE_BACKENDS, CACHE_ENCODINGS, get_cache_backend
+from variables import CACHE_ENCODING
+from test_repo_heads import num_processes
+
+
+def migrate_repo_cache(args: Tuple[str, Path, str, str, str, bool]) -> int:
+    """Converts the cache of one repository.
+    Args:
+        args (Tuple[str,Path,str,str,str,bool]): The repository slug, the cache
+            directory, the source backend, the target backend, the target encoding,
+            and whether to delete the source entries.
+    Returns:
+        int: The number of converted entries.
+    """
+    repo_slug, cache_directory, source_name, target_name, encoding, delete_source = args
+    source = get_cache_backend(repo_slug, cache_directory, source_name)
+    target = get_cache_backend(repo_slug, cache_directory, target_name, encoding)
+    cache = source.load()
+    lock = target.get_lock()
+    lock.acquire()
+    target.write_entries(cache)
+    lock.release()
+    if delete_source:
+        source.delete()
+    return len(cache)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cache_dir", type=Path, default=Path("cache"))
+    parser.add_argument(
+        "--from", dest="source", choices=list(CACHE_BACKENDS), default="json"
+    )
+    parser.add_argument("--to", choices=list(CACHE_BACKENDS), required=True)
+    parser.add_argument(
+        "--encoding",
+        help="Encoding of the written cache files",
+        choices=list(CACHE_ENCODINGS),
+        default=CACHE_ENCODING,
+    )
+    parser.add_argument(
+        "--delete_source",
+        help="Delete the entries of the source backend after converting them",
+        action="store_true",
+    )
+    args = parser.parse_args()
+    if args.source == args.to and args.delete_source:
+        parser.error("--delete_source requires different --from and --to backends")
+
+    migrate_arguments = [
+        (
+            repo_slug,
+            cache_directory,
+            args.source,
+            args.to,
+            args.encoding,
+            args.delete_source,
+        )
+        for repo_slug, cache_directory in CACHE_BACKENDS[args.source].find_repo_caches(
+            args.cache_dir
+        )
+    ]
+    logger.info(
+        f"migrate_cache: Converting {len(migrate_arguments)} caches "
+        f"from {args.source} to {args.to} ({args.encoding})"
+    )
+
+    n_entries = 0
+    with multiprocessing.Pool(processes=num_processes()) as pool:
+        with Progress(
+            SpinnerColumn(),
+            TextColumn("[progress.description]{task.description}"),
+            BarColumn(),
+            TimeElapsedColumn(),
+            TimeRemainingColumn(),
+        ) as progress:
+            task = progress.add_task(
+                "Converting caches...", total=len(migrate_arguments)
+            )
+            for result in pool.imap_unordered(migrate_repo_cache, migrate_arguments):
+                n_entries += result
+                progress.update(task, advance=1)
+    logger.success(f"migrate_cache: Converted {n_entries} entries")
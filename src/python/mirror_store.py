@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Keeps one bare mirror of each repository, in MIRRORS_PATH/<owner>/<repo>.git.
+The clones in REPOS_PATH are made from the mirrors with `git clone --shared`, so
+they borrow the objects of the mirror through .git/objects/info/alternates
+instead of downloading and storing them again, and FindMergeCommits.java reads
+the mirrors instead of cloning the repositories from GitHub.
+A mirror fetches the branches, the tags and the pull request heads of its
+repository; the pull request heads are stored as refs/pull/<n>/head, as on GitHub.
+Fetching never deletes a ref and gc is disabled, so the objects that the clones
+borrow stay in the mirror.
+Forks share most of their objects.  --share_forks makes the mirrors whose
+repositories have a common root commit borrow the objects of one of them, and
+repacks them without the borrowed objects.  A mirror that is borrowed from must
+then not be deleted while its forks exist.
+usage: python3 mirror_store.py [--share_forks]
+"""
+
+import argparse
+import os
+import subprocess
+from pathlib import Path
+from typing import Dict, List
+import fasteners
+from loguru import logger
+from variables import MIRRORS_PATH
+
+MIRROR_REFSPECS = (
+    "+refs/heads/*:refs/heads/*",
+    "+refs/tags/*:refs/tags/*",
+    "+refs/pull/*/head:refs/pull/*/head",
+)
+
+
+def get_mirror_path(repo_slug: str) -> Path:
+    """Returns the path to the mirror of a repository.
+    Args:
+        repo_slug (str): The slug of the repository, which is "owner/reponame".
+    Returns:
+        Path: The path to the bare mirror.
+    """
+    return MIRRORS_PATH / (repo_slug.lower() + ".git")
+
+
+def get_github_url(repo_slug: str) -> str:
+    """Returns the URL of a repository on GitHub, which the mirror fetches from and
+    which is the origin of the clones made from the mirror."""
+    # ":@" in URL ensures that we are not prompted for login details
+    # for the repos that are now private.
+    return f"https://:@github.com/{repo_slug}.git"
+
+
+def get_mirror_lock(repo_slug: str) -> fasteners.InterProcessLock:
+    """Returns the lock that serializes the updates of the mirror of a repository."""
+    return fasteners.InterProcessLock(MIRRORS_PATH / "locks" / repo_slug.lower())
+
+
+def git(mirror_path: Path, *args: str) -> str:
+    """Runs a git command in a mirror.
+    Raises:
+        subprocess.CalledProcessError: If the command fails.
+    """
+    return subprocess.run(
+        ["git", "--git-dir", str(mirror_path), *args],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+
+
+def create_mirror(repo_slug: str) -> Path:
+    """Creates the empty mirror of a repository, if it does not exist.
+    Args:
+        repo_slug (str): The slug of the repository, which is "owner/reponame".
+    Returns:
+        Path: The path to the mirror.
+    """
+    mirror_path = get_mirror_path(repo_slug)
+    if (mirror_path / "config").exists():
+        return mirror_path
+    mirror_path.parent.mkdir(parents=True, exist_ok=True)
+    subprocess.run(
+        ["git", "init", "--quiet", "--bare", str(mirror_path)],
+        check=True,
+        capture_output=True,
+    )
+    git(mirror_path, "config", "remote.origin.url", get_github_url(repo_slug))
+    for refspec in MIRROR_REFSPECS:
+        git(mirror_path, "config", "--add", "remote.origin.fetch", refspec)
+    git(mirror_path, "config", "gc.auto", "0")
+    return mirror_path
+
+
+def update_mirror(repo_slug: str) -> Path:
+    """Creates the mirror of a repository if needed, and fetches the repository.
+    Args:
+        repo_slug (str): The slug of the repository, which is "owner/reponame".
+    Returns:
+        Path: The path to the mirror.
+    Raises:
+        subprocess.CalledProcessError: If the fetch fails.
+    """
+    env = dict(
+        os.environ, GIT_TERMINAL_PROMPT="0", GIT_SSH_COMMAND="ssh -o BatchMode=yes"
+    )
+    with get_mirror_lock(repo_slug):
+        mirror_path = create_mirror(repo_slug)
+        logger.debug(f"update_mirror: Fetching {repo_slug} into {mirror_path}")
+        subprocess.run(
+            ["git", "--git-dir", str(mirror_path), "fetch", "--quiet", "origin"],
+            check=True,
+            capture_output=True,
+            env=env,
+        )
+    return mirror_path
+
+
+def has_commits(mirror_path: Path) -> bool:
+    """Returns whether a mirror was fetched successfully at least once."""
+    return bool(git(mirror_path, "for-each-ref", "--count=1", "refs/heads/"))
+
+
+def get_root_commits(mirror_path: Path) -> List[str]:
+    """Returns the root commits of all refs of a mirror."""
+    return git(mirror_path, "rev-list", "--max-parents=0", "--all").split()
+
+
+def get_alternates_path(mirror_path: Path) -> Path:
+    """Returns the path to the alternates file of a mirror."""
+    return mirror_path / "objects" / "info" / "alternates"
+
+
+def share_objects(mirror_path: Path, base_mirror_path: Path) -> None:
+    """Makes a mirror borrow the objects of another mirror, and repacks it without
+    the borrowed objects.
+    Args:
+        mirror_path (Path): The mirror that borrows the objects.
+        base_mirror_path (Path): The mirror whose objects are borrowed.
+    """
+    get_alternates_path(mirror_path).write_text(
+        str((base_mirror_path / "objects").resolve()) + "\n", encoding="utf-8"
+    )
+    # -l omits the objects that are found through the alternates.
+    git(mirror_path, "repack", "-a", "-d", "-l", "-q")
+
+
+def share_fork_objects() -> int:
+    """Makes the mirrors of forks borrow the objects of one mirror of their
+    repository network, which are the mirrors whose repositories have a common
+    root commit.  The mirror that others borrow from is the first one of the
+    network in path order that does not itself borrow objects.
+    Returns:
+        int: The number of mirrors that were made to borrow objects.
+    """
+    mirrors = sorted(
+        path for path in MIRRORS_PATH.glob("*/*.git") if (path / "config").exists()
+    )
+    base_by_root: Dict[str, Path] = {}
+    n_shared = 0
+    for mirror_path in mirrors:
+        repo_slug = str(mirror_path.relative_to(MIRRORS_PATH))[: -len(".git")]
+        with get_mirror_lock(repo_slug):
+            if get_alternates_path(mirror_path).exists():
+                continue
+            if not has_commits(mirror_path):
+                continue
+            root_commits = get_root_commits(mirror_path)
+            base_mirror_path = next(
+                (base_by_root[root] for root in root_commits if root in base_by_root),
+                None,
+            )
+            if base_mirror_path is None:
+                for root in root_commits:
+                    base_by_root[root] = mirror_path
+                continue
+            logger.info(
+                f"share_fork_objects: {mirror_path} borrows the objects of "
+                f"{base_mirror_path}"
+            )
+            share_objects(mirror_path, base_mirror_path)
+            n_shared += 1
+    return n_shared
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--share_forks",
+        help="Make the mirrors of forks borrow the objects of a common mirror",
+        action="store_true",
+    )
+    args = parser.parse_args()
+    if not args.share_forks:
+        parser.print_help()
+    else:
+        n_shared_mirrors = share_fork_objects()
+        logger.success(f"mirror_store: {n_shared_mirrors} mirrors now share objects")
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Computes the merge bases of the sampled merges of each repository in one pass,
+into the merge base index (see merge_base_index.py) that the later stages consult.
+
+usage: python3 precompute_merge_bases.py --repos_csv <repos.csv>
+                                         --merges_path <merges_path>
+                                         [--n_parallel <n>]
+
+Input: a csv of repos.  It must contain a header, one of whose columns is "repository".
+That column contains "ORGANIZATION/REPO" for a GitHub repository.
+The merges of each repository are read from <merges_path>/<repo>.csv.
+For each repository whose index lacks some of its merges:
+- the commit-graph of the clone is written (`git commit-graph write --reachable`),
+  with the generation numbers of the commits, which speed up the walks of
+  git (including `git merge-base`);
+- the ancestry of all the parents of the merges is read with one
+  `git rev-list --topo-order --reverse --parents`, and the generation number of
+  each commit is computed from it;
+- the merge bases of all the merges are found by a paint-down of this graph in
+  generation order, as `git merge-base` does.  A pair that has several best merge
+  bases (after criss-cross merges) is computed by `git merge-base`, since which
+  of them it prints depends on its internal order.
+Merges whose parents are not in the clone are left to the later stages.
+"""
+
+import argparse
+import heapq
+import multiprocessing
+import subprocess
+from pathlib import Path
+from typing import Dict, List, Set, Tuple, Union
+import pandas as pd
+from loguru import logger
+from rich.progress import (
+    Progress,
+    SpinnerColumn,
+    BarColumn,
+    TimeElapsedColumn,
+    TimeRemainingColumn,
+    TextColumn,
+)
+from repo import Repository
+from merge_base_index import get_merge_base_index, is_commit_id
+
+N_PARALLEL = 8
+
+# The flags of the paint-down.
+PARENT1 = 1
+PARENT2 = 2
+STALE = 4
+RESULT = 8
+
+
+class CommitGraph:
+    """The ancestry of a set of commits, with the generation number of each commit."""
+
+    def __init__(self, git_directory: Path, commits: Set[str]) -> None:
+        """Reads the ancestry of commits.
+        Args:
+            git_directory (Path): The git directory of the clone.
+            commits (Set[str]): The commits, which must be in the clone.
+        Raises:
+            subprocess.CalledProcessError: If the ancestry cannot be read.
+        """
+        # The commits are numbered in topological order, parents first.
+        self.ids: Dict[str, int] = {}
+        self.names: List[str] = []
+        self.parents: List[Tuple[int, ...]] = []
+        self.generations: List[int] = []
+        process = subprocess.run(
+            [
+                "git",
+                "--git-dir",
+                str(git_directory),
+                "rev-list",
+                "--topo-order",
+                "--reverse",
+                "--parents",
+                "--stdin",
+            ],
+            input="".join(commit + "\n" for commit in sorted(commits)),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        for line in process.stdout.splitlines():
+            commit, *parents = line.split()
+            parent_ids = tuple(self.ids[parent] for parent in parents)
+            self.ids[commit] = len(self.names)
+            self.names.append(commit)
+            self.parents.append(parent_ids)
+            self.generations.append(
+                1 + max((self.generations[p] for p in parent_ids), default=0)
+            )
+
+    def merge_bases(self, left: str, right: str) -> List[str]:
+        """Returns the best common ancestors of two commits, by a paint-down in
+        generation order (paint_down_to_common in git).  When there are several,
+        some of them may be ancestors of others, as in git before it removes the
+        redundant ones.
+        Args:
+            left (str): The left commit.
+            right (str): The right commit.
+        Returns:
+            List[str]: The merge bases, empty if the commits have none.
+        """
+        if left == right:
+            return [left]
+        flags = {self.ids[left]: PARENT1, self.ids[right]: PARENT2}
+        queue = [(-self.generations[commit], commit) for commit in flags]
+        heapq.heapify(queue)
+        results = []
+        # The number of entries of each commit in the queue, and of the entries
+        # whose commit is not stale: the walk ends when all of them are.
+        n_queued = {commit: 1 for commit in flags}
+        n_not_stale = len(queue)
+        while n_not_stale > 0:
+            _, commit = heapq.heappop(queue)
+            n_queued[commit] -= 1
+            commit_flags = flags[commit] & (PARENT1 | PARENT2 | STALE)
+            if not commit_flags & STALE:
+                n_not_stale -= 1
+            if commit_flags == PARENT1 | PARENT2:
+                if not flags[commit] & RESULT:
+                    flags[commit] |= RESULT
+                    results.append(commit)
+                # The ancestors of a common ancestor are not the best ones.
+                commit_flags |= STALE
+            for parent in self.parents[commit]:
+                parent_flags = flags.get(parent, 0)
+                if parent_flags & commit_flags == commit_flags:
+                    continue
+                if commit_flags & STALE and not parent_flags & STALE:
+                    n_not_stale -= n_queued.get(parent, 0)
+                flags[parent] = parent_flags | commit_flags
+                heapq.heappush(queue, (-self.generations[parent], parent))
+                n_queued[parent] = n_queued.get(parent, 0) + 1
+                if not flags[parent] & STALE:
+                    n_not_stale += 1
+        return [self.names[commit] for commit in results if not flags[commit] & STALE]
+
+
+def read_merges(repo_slug: str, merges_path: Path) -> List[Tuple[str, str]]:
+    """Returns the pairs (left, right) of the merges of a repository.
+    Args:
+        repo_slug (str): The slug of the repository, which is "owner/reponame".
+        merges_path (Path): The directory of the merge lists.
+    Returns:
+        List[Tuple[str,str]]: The pairs, empty if the repository has no merge list.
+    """
+    merge_list_file = merges_path / (repo_slug + ".csv")
+    if not merge_list_file.exists():
+        return []
+    merges = pd.read_csv(
+        merge_list_file,
+        names=["idx", "branch_name", "merge", "left", "right", "notes"],
+        dtype=str,
+        header=0,
+    )
+    return list(dict.fromkeys(zip(merges["left"], merges["right"])))
+
+
+def write_commit_graph(repo: Repository) -> None:
+    """Writes the commit-graph of the clone of a repository, with the generation
+    numbers of its commits."""
+    with repo.get_clone_lock():
+        process = subprocess.run(
+            ["git", "commit-graph", "write", "--reachable"],
+            cwd=repo.repo_path,
+            capture_output=True,
+            text=True,
+            check=False,
+        )
+    if process.returncode != 0:
+        logger.warning(
+            f"write_commit_graph: {repo.repo_slug}: {process.stderr.strip()}"
+        )
+
+
+def precompute_merge_bases(args: Tuple[str, Path]) -> Tuple[str, int]:
+    """Adds the merge bases of the merges of a repository to its index.
+    Args:
+        args (Tuple[str,Path]): The repository slug and the directory of the
+            merge lists.
+    Returns:
+        str: The repository slug.
+        int: The number of merge bases that were computed.
+    """
+    repo_slug, merges_path = args
+    index = get_merge_base_index(repo_slug)
+    index.refresh()
+    pairs = [
+        (left, right)
+        for left, right in read_merges(repo_slug, merges_path)
+        if is_commit_id(left)
+        and is_commit_id(right)
+        and (left, right) not in index.merge_bases
+    ]
+    if not pairs:
+        return repo_slug, 0
+    try:
+        repo = Repository(
+            merge_idx="merge_bases",
+            repo_slug=repo_slug,
+            lazy_clone=True,
+            delete_workdir=False,
+        )
+        service = repo.get_git_query_service()
+        write_commit_graph(repo)
+        commits = {
+            commit
+            for commit in {commit for pair in pairs for commit in pair}
+            if service.resolve(commit + "^{commit}") == commit
+        }
+        pairs = [
+            (left, right)
+            for left, right in pairs
+            if left in commits and right in commits
+        ]
+        graph = CommitGraph(service.git_directory, commits)
+    except Exception as e:
+        logger.warning(f"precompute_merge_bases: {repo_slug}: {e}")
+        return repo_slug, 0
+    merge_bases: Dict[Tuple[str, str], Union[str, None]] = {}
+    ambiguous_pairs = []
+    for left, right in pairs:
+        bases = graph.merge_bases(left, right)
+        if len(bases) > 1:
+            ambiguous_pairs.append((left, right))
+        else:
+            merge_bases[(left, right)] = bases[0] if bases else None
+    index.add(merge_bases)
+    # The service adds the merge bases that git computes to the index.
+    for left, right in ambiguous_pairs:
+        service.merge_base(left, right)
+    return repo_slug, len(pairs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repos_csv", type=Path, required=True)
+    parser.add_argument("--merges_path", type=Path, required=True)
+    parser.add_argument("--n_parallel", type=int, default=N_PARALLEL)
+    args = parser.parse_args()
+
+    repos = pd.read_csv(args.repos_csv)
+    arguments = [
+        (repo_slug, args.merges_path)
+        for repo_slug in dict.fromkeys(repos["repository"])
+    ]
+    logger.info(
+        f"precompute_merge_bases: Computing the merge bases of {len(arguments)} repos"
+    )
+    n_merge_bases = 0
+    with multiprocessing.Pool(processes=args.n_parallel) as pool:
+        with Progress(
+            SpinnerColumn(),
+            TextColumn("[progress.description]{task.description}"),
+            BarColumn(),
+            TimeElapsedColumn(),
+            TimeRemainingColumn(),
+        ) as progress:
+            task = progress.add_task("Computing merge bases...", total=len(arguments))
+            for _, n_computed in pool.imap_unordered(precompute_merge_bases, arguments):
+                n_merge_bases += n_computed
+                progress.update(task, advance=1)
+    logger.success(f"precompute_merge_bases: Computed {n_merge_bases} merge bases")
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Clones the repositories of a pipeline stage before its workers need them.
+Without it, the first worker that needs a repository clones it while holding the
+clone lock, and the other workers that need the repository wait on the lock.
+
+usage: python3 prefetch_repos.py --repos_csv <repos.csv>
+                                 [--merges_path <merges_path>]
+                                 [--n_parallel <n>] [--update] [--offline]
+
+Input: a csv of repos.  It must contain a header, one of whose columns is "repository".
+That column contains "ORGANIZATION/REPO" for a GitHub repository.
+The repositories are cloned in parallel, by at most n_parallel processes.  With
+--merges_path, the repositories with the most merges in <merges_path>/<repo>.csv
+are cloned first, since the workers of the merge stages, which take the merges
+in random order, are the most likely to need them first; otherwise the
+repositories are cloned in the order of the csv.
+--update also fetches the repositories that are already cloned.  With --offline
+(or AST_OFFLINE=1), nothing is fetched from the network: the clones are made
+from the local mirrors (see mirror_store.py) as they are.
+"""
+
+import argparse
+import multiprocessing
+from pathlib import Path
+from typing import List, Tuple
+import pandas as pd
+from loguru import logger
+from rich.progress import (
+    Progress,
+    SpinnerColumn,
+    BarColumn,
+    TimeElapsedColumn,
+    TimeRemainingColumn,
+    TextColumn,
+)
+from repo import Repository
+from variables import OFFLINE
+
+N_PARALLEL_CLONES = 8
+
+
+def count_merges(repo_slug: str, merges_path: Path) -> int:
+    """Returns the number of merges of a repository in a directory of merge lists.
+    Args:
+        repo_slug (str): The slug of the repository, which is "owner/reponame".
+        merges_path (Path): The directory of the merge lists.
+    Returns:
+        int: The number of merges, or 0 if the repository has no merge list.
+    """
+    merge_list_file = merges_path / (repo_slug + ".csv")
+    if not merge_list_file.exists():
+        return 0
+    with open(merge_list_file, "rb") as f:
+        # The first line is the header.
+        return max(sum(1 for _ in f) - 1, 0)
+
+
+def prefetch_repo(args: Tuple[str, bool, bool]) -> Tuple[str, str]:
+    """Clones a repository if it is not cloned, or updates it if requested.
+    Args:
+        args (Tuple[str,bool,bool]): The repository slug, whether to update a
+            repository that is already cloned, and whether to work offline.
+    Returns:
+        str: The repository slug.
+        str: What was done: "cloned", "updated", "ready" or "failed".
+    """
+    repo_slug, update, offline = args
+    repo = Repository(
+        merge_idx="prefetch",
+        repo_slug=repo_slug,
+        lazy_clone=True,
+        delete_workdir=False,
+    )
+    try:
+        if repo.repo_path.exists():
+            if not update:
+                return repo_slug, "ready"
+            repo.update_clone(offline)
+            return repo_slug, "updated"
+        repo.clone_repo(offline)
+        return repo_slug, "cloned"
+    except Exception as e:
+        logger.warning(f"prefetch_repo: Could not prefetch {repo_slug}: {e}")
+        return repo_slug, "failed"
+
+
+def order_repos(repo_slugs: List[str], merges_path: Path) -> List[str]:
+    """Orders the repositories by decreasing number of merges, keeping the order
+    of the list for repositories with the same number of merges."""
+    return sorted(
+        repo_slugs, key=lambda repo_slug: -count_merges(repo_slug, merges_path)
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repos_csv", type=Path, required=True)
+    parser.add_argument(
+        "--merges_path",
+        help="Directory of the merge lists, to clone the busiest repos first",
+        type=Path,
+    )
+    parser.add_argument("--n_parallel", type=int, default=N_PARALLEL_CLONES)
+    parser.add_argument(
+        "--update",
+        help="Also fetch the repos that are already cloned",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--offline",
+        help="Clone from the local mirrors without fetching",
+        action="store_true",
+        default=OFFLINE,
+    )
+    args = parser.parse_args()
+
+    repos = pd.read_csv(args.repos_csv)
+    repo_slugs = list(dict.fromkeys(repos["repository"]))
+    if args.merges_path is not None:
+        repo_slugs = order_repos(repo_slugs, args.merges_path)
+    prefetch_arguments = [
+        (repo_slug, args.update, args.offline) for repo_slug in repo_slugs
+    ]
+    logger.info(
+        f"prefetch_repos: Prefetching {len(prefetch_arguments)} repos "
+        f"with {args.n_parallel} processes"
+    )
+
+    counts = {"cloned": 0, "updated": 0, "ready": 0, "failed": 0}
+    with multiprocessing.Pool(processes=args.n_parallel) as pool:
+        with Progress(
+            SpinnerColumn(),
+            TextColumn("[progress.description]{task.description}"),
+            BarColumn(),
+            TimeElapsedColumn(),
+            TimeRemainingColumn(),
+        ) as progress:
+            task = progress.add_task(
+                "Prefetching repos...", total=len(prefetch_arguments)
+            )
+            # The repositories are dispatched to the processes in order.
+            for _, status in pool.imap_unordered(prefetch_repo, prefetch_arguments):
+                counts[status] += 1
+                progress.update(task, advance=1)
+    logger.success(
+        "prefetch_repos: "
+        + ", ".join(f"{count} {status}" for status, count in counts.items())
+    )
@@ -18,10 +18,11 @@ import os.path
 import sys
 import tarfile
 from pathlib import Path
-import shutil
 import subprocess
 import pandas as pd
 from repo import Repository, MERGE_TOOL, TEST_STATE, MERGE_STATE
+from log_store import read_log
+from workdir_reaper import trash_workdir
 from variables import TIMEOUT_TESTING_MERGE, N_TESTS, WORKDIR_DIRECTORY, TIMEOUT_MERGING
 from rich.progress import (
     Progress,
@@ -58,8 +59,7 @@ def store_artifacts(result_df: pd.DataFrame) -> None:
 def delete_workdirs(results_df: pd.DataFrame) -> None:
     """Delete the workdirs after replaying the merges."""
     for idx in results_df.index:
-        os.system("chmod -R 777 " + str(results_df.loc[idx, "repo path"]))
-        shutil.rmtree(results_df.loc[idx, "repo path"])  # type: ignore
+        trash_workdir(results_df.loc[idx, "repo path"])  # type: ignore
     logger.info("Workdirs deleted")
 
 
@@ -170,16 +170,10 @@ def merge_replay(
                 delete_workdir=False,
                 lazy_clone=False,
             )
-            base_commit = (
-                subprocess.run(
-                    ["git", "merge-base", merge_data["left"], merge_data["right"]],
-                    cwd=repo.local_repo_path,
-                    stdout=subprocess.PIPE,
-                    check=True,
-                )
-                .stdout.decode("utf-8")
-                .strip()
+            base_commit = repo.get_git_query_service().merge_base(
+                merge_data["left"], merge_data["right"]
             )
+            assert base_commit is not None, "The commits have no merge base"
             repo.checkout(base_commit, use_cache=False)
 
         workdir = Path(
@@ -223,8 +217,7 @@ def merge_replay(
                         f"Workdir {workdir} exists for idx: {merge_idx}. Delete it? (y/n)"
                     )
                 if answer == "y":
-                    os.system("chmod -R 777 " + str(WORKDIR_DIRECTORY / workdir))
-                    shutil.rmtree(WORKDIR_DIRECTORY / workdir)
+                    trash_workdir(WORKDIR_DIRECTORY / workdir)
                 else:
                     logger.info(
                         f"Workdir {WORKDIR_DIRECTORY/workdir} already exists. Skipping."
@@ -336,8 +329,7 @@ def merge_replay(
                     delete_workdirs(result_df)
                 print("fingerprints differ; details follow.")
                 print(f"=================== start of {log_path}:")
-                with open(log_path, "r", encoding="utf-8") as f:
-                    print(f.read())
+                print(read_log(str(log_path)))
                 print(f"=================== end of {log_path}.")
                 raise Exception(
                     f"fingerprints differ: after merge of {workdir} with {merge_tool}, found"
@@ -22,20 +22,75 @@ from git import GitCommandError
 from cache_utils import (
     set_in_cache,
     lookup_in_cache,
+    cache_transaction,
+)
+from log_store import store_log
+from workdir_pool import WorkdirPoolSlot, acquire_workdir, reset_working_copy
+import tree_fingerprint
+from mirror_store import (
+    get_github_url,
+    get_mirror_lock,
+    get_mirror_path,
+    has_commits,
+    update_mirror,
+)
+from workdir_reaper import trash_workdir
+from git_query_service import GitQueryService, get_git_query_service
+from merge_base_index import get_merge_base_index
+from in_memory_merge import (
+    InMemoryMerge,
+    can_merge_in_memory,
+    commit_merge,
+    converts_line_endings,
+    create_scratch_repository,
+    is_checkout_of_blobs,
+    merge_in_memory,
+    resolve_commit,
+)
+from tmpfs_workdir import (
+    TmpfsReservation,
+    estimate_working_copy_size,
+    reserve_tmpfs,
+)
+from storage_manager import (
+    hold_clone,
+    release_clone,
+    touch_clone,
+    register_workdir,
+    unregister_workdir,
 )
 import fasteners
 import git.repo
 from variables import (
     REPOS_PATH,
     WORKDIR_DIRECTORY,
+    TMPFS_WORKDIR_DIRECTORY,
     LEFT_BRANCH_NAME,
     RIGHT_BRANCH_NAME,
     DELETE_WORKDIRS,
     N_TESTS,
     TIMEOUT_MERGING,
+    WORKDIR_MODE,
+    FINGERPRINT_MODE,
+    OFFLINE,
 )
 from loguru import logger
 
+# The tree fingerprint of a clean checkout of each commit, by (repo slug, commit).
+# A clean checkout of a commit always has the same fingerprint, so it is computed
+# once per process (see Repository.compute_tree_fingerprint).
+_commit_fingerprints: Dict[Tuple[str, str], str] = {}
+MAX_MEMOIZED_FINGERPRINTS = 10000
+# The scratch repository of the in-memory merges, in the workdir.
+SCRATCH_REPOSITORY_NAME = ".merge_tree.git"
+
+
+def memoize_fingerprint(memo_key: Tuple[str, str], fingerprint: str) -> None:
+    """Memoizes the tree fingerprint of a clean checkout of a commit."""
+    if len(_commit_fingerprints) >= MAX_MEMOIZED_FINGERPRINTS:
+        del _commit_fingerprints[next(iter(_commit_fingerprints))]
+    _commit_fingerprints[memo_key] = fingerprint
+
 
 def timeout(seconds=10, error_message=os.strerror(errno.ETIME)):
     """A decorator that raises a TimeoutError if a function takes too long to run."""
@@ -60,27 +115,59 @@ def timeout(seconds=10, error_message=os.strerror(errno.ETIME)):
 
 
 @timeout(10 * 60)
-def clone_repo(repo_slug: str, repo_dir: Path) -> None:
-    """Clones a repository, or runs `git fetch` if the repository is already cloned.
+def clone_repo(repo_slug: str, repo_dir: Path, offline: bool = OFFLINE) -> None:
+    """Clones a repository from its mirror (see mirror_store.py), after fetching
+    the repository into the mirror.  The clone borrows the objects of the mirror.
+    If the fetch fails but the mirror has been fetched before, the repository is
+    cloned from the mirror as it is.
     Args:
         repo_slug (str): The slug of the repository, which is "owner/reponame".
+        repo_dir (Path): The directory of the clone.
+        offline (bool, optional) = OFFLINE: Whether to clone the mirror without
+            fetching.
     """
     logger.debug(f"clone_repo: Cloning {repo_slug} to {repo_dir}")
     repo_dir.parent.mkdir(parents=True, exist_ok=True)
     os.environ["GIT_TERMINAL_PROMPT"] = "0"
     os.environ["GIT_SSH_COMMAND"] = "ssh -o BatchMode=yes"
-    # ":@" in URL ensures that we are not prompted for login details
-    # for the repos that are now private.
-    github_url = "https://:@github.com/" + repo_slug + ".git"
+    mirror_path = get_mirror_path(repo_slug)
+    if offline:
+        if not (mirror_path.exists() and has_commits(mirror_path)):
+            raise Exception(f"No mirror of {repo_slug} to clone offline")
+    else:
+        try:
+            mirror_path = update_mirror(repo_slug)
+        except subprocess.CalledProcessError as e:
+            if not (mirror_path.exists() and has_commits(mirror_path)):
+                logger.debug(f"clone_repo: Fetch failed for {repo_slug}:\n{e.stderr}")
+                raise Exception(f"GitCommandError during cloning {repo_slug}") from e
+            logger.warning(
+                f"clone_repo: Fetch failed for {repo_slug}, cloning its mirror as it is"
+            )
     try:
-        repo = git.repo.Repo.clone_from(github_url, repo_dir)
+        with get_mirror_lock(repo_slug):
+            subprocess.run(
+                [
+                    "git",
+                    "clone",
+                    "--quiet",
+                    "--shared",
+                    str(mirror_path.resolve()),
+                    str(repo_dir),
+                ],
+                check=True,
+                capture_output=True,
+            )
+        repo = git.repo.Repo(repo_dir)
         assert (
             repo_dir.exists()
         ), f"Repo {repo_slug} does not exist after cloning {repo_dir}"
         logger.debug(repo_slug, "clone_repo: Finished cloning")
-        repo.remote().fetch()
         repo.remote().fetch("refs/pull/*/head:refs/remotes/origin/pull/*")
-    except GitCommandError as e:
+        # The origin of the clone is GitHub, not the mirror, so that relative
+        # submodule URLs and later fetches of origin resolve against GitHub.
+        repo.remote().set_url(get_github_url(repo_slug))
+    except (GitCommandError, subprocess.CalledProcessError) as e:
         logger.debug(f"clone_repo: GitCommandError during cloning {repo_slug}:\n{e}")
         raise Exception(f"GitCommandError during cloning {repo_slug}") from e
     try:
@@ -219,51 +306,101 @@ class Repository:
     owner: str
     name: str
     repo_path: Path
+    workdir_id: str
     workdir: Path
     local_repo_path: Path
+    workdir_allocated: bool
     delete_workdir: bool
+    use_pool: bool
     lazy_clone: bool
+    workdir_mode: str
+    pool_slot: Union[WorkdirPoolSlot, None]
+    checked_out_commit: Union[str, None]
+    holds_clone: bool
+    in_memory_merge: Union[InMemoryMerge, None]
+    tmpfs_reservation: Union[TmpfsReservation, None]
     repo: Repo
     test_cache_directory: Path
     sha_cache_directory: Path
+    log_store_directory: Path
 
     def __init__(
         self,
         merge_idx: str,
         repo_slug: str,
         cache_directory: Path = Path(""),
-        workdir_id: str = uuid.uuid4().hex,  # uuid4 is a random UID
+        workdir_id: Union[str, None] = None,
         delete_workdir: bool = DELETE_WORKDIRS,
         lazy_clone: bool = False,
+        workdir_mode: str = WORKDIR_MODE,
+        use_pool: bool = False,
     ) -> None:
         """Initializes the repository.
         Args:
             repo_slug (str): The slug of the repository, which is "owner/reponame".
             cache_directory (Path): The prefix of the cache.
+            workdir_id (Union[str,None], optional) = None: The name of the workdir,
+                a new random id (uuid4) if None.
+            workdir_mode (str, optional) = WORKDIR_MODE: How the working copy is made
+                from the clone, "copy" or "shared" (see copy_repo).
+            use_pool (bool, optional) = False: Whether to use a reusable working copy
+                of the pool (see workdir_pool.py) instead of the workdir workdir_id.
+                A working copy that fits on the tmpfs (see tmpfs_workdir.py) is made
+                there instead, since copies to memory are cheap.
+        The workdir is chosen, reserved and registered when it is first created
+        (see allocate_workdir), so a Repository that only uses the clone takes no
+        space on the tmpfs and no slot of the pool.
         """
+        if workdir_mode not in ("copy", "shared"):
+            raise ValueError(f"Unknown working copy mode: {workdir_mode}")
+        if workdir_id is None:
+            workdir_id = uuid.uuid4().hex  # uuid4 is a random UID
         self.merge_idx = merge_idx
         self.repo_slug = repo_slug.lower()
         self.owner, self.name = self.repo_slug.split("/")
         self.repo_path = REPOS_PATH / repo_slug
+        self.pool_slot = None
+        self.tmpfs_reservation = None
+        # The clone is not evicted by the storage manager while it is held.
+        self.holds_clone = False
+        hold_clone(self.repo_path)
+        self.holds_clone = True
+        # The commit of the last checkout, until the working tree is merged.
+        self.checked_out_commit = None
+        # The result of the last merge, if it was done in memory.
+        self.in_memory_merge = None
+        # The workdir on disk, until allocate_workdir chooses it.
+        self.workdir_id = workdir_id
         self.workdir = WORKDIR_DIRECTORY / workdir_id
         self.local_repo_path = self.workdir / self.repo_path.name
+        self.workdir_allocated = False
         self.delete_workdir = delete_workdir
+        self.use_pool = use_pool
         self.lazy_clone = lazy_clone
+        self.workdir_mode = workdir_mode
         if not lazy_clone:
             self.clone_repo()
-            self.copy_repo()
+            self.ensure_working_copy()
         self.test_cache_directory = cache_directory / "test_cache"
         self.sha_cache_directory = cache_directory / "sha_cache_entry"
+        self.log_store_directory = cache_directory / "logs"
 
-    def clone_repo(self) -> None:
-        """Clones the repository."""
-        lock_path = REPOS_PATH / "locks" / self.repo_slug
-        lock = fasteners.InterProcessLock(lock_path)
-        with lock:
+    def get_clone_lock(self) -> fasteners.InterProcessLock:
+        """Returns the lock that serializes the changes to the clone in REPOS_PATH."""
+        return fasteners.InterProcessLock(REPOS_PATH / "locks" / self.repo_slug)
+
+    def clone_repo(self, offline: bool = OFFLINE) -> None:
+        """Clones the repository.
+        Args:
+            offline (bool, optional) = OFFLINE: Whether to clone the mirror of the
+                repository without fetching.
+        """
+        with self.get_clone_lock():
             if self.repo_path.exists():
                 return
             try:
-                clone_repo(self.repo_slug, self.repo_path)
+                clone_repo(self.repo_slug, self.repo_path, offline)
+                touch_clone(self.repo_path)
             except Exception as e:
                 logger.error("Exception during cloning:\n", e)
                 raise
@@ -275,13 +412,107 @@ class Repository:
                 f"Repo {self.repo_slug} does not exist after cloning {self.repo_path}"
             )
 
+    def update_clone(self, offline: bool = OFFLINE) -> None:
+        """Fetches the repository into its mirror, and the mirror into the clone.
+        Args:
+            offline (bool, optional) = OFFLINE: Whether to only fetch the mirror, as
+                it is, into the clone.
+        Raises:
+            subprocess.CalledProcessError: If a fetch fails.
+        """
+        mirror_path = (
+            get_mirror_path(self.repo_slug)
+            if offline
+            else update_mirror(self.repo_slug)
+        )
+        if not mirror_path.exists():
+            return
+        with self.get_clone_lock():
+            subprocess.run(
+                [
+                    "git",
+                    "fetch",
+                    "--quiet",
+                    str(mirror_path.resolve()),
+                    "+refs/heads/*:refs/remotes/origin/*",
+                    "+refs/tags/*:refs/tags/*",
+                    "+refs/pull/*/head:refs/remotes/origin/pull/*",
+                ],
+                cwd=self.repo_path,
+                check=True,
+                capture_output=True,
+            )
+
+    def allocate_workdir(self) -> None:
+        """Chooses the workdir before it is first created: a reserved workdir on the
+        tmpfs if the working copy fits there, otherwise a slot of the pool if
+        use_pool, otherwise the workdir workdir_id in WORKDIR_DIRECTORY.  A workdir
+        that is deleted with the Repository is registered (see
+        storage_manager.register_workdir).  Does nothing after the first call.
+        """
+        if self.workdir_allocated:
+            return
+        self.workdir_allocated = True
+        if TMPFS_WORKDIR_DIRECTORY is not None and self.delete_workdir:
+            self.tmpfs_reservation = reserve_tmpfs(
+                estimate_working_copy_size(
+                    self.repo_path, self.repo_slug, self.workdir_mode
+                )
+            )
+        if self.tmpfs_reservation is None and self.use_pool:
+            self.pool_slot = acquire_workdir(self.repo_slug)
+        if self.pool_slot is not None:
+            self.workdir = self.pool_slot.path
+        else:
+            if self.tmpfs_reservation is not None:
+                assert TMPFS_WORKDIR_DIRECTORY is not None
+                self.workdir = TMPFS_WORKDIR_DIRECTORY / self.workdir_id
+            if self.delete_workdir:
+                register_workdir(self.workdir)
+        self.local_repo_path = self.workdir / self.repo_path.name
+
     def copy_repo(self) -> None:
-        """Copies the repository and adjusts permissions."""
+        """Makes the working copy of the repository from the clone in REPOS_PATH.
+        In "copy" mode, the clone is copied and the permissions are adjusted.
+        In "shared" mode, the working copy is a `git clone --shared` of the clone:
+        it uses the object store of the clone through .git/objects/info/alternates,
+        so only the checked-out files are written.  The clone must therefore not be
+        deleted while the working copy is in use: the Repository holds a shared lock
+        on the clone (storage_manager.hold_clone) from its creation until
+        release_clone, and storage_manager.evict_clone deletes a clone only under
+        the exclusive lock, together with the pool slots of its repository.  The
+        clone lock only serializes the `git clone --shared` with the changes to the
+        clone (cloning and fetching).
+        """
         if not self.repo_path.exists():
             self.clone_repo()
-        if self.local_repo_path.exists():
-            shutil.rmtree(self.local_repo_path, ignore_errors=True)
+        self.allocate_workdir()
+        trash_workdir(self.local_repo_path)
         self.workdir.mkdir(parents=True, exist_ok=True)
+        if self.workdir_mode == "shared":
+            with self.get_clone_lock():
+                subprocess.run(
+                    [
+                        "git",
+                        "clone",
+                        "--quiet",
+                        "--shared",
+                        "--no-checkout",
+                        str(self.repo_path.resolve()),
+                        str(self.local_repo_path),
+                    ],
+                    check=True,
+                    capture_output=True,
+                )
+            # Use the configuration of the clone, as a copy would.
+            shutil.copyfile(
+                self.repo_path / ".git" / "config",
+                self.local_repo_path / ".git" / "config",
+            )
+            self.repo = Repo(self.local_repo_path)
+            # A gc in the working copy could delete objects that it borrows.
+            self.repo.git.config("gc.auto", "0")
+            return
         shutil.copytree(
             self.repo_path,
             self.local_repo_path,
@@ -291,6 +522,31 @@ class Repository:
         os.system("chmod -R 777 " + str(self.local_repo_path))
         self.repo = Repo(self.local_repo_path)
 
+    def ensure_working_copy(self) -> None:
+        """Makes the working copy if it does not exist.  A working copy of the pool
+        that was used before is reset first, or made again if it cannot be reset.
+        """
+        self.allocate_workdir()
+        if (
+            self.pool_slot is not None
+            and self.pool_slot.needs_reset
+            and self.local_repo_path.exists()
+        ):
+            try:
+                reset_working_copy(self.local_repo_path, self.repo_path)
+                self.repo = Repo(self.local_repo_path)
+            except subprocess.CalledProcessError as e:
+                logger.warning(
+                    f"ensure_working_copy: Could not reset {self.local_repo_path}, "
+                    f"copying it again: {e.stderr}"
+                )
+                trash_workdir(self.local_repo_path)
+        if self.pool_slot is not None:
+            self.pool_slot.needs_reset = False
+        if not self.local_repo_path.exists():
+            self.copy_repo()
+
+    @cache_transaction()
     def checkout(self, commit: str, use_cache: bool = True) -> Tuple[bool, str]:
         """Checks out the given commit.
         Args:
@@ -311,13 +567,14 @@ class Repository:
                     )
                 return False, "Failed to clone " + self.repo_slug + " : \n" + str(e)
         assert self.repo_path.exists(), f"Repo {self.repo_slug} does not exist"
-        if not self.local_repo_path.exists():
-            self.copy_repo()
+        self.ensure_working_copy()
         assert self.local_repo_path.exists()
+        self.checked_out_commit = None
         try:
             self.repo.git.checkout(commit, force=True)
             explanation = f"Checked out {commit} for {self.repo_slug}"
             self.repo.submodule_update()
+            self.checked_out_commit = self.repo.head.commit.hexsha
         except Exception as e:
             explanation = (
                 "Failed to checkout "
@@ -379,7 +636,7 @@ class Repository:
             right_fingerprint,
             _,
             _,
-        ) = self.merge(tool, left_commit, right_commit, timeout_merge)
+        ) = self.merge(tool, left_commit, right_commit, timeout_merge, in_memory=True)
         if merge_status != MERGE_STATE.Merge_success:
             return (
                 merge_status,
@@ -388,6 +645,28 @@ class Repository:
                 right_fingerprint,
                 -1,
             )
+        if self.in_memory_merge is not None:
+            # The merge is only checked out if it must be tested.
+            assert merge_fingerprint is not None
+            test_result, test_coverage = self.get_test_cache_entry(merge_fingerprint)
+            if test_result is not None:
+                return (
+                    test_result,
+                    merge_fingerprint,
+                    left_fingerprint,
+                    right_fingerprint,
+                    test_coverage,
+                )
+            try:
+                self.checkout_merge()
+            except subprocess.CalledProcessError as e:
+                logger.warning(
+                    f"_merge_and_test: Could not check out the merge of {left_commit} "
+                    f"and {right_commit} for {self.repo_slug}, merging again: {e.stderr}"
+                )
+                self.merge(
+                    tool, left_commit, right_commit, timeout_merge, use_cache=False
+                )
         test_result, test_coverage = self.test(timeout_test, n_tests)
         return (
             test_result,
@@ -467,6 +746,7 @@ class Repository:
             test_coverage,
         )
 
+    @cache_transaction()
     def create_branch(
         self, branch_name: str, commit: str, use_cache: bool = True
     ) -> Tuple[Union[None, str], str]:
@@ -499,6 +779,7 @@ class Repository:
         self.repo.git.checkout("-b", branch_name, force=True)
         return tree_fingerprint, explanation
 
+    @cache_transaction()
     def merge(
         self,
         tool: MERGE_TOOL,
@@ -507,6 +788,7 @@ class Repository:
         timeout: int,
         use_cache: bool = True,
         verbose: bool = False,
+        in_memory: bool = False,
     ) -> Tuple[
         MERGE_STATE, Union[str, None], Union[str, None], Union[str, None], str, float
     ]:
@@ -518,6 +800,10 @@ class Repository:
             explanation (str): The explanation of the result.
             timeout (int): The timeout limit, in seconds.
             use_cache (bool, optional) = True: Whether to check the cache.
+            in_memory (bool, optional) = False: Whether the merge may be done without
+                the working copy, with `git merge-tree` (see in_memory_merge.py).
+                The working copy then does not contain the result, and
+                in_memory_merge is set; checkout_merge checks the result out.
         Returns:
             MERGE_STATE: The result of the merge.
             str: The tree fingerprint of the result.
@@ -527,6 +813,13 @@ class Repository:
             float: The time it took to run the merge, in seconds.
         """
         cache_entry_name = left_commit + "_" + right_commit + "_" + tool.name
+        self.in_memory_merge = None
+        if in_memory and can_merge_in_memory(tool.name):
+            result = self._merge_in_memory(
+                tool, left_commit, right_commit, timeout, use_cache
+            )
+            if result is not None:
+                return result
         cache_entry: Dict[str, Union[str, None]] = {"sha": None}
         # Checkout left
         left_fingerprint, left_explanation = self.create_branch(
@@ -577,6 +870,7 @@ class Repository:
             f"merge: Merging {self.repo_slug} {left_commit} {right_commit} with {tool.name}"
         )
         logger.debug(f"command = {command}")
+        self.checked_out_commit = None
         p = subprocess.run(
             command,
             capture_output=True,
@@ -612,16 +906,9 @@ class Repository:
         if use_cache:
             cache_entry["sha"] = sha
             cache_entry["merge status"] = merge_status.name
-            output_file = (
-                self.sha_cache_directory
-                / self.owner
-                / "logs"
-                / f"{cache_entry_name}.log"
+            cache_entry["merge_logs"] = store_log(
+                explanation, self.repo_slug, self.log_store_directory
             )
-            output_file.parent.mkdir(parents=True, exist_ok=True)
-            cache_entry["merge_logs"] = str(output_file)
-            with open(output_file, "w", encoding="utf-8") as f:
-                f.write(explanation)
             set_in_cache(
                 cache_entry_name,
                 cache_entry,
@@ -637,25 +924,269 @@ class Repository:
             run_time,
         )
 
+    def _merge_in_memory(
+        self,
+        tool: MERGE_TOOL,
+        left_commit: str,
+        right_commit: str,
+        timeout: int,
+        use_cache: bool,
+    ) -> Union[
+        Tuple[
+            MERGE_STATE,
+            Union[str, None],
+            Union[str, None],
+            Union[str, None],
+            str,
+            float,
+        ],
+        None,
+    ]:
+        """Helper function for `merge`, which merges the given commits with
+        `git merge-tree` in a scratch repository instead of running the tool in the
+        working copy.  The results and the cache entries are those of the tool.
+        Args:
+            tool (MERGE_TOOL): The tool to use, which can_merge_in_memory.
+            left_commit (str): The left commit to merge.
+            right_commit (str): The right commit to merge.
+            timeout (int): The timeout limit, in seconds.
+            use_cache (bool): Whether to check the cache.
+        Returns:
+            The result of `merge`, or None if the merge must be done in the working
+            copy.
+        """
+        if not self.repo_path.exists():
+            try:
+                self.clone_repo()
+            except Exception:
+                return None
+        if converts_line_endings(self.repo_path):
+            return None
+        commits = (left_commit, right_commit)
+        if use_cache:
+            for commit in commits:
+                cache_entry = self.get_sha_cache_entry(commit)
+                if cache_entry is not None and cache_entry["sha"] is None:
+                    # The checkout failed; `merge` explains why.
+                    return None
+        self.allocate_workdir()
+        git_directory = create_scratch_repository(
+            self.workdir / SCRATCH_REPOSITORY_NAME, self.repo_path
+        )
+        commit_ids = []
+        fingerprints = []
+        for commit in commits:
+            commit_id = resolve_commit(git_directory, commit)
+            if commit_id is None:
+                return None
+            entries = tree_fingerprint.list_tree(git_directory, commit_id)
+            if not is_checkout_of_blobs(entries):
+                return None
+            commit_ids.append(commit_id)
+            fingerprints.append(
+                self.compute_commit_fingerprint(git_directory, commit_id, entries)
+            )
+        left_fingerprint, right_fingerprint = fingerprints
+        explanations = [
+            f"Checked out {commit} for {self.repo_slug}" for commit in commits
+        ]
+        explanation = "\n".join(explanations)
+
+        logger.debug(
+            f"merge: Merging {self.repo_slug} {left_commit} {right_commit} "
+            f"with {tool.name} in memory"
+        )
+        start_time = time.time()
+        try:
+            merge, command, p = merge_in_memory(
+                git_directory, tool.name, commit_ids[0], commit_ids[1], timeout
+            )
+        except subprocess.TimeoutExpired as e:
+            merge = None
+            merge_status = MERGE_STATE.Merge_timedout
+            explanation = explanation + "\n" + stdout_and_stderr(e.cmd, e)
+        else:
+            if merge is None:
+                logger.debug(stdout_and_stderr(command, p))
+                return None
+            merge_status = (
+                MERGE_STATE.Merge_success if merge.success else MERGE_STATE.Merge_failed
+            )
+            explanation = explanation + "\n" + stdout_and_stderr(command, p)
+        run_time = time.time() - start_time
+        logger.debug(explanation)
+        sha = None
+        if merge is not None:
+            sha = tree_fingerprint.compute_tree_object_fingerprint(
+                git_directory, merge.tree, FINGERPRINT_MODE
+            )
+            self.in_memory_merge = merge
+
+        if use_cache:
+            for commit, fingerprint, commit_explanation in zip(
+                commits, fingerprints, explanations
+            ):
+                set_in_cache(
+                    commit,
+                    {"sha": fingerprint, "explanation": commit_explanation},
+                    self.repo_slug,
+                    self.sha_cache_directory,
+                )
+            cache_entry: Dict[str, Union[str, None]] = {
+                "sha": sha,
+                "left_fingerprint": left_fingerprint,
+                "right_fingerprint": right_fingerprint,
+                "merge status": merge_status.name,
+            }
+            if merge is None:
+                cache_entry["explanation"] = explanation
+            else:
+                cache_entry["merge_logs"] = store_log(
+                    explanation, self.repo_slug, self.log_store_directory
+                )
+            set_in_cache(
+                left_commit + "_" + right_commit + "_" + tool.name,
+                cache_entry,
+                self.repo_slug,
+                self.sha_cache_directory,
+            )
+        if merge is None:
+            return (
+                merge_status,
+                None,
+                left_fingerprint,
+                right_fingerprint,
+                explanation,
+                -1,
+            )
+        return (
+            merge_status,
+            sha,
+            left_fingerprint,
+            right_fingerprint,
+            explanation,
+            run_time,
+        )
+
+    def checkout_merge(self) -> None:
+        """Checks out the result of the last in-memory merge in the working copy, as
+        the merge tool leaves it: the branch LEFT_BRANCH_NAME is a merge commit of
+        the two commits.
+        Raises:
+            subprocess.CalledProcessError: If a git command fails.
+        """
+        assert self.in_memory_merge is not None
+        git_directory = self.in_memory_merge.git_directory
+        merge_commit = commit_merge(self.in_memory_merge)
+        self.ensure_working_copy()
+        self.checked_out_commit = None
+        for command in (
+            [
+                "git",
+                "fetch",
+                "--quiet",
+                "--no-tags",
+                str(git_directory.resolve()),
+                "refs/heads/merged",
+            ],
+            [
+                "git",
+                "checkout",
+                "--quiet",
+                "--force",
+                "-B",
+                LEFT_BRANCH_NAME,
+                merge_commit,
+            ],
+        ):
+            subprocess.run(
+                command, cwd=self.local_repo_path, check=True, capture_output=True
+            )
+        # The fingerprint of the merge is known, so the tests do not hash the tree.
+        memoize_fingerprint(
+            (self.repo_slug, merge_commit),
+            tree_fingerprint.compute_tree_object_fingerprint(
+                git_directory, self.in_memory_merge.tree, FINGERPRINT_MODE
+            ),
+        )
+        self.checked_out_commit = merge_commit
+
+    def get_clean_checkout_commit(self) -> Union[str, None]:
+        """Returns the commit of the last checkout if the working tree is still a
+        clean checkout of it: HEAD is that commit and `git status` reports no
+        modified, untracked or ignored file.  Repositories with submodules are
+        never considered clean, since the status does not report the ignored
+        files of submodules.
+        Returns:
+            Union[str,None]: The commit, or None if the working tree may differ from
+                a clean checkout.
+        """
+        if self.checked_out_commit is None:
+            return None
+        if (self.local_repo_path / ".gitmodules").exists():
+            return None
+        status = subprocess.run(
+            ["git", "status", "--porcelain=v2", "--branch", "--ignored"],
+            cwd=self.local_repo_path,
+            capture_output=True,
+            text=True,
+            check=False,
+        )
+        if status.returncode != 0:
+            return None
+        head = None
+        for line in status.stdout.splitlines():
+            if line.startswith("# branch.oid "):
+                head = line.split()[2]
+            elif not line.startswith("#"):
+                return None
+        return self.checked_out_commit if head == self.checked_out_commit else None
+
     def compute_tree_fingerprint(self) -> str:
         """Computes the tree fingerprint of the repository.
+        The fingerprint of a clean checkout of a commit is memoized, so the tree is
+        only hashed after a merge, or when files were written since the checkout.
         This function must never be run after running tests,
         since running tests might write output files.
         Returns:
             str: The tree fingerprint.
         """
         assert self.local_repo_path.exists(), f"Repo {self.repo_slug} does not exist"
-        command = (
-            "sha256sum <(export LC_ALL=C; export LC_COLLATE=C; cd "
-            + str(self.local_repo_path)
-            + " ;find . -type f -not -path '*/\\.git*' -exec sha256sum {} \\; | sort)"
+        commit = self.get_clean_checkout_commit()
+        memo_key = (self.repo_slug, commit)
+        if commit is not None and memo_key in _commit_fingerprints:
+            return _commit_fingerprints[memo_key]
+        fingerprint = tree_fingerprint.compute_tree_fingerprint(
+            self.local_repo_path, FINGERPRINT_MODE
         )
-        result = (
-            subprocess.check_output(command, shell=True, executable="/bin/bash")
-            .decode("utf-8")
-            .split()[0]
-        )
-        return result
+        if commit is not None:
+            memoize_fingerprint(memo_key, fingerprint)
+        return fingerprint
+
+    def compute_commit_fingerprint(
+        self,
+        git_directory: Path,
+        commit: str,
+        entries: List[Tuple[bytes, bytes, bytes]],
+    ) -> str:
+        """Computes the tree fingerprint of a clean checkout of a commit from the
+        object store, without checking it out.
+        Args:
+            git_directory (Path): The git directory that contains the commit.
+            commit (str): The id of the commit.
+            entries (List[Tuple[bytes,bytes,bytes]]): The entries of its tree.
+        Returns:
+            str: The tree fingerprint.
+        """
+        memo_key = (self.repo_slug, commit)
+        if memo_key not in _commit_fingerprints:
+            memoize_fingerprint(
+                memo_key,
+                tree_fingerprint.compute_tree_object_fingerprint(
+                    git_directory, commit + "^{tree}", FINGERPRINT_MODE, entries
+                ),
+            )
+        return _commit_fingerprints[memo_key]
 
     def get_sha_cache_entry(
         self, commit: str, start_merge: bool = False
@@ -754,6 +1285,7 @@ class Repository:
             return self._checkout_and_test(commit, timeout, n_tests)
         return result, test_coverage, sha_cache_entry["sha"]
 
+    @cache_transaction()
     def test(
         self,
         timeout: int,
@@ -770,6 +1302,7 @@ class Repository:
             n_tests (int): The number of times to run the test suite.
             use_cache (bool, optional) = True: Whether to check the cache.
             test_log_file (Union[None,Path], optional) = None: The path to the test log file.
+                If None, the logs are kept in the log store of the cache.
         Returns:
             TEST_STATE: The result of the test.
             float: The test coverage.
@@ -791,21 +1324,18 @@ class Repository:
             )
             test_state, test_output = repo_test(self.local_repo_path, timeout)
             if test_log_file is None:
-                test_log_file = Path(
-                    os.path.join(
-                        self.test_cache_directory,
-                        "logs",
-                        self.repo_slug,
-                        sha + "_" + str(i) + ".log",
-                    )
+                test_log_reference = store_log(
+                    test_output, self.repo_slug, self.log_store_directory
                 )
-            test_log_file.parent.mkdir(parents=True, exist_ok=True)
-            if test_log_file.exists():
-                test_log_file.unlink()
-            with open(test_log_file, "w", encoding="utf-8") as f:
-                f.write(test_output)
+            else:
+                test_log_file.parent.mkdir(parents=True, exist_ok=True)
+                if test_log_file.exists():
+                    test_log_file.unlink()
+                with open(test_log_file, "w", encoding="utf-8") as f:
+                    f.write(test_output)
+                test_log_reference = str(test_log_file)
             cache_data["test_results"].append(test_state.name)
-            cache_data["test_log_file"].append(str(test_log_file))
+            cache_data["test_log_file"].append(test_log_reference)
             cache_data["test_result"] = test_state.name
             cache_data["test_coverage"].append(self.compute_test_coverage())
             if test_state in (TEST_STATE.Tests_passed, TEST_STATE.Tests_timedout):
@@ -849,6 +1379,20 @@ class Repository:
         """
         return self.repo.head.commit.hexsha
 
+    def get_git_query_service(self) -> GitQueryService:
+        """Returns the git query service of the clone in REPOS_PATH (see
+        git_query_service.py), cloning the repository if needed.  The service
+        answers queries about commits without a working copy, and its merge
+        bases are looked up in the merge base index of the repository.
+        Returns:
+            GitQueryService: The service, shared by all code of this process.
+        """
+        if not self.repo_path.exists():
+            self.clone_repo()
+        return get_git_query_service(
+            self.repo_path / ".git", get_merge_base_index(self.repo_slug)
+        )
+
     def run_command(self, command: str) -> Tuple[str, str]:
         """Runs a command in the repository.
         Args:
@@ -856,8 +1400,7 @@ class Repository:
         Returns:
             Tuple[str,str]: The standard output and standard error of the command.
         """
-        if not self.local_repo_path.exists():
-            self.copy_repo()
+        self.ensure_working_copy()
         process = subprocess.run(
             command,
             shell=True,
@@ -874,6 +1417,14 @@ class Repository:
         return process.stdout, process.stderr
 
     def __del__(self) -> None:
-        """Deletes the repository."""
-        if self.delete_workdir:
-            shutil.rmtree(self.workdir, ignore_errors=True)
+        """Deletes the repository, or returns its working copy to the pool."""
+        if self.pool_slot is not None:
+            self.pool_slot.release()
+        elif self.delete_workdir and self.workdir_allocated:
+            # The workdir is deleted in the background by the reaper.
+            trash_workdir(self.workdir)
+            unregister_workdir(self.workdir)
+        if self.tmpfs_reservation is not None:
+            self.tmpfs_reservation.release()
+        if self.holds_clone:
+            release_clone(self.repo_path)
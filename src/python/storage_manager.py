@@ -0,0 +1,543 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Keeps the clones in REPOS_PATH and the working copies in WORKDIR_DIRECTORY
+within a disk budget, AST_DISK_BUDGET (e.g. "500G"; no budget if unset).
+The storage is made of:
+- clones, REPOS_PATH/<owner>/<repo>.  A Repository holds a shared lock on its
+  clone (hold_clone) while it exists, and records the last use of the clone in
+  REPOS_PATH/.last_used/<owner>/<repo>.
+- mirrors, MIRRORS_PATH/<owner>/<repo>.git (see mirror_store.py).
+- the slots of the working copy pool (see workdir_pool.py).
+- workdirs, in WORKDIR_DIRECTORY and TMPFS_WORKDIR_DIRECTORY.  A Repository
+  that deletes its workdir registers it, with its process, in
+  WORKDIR_DIRECTORY/.owners; the workdir of a process that died is stale.
+- the trash, the directories that wait to be deleted by the reaper (see
+  workdir_reaper.py).
+Stale workdirs are always deleted.  The workdirs and the trash count against the
+budget but are not evicted.  While the storage exceeds the budget, the least
+recently used items are evicted, in this order: free pool slots, clones without
+pending work, clones with pending work, and mirrors that no clone and no other
+mirror borrows objects from.  A repository has pending work if its merge list in
+--merges_path has a merge and its results are not in --results_path yet, the
+output of the last stage that uses the clones (see has_pending_work).  Nothing that a live process holds is evicted; a clone that is
+evicted is cloned again when it is needed.  Evicted items are moved to the
+trash, so that the locks are not held while they are deleted.
+usage: python3 storage_manager.py [--merges_path <merges_path>]
+                                  [--results_path <results_path>]
+                                  [--report <report.json>] [--interval <seconds>]
+With --interval, the storage is checked every <seconds> seconds until the
+process is killed.
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+import shutil
+import socket
+import subprocess
+import time
+from pathlib import Path
+from typing import Dict, List, Set, Tuple, Union
+import fasteners
+from loguru import logger
+from variables import (
+    DISK_BUDGET,
+    MIRRORS_PATH,
+    REPOS_PATH,
+    TMPFS_WORKDIR_DIRECTORY,
+    WORKDIR_DIRECTORY,
+)
+from workdir_pool import POOL_DIRECTORY, list_slots, get_last_use_time, try_acquire_slot
+from workdir_reaper import TRASH_DIRECTORY, trash_workdir
+from mirror_store import get_alternates_path, get_mirror_lock
+
+LAST_USED_DIRECTORY = REPOS_PATH / ".last_used"
+WORKDIR_OWNERS_DIRECTORY = WORKDIR_DIRECTORY / ".owners"
+SIZE_UNITS = {"K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+
+# The shared locks on clones held by this process, with the number of holders.
+# The locks are fcntl locks, which a process holds once whatever the number of
+# open files, so each clone is locked once per process.
+_held_clones: Dict[Path, Tuple[fasteners.InterProcessReaderWriterLock, int]] = {}
+
+
+def parse_size(size: str) -> int:
+    """Parses a size such as "500G", "1.5T" or "1000000" (in bytes).
+    Args:
+        size (str): The size.
+    Returns:
+        int: The size in bytes.
+    """
+    size = size.strip().upper().removesuffix("B")
+    if size and size[-1] in SIZE_UNITS:
+        return int(float(size[:-1]) * SIZE_UNITS[size[-1]])
+    return int(size)
+
+
+def get_clone_key(repo_path: Path) -> Path:
+    """Returns the path of a clone relative to REPOS_PATH, "<owner>/<repo>"."""
+    return repo_path.relative_to(REPOS_PATH)
+
+
+def get_clone_use_lock(repo_path: Path) -> fasteners.InterProcessReaderWriterLock:
+    """Returns the lock that the users of a clone hold shared, and the storage
+    manager holds exclusively to evict it."""
+    return fasteners.InterProcessReaderWriterLock(
+        REPOS_PATH / "locks" / (str(get_clone_key(repo_path)) + ".use")
+    )
+
+
+def touch_clone(repo_path: Path) -> None:
+    """Records that a clone is used now."""
+    marker = LAST_USED_DIRECTORY / get_clone_key(repo_path)
+    marker.parent.mkdir(parents=True, exist_ok=True)
+    marker.touch()
+
+
+def hold_clone(repo_path: Path) -> None:
+    """Prevents the eviction of a clone until release_clone is called, and records
+    that it is used now.  Waits while the clone is being evicted.
+    Args:
+        repo_path (Path): The clone in REPOS_PATH, which need not exist yet.
+    """
+    lock, n_holders = _held_clones.get(repo_path, (None, 0))
+    if lock is None:
+        lock = get_clone_use_lock(repo_path)
+        lock.acquire_read_lock()
+    _held_clones[repo_path] = (lock, n_holders + 1)
+    touch_clone(repo_path)
+
+
+def release_clone(repo_path: Path) -> None:
+    """Releases a clone held by hold_clone."""
+    if repo_path not in _held_clones:
+        return
+    lock, n_holders = _held_clones[repo_path]
+    if n_holders > 1:
+        _held_clones[repo_path] = (lock, n_holders - 1)
+        return
+    del _held_clones[repo_path]
+    lock.release_read_lock()
+
+
+def get_workdir_owner_file(workdir: Path) -> Path:
+    """Returns the file that registers the process that owns a workdir."""
+    digest = hashlib.sha256(str(workdir.resolve()).encode("utf-8")).hexdigest()
+    return WORKDIR_OWNERS_DIRECTORY / (digest + ".json")
+
+
+def register_workdir(workdir: Path) -> None:
+    """Registers a workdir as owned by this process, which must delete it and
+    call unregister_workdir.  The workdir is deleted by the storage manager if the
+    process dies first."""
+    owner_file = get_workdir_owner_file(workdir)
+    owner_file.parent.mkdir(parents=True, exist_ok=True)
+    owner = {
+        "workdir": str(workdir.resolve()),
+        "pid": os.getpid(),
+        "host": socket.gethostname(),
+    }
+    owner_file.write_text(json.dumps(owner), encoding="utf-8")
+
+
+def unregister_workdir(workdir: Path) -> None:
+    """Unregisters a workdir registered by register_workdir."""
+    get_workdir_owner_file(workdir).unlink(missing_ok=True)
+
+
+def is_process_alive(owner: dict) -> bool:
+    """Returns whether the process that registered a workdir may be alive.
+    The processes of other hosts are assumed to be alive."""
+    if owner["host"] != socket.gethostname():
+        return True
+    try:
+        os.kill(owner["pid"], 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def delete_stale_workdirs() -> int:
+    """Deletes the registered workdirs of the processes that died.
+    Returns:
+        int: The number of deleted workdirs.
+    """
+    n_deleted = 0
+    for owner_file in WORKDIR_OWNERS_DIRECTORY.glob("*.json"):
+        try:
+            owner = json.loads(owner_file.read_text(encoding="utf-8"))
+        except (OSError, json.JSONDecodeError):
+            continue
+        if is_process_alive(owner):
+            continue
+        logger.info(f"delete_stale_workdirs: Deleting {owner['workdir']}")
+        trash_workdir(owner["workdir"])
+        owner_file.unlink(missing_ok=True)
+        n_deleted += 1
+    return n_deleted
+
+
+def measure_sizes(paths: List[Path]) -> Dict[Path, int]:
+    """Measures the disk usage of files and directories with `du`.
+    Args:
+        paths (List[Path]): The paths.
+    Returns:
+        Dict[Path,int]: The disk usage of each path, in bytes.
+    """
+    sizes: Dict[Path, int] = {}
+    for start in range(0, len(paths), 1000):
+        batch = paths[start : start + 1000]
+        output = subprocess.run(
+            ["du", "-s", "-k", "--", *map(str, batch)],
+            capture_output=True,
+            text=True,
+            check=False,
+        ).stdout
+        for line in output.splitlines():
+            size, path = line.split("\t", 1)
+            sizes[Path(path)] = int(size) * 1024
+    return sizes
+
+
+def list_clones() -> List[Path]:
+    """Returns the clones in REPOS_PATH."""
+    return [
+        path
+        for path in REPOS_PATH.glob("*/*")
+        if not path.parent.name.startswith(".")
+        and path.parent.name != "locks"
+        and (path / ".git").exists()
+    ]
+
+
+def list_mirrors() -> List[Path]:
+    """Returns the mirrors in MIRRORS_PATH."""
+    return [path for path in MIRRORS_PATH.glob("*/*.git") if (path / "config").exists()]
+
+
+def list_borrowed_mirrors() -> Set[Path]:
+    """Returns the mirrors whose objects a clone or another mirror borrows, through
+    its alternates, resolved."""
+    alternates_paths = [get_alternates_path(path) for path in list_mirrors()] + [
+        path / ".git" / "objects" / "info" / "alternates" for path in list_clones()
+    ]
+    borrowed_mirrors = set()
+    for alternates_path in alternates_paths:
+        try:
+            lines = alternates_path.read_text().splitlines()
+        except FileNotFoundError:
+            continue
+        for line in lines:
+            # Each line is the objects directory of a repository.
+            borrowed_mirrors.add(Path(line).parent.resolve())
+    return borrowed_mirrors
+
+
+def get_clone_last_use_time(repo_path: Path) -> float:
+    """Returns when a clone was last used."""
+    try:
+        return (LAST_USED_DIRECTORY / get_clone_key(repo_path)).stat().st_mtime
+    except FileNotFoundError:
+        return repo_path.stat().st_mtime
+
+
+def evict_clone(repo_path: Path) -> bool:
+    """Deletes a clone, and the free pool slots of its repository, unless a process
+    holds the clone or one of the slots, or is cloning or deleting it.
+    Returns:
+        bool: Whether the clone was deleted.
+    """
+    lock = get_clone_use_lock(repo_path)
+    if not lock.acquire_write_lock(blocking=False):
+        return False
+    # The lock of Repository.get_clone_lock.
+    clone_lock = fasteners.InterProcessLock(
+        REPOS_PATH / "locks" / str(get_clone_key(repo_path)).lower()
+    )
+    if not clone_lock.acquire(blocking=False):
+        lock.release_write_lock()
+        return False
+    try:
+        slots = []
+        for slot_path in list_slots():
+            if slot_path.parent.relative_to(WORKDIR_DIRECTORY / "pool") != Path(
+                str(get_clone_key(repo_path)).lower()
+            ):
+                continue
+            slot = try_acquire_slot(slot_path)
+            if slot is None:
+                for held_slot in slots:
+                    held_slot.release()
+                return False
+            slots.append(slot)
+        logger.info(f"evict_clone: Deleting {repo_path}")
+        for slot in slots:
+            trash_workdir(slot.path)
+            slot.release()
+        trash_workdir(repo_path)
+        (LAST_USED_DIRECTORY / get_clone_key(repo_path)).unlink(missing_ok=True)
+    finally:
+        clone_lock.release()
+        lock.release_write_lock()
+    return True
+
+
+def evict_pool_slot(slot_path: Path) -> bool:
+    """Deletes a pool slot unless a process holds it.
+    Returns:
+        bool: Whether the slot was deleted.
+    """
+    slot = try_acquire_slot(slot_path)
+    if slot is None:
+        return False
+    logger.info(f"evict_pool_slot: Deleting {slot_path}")
+    trash_workdir(slot_path)
+    slot.release()
+    return True
+
+
+def evict_mirror(mirror_path: Path) -> bool:
+    """Deletes a mirror, unless a process is cloning it or a clone or another
+    mirror borrows its objects.  The clones are listed again under the locks,
+    since one may have been made since get_usage.
+    Returns:
+        bool: Whether the mirror was deleted.
+    """
+    repo_slug = str(mirror_path.relative_to(MIRRORS_PATH)).removesuffix(".git")
+    lock = get_mirror_lock(repo_slug)
+    if not lock.acquire(blocking=False):
+        return False
+    # The lock of Repository.get_clone_lock, which is held while cloning.
+    clone_lock = fasteners.InterProcessLock(REPOS_PATH / "locks" / repo_slug.lower())
+    if not clone_lock.acquire(blocking=False):
+        lock.release()
+        return False
+    try:
+        if mirror_path.resolve() in list_borrowed_mirrors():
+            return False
+        logger.info(f"evict_mirror: Deleting {mirror_path}")
+        trash_workdir(mirror_path)
+    finally:
+        clone_lock.release()
+        lock.release()
+    return True
+
+
+def has_merges(merge_list_file: Path) -> bool:
+    """Returns whether a merge list, a csv file with a header, has a merge."""
+    try:
+        with open(merge_list_file, encoding="utf-8", newline="") as f:
+            return next(csv.DictReader(f), None) is not None
+    except FileNotFoundError:
+        return False
+
+
+def has_pending_work(
+    repo_slug: str, merges_path: Union[Path, None], results_path: Union[Path, None]
+) -> bool:
+    """Returns whether the merges of a repository are still to be processed: its
+    merge list has a merge, and the last stage that uses the clones has not
+    written the results of the repository yet.  The stages write the results of a
+    repository once all of its merges are processed.
+    Args:
+        repo_slug (str): The slug of the repository, which is "owner/reponame".
+        merges_path (Union[Path,None]): The directory of the merge lists of the
+            pending work, or None if there is no pending work.
+        results_path (Union[Path,None]): The directory of the results of the last
+            stage that uses the clones, or None to consider every merge list.
+    Returns:
+        bool: True if the repository has pending work.
+    """
+    if merges_path is None or not has_merges(merges_path / (repo_slug + ".csv")):
+        return False
+    return results_path is None or not (results_path / (repo_slug + ".csv")).exists()
+
+
+def list_workdirs() -> List[Path]:
+    """Returns the workdirs that are not pool slots: the directories in
+    WORKDIR_DIRECTORY and TMPFS_WORKDIR_DIRECTORY, without the pool, the trash and
+    the registrations."""
+    excluded_paths = {POOL_DIRECTORY, TRASH_DIRECTORY, WORKDIR_OWNERS_DIRECTORY}
+    workdirs = [
+        path
+        for path in WORKDIR_DIRECTORY.glob("*")
+        if path.is_dir() and path not in excluded_paths
+    ]
+    if TMPFS_WORKDIR_DIRECTORY is not None:
+        workdirs += [
+            path
+            for path in TMPFS_WORKDIR_DIRECTORY.glob("*")
+            if path.is_dir() and not path.name.startswith(".")
+        ]
+    return workdirs
+
+
+def get_usage(
+    merges_path: Union[Path, None], results_path: Union[Path, None] = None
+) -> List[dict]:
+    """Lists the items of the storage, the evictable ones in eviction order.
+    Args:
+        merges_path (Union[Path,None]): The directory of the merge lists of the
+            pending work, or None if there is no pending work.
+        results_path (Union[Path,None], optional) = None: The directory of the
+            results of the last stage that uses the clones (see has_pending_work).
+    Returns:
+        List[dict]: The items, with their "kind", "path", "size" (in bytes) and
+            "last_used" (a timestamp).
+    """
+    clones = list_clones()
+    cloned_repos = {str(get_clone_key(path)).lower() for path in clones}
+    mirrors = list_mirrors()
+    borrowed_mirrors = list_borrowed_mirrors()
+    slots = list_slots()
+    workdirs = list_workdirs()
+    trash = [TRASH_DIRECTORY] if TRASH_DIRECTORY.exists() else []
+    sizes = measure_sizes(clones + mirrors + slots + workdirs + trash)
+    stored_repos = cloned_repos | {
+        str(path.relative_to(MIRRORS_PATH)).removesuffix(".git") for path in mirrors
+    }
+    # The merge lists are named after the slugs, which the mirrors lower-case.
+    pending_repos = set()
+    if merges_path is not None:
+        for merge_list_file in merges_path.glob("*/*.csv"):
+            repo_slug = str(merge_list_file.relative_to(merges_path).with_suffix(""))
+            if repo_slug.lower() in stored_repos and has_pending_work(
+                repo_slug, merges_path, results_path
+            ):
+                pending_repos.add(repo_slug.lower())
+
+    items = []
+    for slot_path in slots:
+        items.append(("pool slot", slot_path, get_last_use_time(slot_path)))
+    for repo_path in clones:
+        kind = (
+            "clone with pending work"
+            if str(get_clone_key(repo_path)).lower() in pending_repos
+            else "clone"
+        )
+        items.append((kind, repo_path, get_clone_last_use_time(repo_path)))
+    for mirror_path in mirrors:
+        repo_slug = str(mirror_path.relative_to(MIRRORS_PATH)).removesuffix(".git")
+        if (
+            repo_slug in cloned_repos
+            or repo_slug in pending_repos
+            or mirror_path.resolve() in borrowed_mirrors
+        ):
+            kind = "mirror in use"
+        else:
+            kind = "mirror"
+        items.append((kind, mirror_path, mirror_path.stat().st_mtime))
+    for path in workdirs:
+        items.append(("workdir", path, path.stat().st_mtime))
+    for path in trash:
+        items.append(("trash", path, path.stat().st_mtime))
+    kind_order = ["pool slot", "clone", "clone with pending work", "mirror"]
+    return [
+        {"kind": kind, "path": path, "size": sizes.get(path, 0), "last_used": used}
+        for kind, path, used in sorted(
+            items,
+            key=lambda item: (
+                kind_order.index(item[0]) if item[0] in kind_order else len(kind_order),
+                item[2],
+            ),
+        )
+    ]
+
+
+def manage_storage(
+    budget: Union[int, None],
+    merges_path: Union[Path, None] = None,
+    report_path: Union[Path, None] = None,
+    results_path: Union[Path, None] = None,
+) -> dict:
+    """Deletes the stale workdirs, and evicts items until the storage fits the budget.
+    Args:
+        budget (Union[int,None]): The disk budget, in bytes, or None for no budget.
+        merges_path (Union[Path,None], optional) = None: The directory of the merge
+            lists of the pending work.
+        results_path (Union[Path,None], optional) = None: The directory of the
+            results of the last stage that uses the clones (see has_pending_work).
+        report_path (Union[Path,None], optional) = None: Where to write the report.
+    Returns:
+        dict: The report: the usage by kind, the free disk space and what was
+            deleted, in bytes.
+    """
+    n_stale_workdirs = delete_stale_workdirs()
+    items = get_usage(merges_path, results_path)
+    total_size = sum(item["size"] for item in items)
+    evicted: Dict[str, int] = {}
+    evict = {
+        "pool slot": evict_pool_slot,
+        "clone": evict_clone,
+        "clone with pending work": evict_clone,
+        "mirror": evict_mirror,
+    }
+    for item in items:
+        if budget is None or total_size <= budget:
+            break
+        if item["kind"] not in evict or not evict[item["kind"]](item["path"]):
+            continue
+        total_size -= item["size"]
+        evicted[item["kind"]] = evicted.get(item["kind"], 0) + item["size"]
+    usage: Dict[str, int] = {}
+    for item in items:
+        usage[item["kind"]] = usage.get(item["kind"], 0) + item["size"]
+    REPOS_PATH.mkdir(parents=True, exist_ok=True)
+    report = {
+        "budget": budget,
+        "usage": usage,
+        "usage_after_eviction": total_size,
+        "evicted": evicted,
+        "stale_workdirs_deleted": n_stale_workdirs,
+        "free_disk_space": shutil.disk_usage(REPOS_PATH).free,
+    }
+    if budget is not None and total_size > budget:
+        logger.warning(
+            f"manage_storage: {total_size} bytes used, over the budget of {budget} "
+            "bytes, but the remaining items are in use"
+        )
+    logger.info(f"manage_storage: {report}")
+    if report_path is not None:
+        report_path.parent.mkdir(parents=True, exist_ok=True)
+        report_path.write_text(json.dumps(report, indent=4), encoding="utf-8")
+    return report
+
+
+def _reset_held_clones_after_fork() -> None:
+    """Forgets the clones held by the parent process in a forked child process,
+    which does not hold their fcntl locks."""
+    _held_clones.clear()
+
+
+os.register_at_fork(after_in_child=_reset_held_clones_after_fork)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--merges_path",
+        help="Directory of the merge lists of the pending work",
+        type=Path,
+    )
+    parser.add_argument(
+        "--results_path",
+        help="Directory of the results of the last stage that uses the clones",
+        type=Path,
+    )
+    parser.add_argument("--report", help="Path of the JSON report", type=Path)
+    parser.add_argument(
+        "--interval",
+        help="Check the storage every <interval> seconds until killed",
+        type=int,
+    )
+    args = parser.parse_args()
+    disk_budget = parse_size(DISK_BUDGET) if DISK_BUDGET else None
+    while True:
+        manage_storage(disk_budget, args.merges_path, args.report, args.results_path)
+        if args.interval is None:
+            break
+        time.sleep(args.interval)
@@ -21,6 +21,11 @@ from pathlib import Path
 import shutil
 from typing import Tuple
 from repo import Repository, TEST_STATE
+from cache_utils import (
+    flush_cache_stats_after,
+    reset_cache_stats,
+    summarize_cache_stats,
+)
 from variables import TIMEOUT_TESTING_PARENT
 import pandas as pd
 from loguru import logger
@@ -49,6 +54,7 @@ def num_processes(percentage: float = 0.7) -> int:
     return processes_used
 
 
+@flush_cache_stats_after("test_repo_heads")
 def head_passes_tests(args: Tuple[pd.Series, Path]) -> pd.Series:
     """Runs tests on the head of the main branch.
     Args:
@@ -91,7 +97,9 @@ def head_passes_tests(args: Tuple[pd.Series, Path]) -> pd.Series:
         repo_info["head hash"], timeout=TIMEOUT_TESTING_PARENT, n_tests=3
     )
     if test_state != TEST_STATE.Tests_passed:
-        shutil.rmtree(repo.repo_path, ignore_errors=True)
+        # Working copies in "shared" mode borrow the objects of the clone.
+        with repo.get_clone_lock():
+            shutil.rmtree(repo.repo_path, ignore_errors=True)
 
     repo_info["head test result"] = test_state.name
 
@@ -114,6 +122,7 @@ if __name__ == "__main__":
 
     logger.info("test_repo_heads: Started Testing")
     head_passes_tests_arguments = [(v, arguments.cache_dir) for _, v in df.iterrows()]
+    reset_cache_stats("test_repo_heads")
     with multiprocessing.Pool(processes=num_processes()) as pool:
         with Progress(
             SpinnerColumn(),
@@ -130,6 +139,7 @@ if __name__ == "__main__":
                 head_passes_tests_results.append(result)
                 progress.update(task, advance=1)
     logger.info("test_repo_heads: Finished Testing")
+    summarize_cache_stats("test_repo_heads")
 
     logger.info("test_repo_heads: Started Building Output")
     df = pd.DataFrame(head_passes_tests_results)
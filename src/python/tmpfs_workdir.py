@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""Places working copies on a RAM-backed file system when they fit.
+When AST_TMPFS_WORKDIR is set to a directory on a tmpfs (e.g. /dev/shm/ast), a
+Repository that deletes its workdir puts it there instead of in
+WORKDIR_DIRECTORY, if the estimated size of the working copy fits in the
+budget, AST_TMPFS_BUDGET (e.g. "32G"; by default the size of the file system),
+in the free space of the file system, and in the available memory (MemAvailable
+in /proc/meminfo), since the files of a tmpfs are kept in memory.  Otherwise the working copy spills
+over to WORKDIR_DIRECTORY on disk.
+The estimated size of a working copy is the size of the files of the HEAD of
+the clone, times WORKING_COPY_SIZE_FACTOR to leave room for build outputs, plus
+the size of the .git directory of the clone when it is copied.  Each working
+copy on the tmpfs reserves its estimated size until it is deleted, in
+TMPFS_WORKDIR_DIRECTORY/.reservations; the reservations of processes that died
+are dropped.  Reservations are made when the working copy is created, not when
+its Repository is.
+The free space of the file system is measured under the lock of the
+reservations.  A reservation whose working copy is not written yet does not
+show in it, so a working copy must fit in the free space, and in the available
+memory, minus the reserved space that is not used yet.  The used space of the file system is taken to be
+that of the reserved working copies: the file system is assumed to hold only
+them, and if it holds other files the check is more lenient by their size.
+"""
+
+import json
+import os
+import shutil
+import socket
+import subprocess
+import uuid
+from pathlib import Path
+from typing import Dict, Union
+import fasteners
+from loguru import logger
+from variables import TMPFS_WORKDIR_DIRECTORY, TMPFS_BUDGET
+from mirror_store import get_mirror_path
+from storage_manager import is_process_alive, measure_sizes, parse_size
+
+# The estimated size of a working copy, relative to the size of its files, to
+# leave room for the outputs of builds and tests.
+WORKING_COPY_SIZE_FACTOR = 3
+
+# The estimated size of the files of the HEAD of each clone, in bytes.
+_tree_sizes: Dict[Path, int] = {}
+# The size of the .git directory of each clone, in bytes.
+_git_sizes: Dict[Path, int] = {}
+
+
+class TmpfsReservation:
+    """Space reserved on the tmpfs for a working copy, until release is called."""
+
+    def __init__(self, path: Path) -> None:
+        """Initializes the reservation.
+        Args:
+            path (Path): The file that records the reservation.
+        """
+        self.path = path
+
+    def release(self) -> None:
+        """Releases the space."""
+        self.path.unlink(missing_ok=True)
+
+
+def get_tree_size(repo_path: Path, repo_slug: str) -> Union[int, None]:
+    """Returns the size of the files of the HEAD of a clone, or of its mirror if
+    it is not cloned yet.
+    Args:
+        repo_path (Path): The clone in REPOS_PATH.
+        repo_slug (str): The slug of the repository, which is "owner/reponame".
+    Returns:
+        Union[int,None]: The size in bytes, or None if it is unknown.
+    """
+    if repo_path in _tree_sizes:
+        return _tree_sizes[repo_path]
+    if (repo_path / ".git").exists():
+        git_directory = repo_path / ".git"
+    elif get_mirror_path(repo_slug).exists():
+        git_directory = get_mirror_path(repo_slug)
+    else:
+        return None
+    process = subprocess.run(
+        ["git", "--git-dir", str(git_directory), "ls-tree", "-r", "-l", "HEAD"],
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    if process.returncode != 0:
+        return None
+    # Each line is "<mode> <type> <object> <size>\t<path>"; submodules have no size.
+    tree_size = sum(
+        int(size)
+        for size in (
+            line.split("\t", 1)[0].split()[3] for line in process.stdout.splitlines()
+        )
+        if size.isdigit()
+    )
+    _tree_sizes[repo_path] = tree_size
+    return tree_size
+
+
+def estimate_working_copy_size(
+    repo_path: Path, repo_slug: str, workdir_mode: str
+) -> Union[int, None]:
+    """Estimates the size of a working copy of a clone, with its build outputs.
+    Args:
+        repo_path (Path): The clone in REPOS_PATH.
+        repo_slug (str): The slug of the repository, which is "owner/reponame".
+        workdir_mode (str): How the working copy is made, "copy" or "shared".
+    Returns:
+        Union[int,None]: The size in bytes, or None if it is unknown.
+    """
+    tree_size = get_tree_size(repo_path, repo_slug)
+    if tree_size is None:
+        return None
+    size = tree_size * WORKING_COPY_SIZE_FACTOR
+    if workdir_mode == "copy" and (repo_path / ".git").exists():
+        if repo_path not in _git_sizes:
+            git_directory = repo_path / ".git"
+            _git_sizes[repo_path] = measure_sizes([git_directory]).get(git_directory, 0)
+        size += _git_sizes[repo_path]
+    return size
+
+
+def get_available_memory() -> Union[int, None]:
+    """Returns the memory available for new allocations without swapping.
+    Returns:
+        Union[int,None]: MemAvailable in /proc/meminfo in bytes, or None if it is
+            unknown.
+    """
+    try:
+        with open("/proc/meminfo", encoding="ascii") as f:
+            for line in f:
+                # The line is "MemAvailable:   <size> kB".
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def get_reservations_directory() -> Path:
+    """Returns the directory of the reservations of the tmpfs."""
+    assert TMPFS_WORKDIR_DIRECTORY is not None
+    return TMPFS_WORKDIR_DIRECTORY / ".reservations"
+
+
+def get_reserved_size() -> int:
+    """Returns the space reserved by live processes, deleting the reservations of
+    the processes that died.  The caller must hold the lock of the reservations."""
+    reserved_size = 0
+    for reservation_file in get_reservations_directory().glob("*.json"):
+        try:
+            reservation = json.loads(reservation_file.read_text(encoding="utf-8"))
+        except (OSError, json.JSONDecodeError):
+            continue
+        if not is_process_alive(reservation):
+            reservation_file.unlink(missing_ok=True)
+            continue
+        reserved_size += reservation["size"]
+    return reserved_size
+
+
+def reserve_tmpfs(size: Union[int, None]) -> Union[TmpfsReservation, None]:
+    """Reserves space on the tmpfs for a working copy.
+    Args:
+        size (Union[int,None]): The estimated size of the working copy, in bytes.
+    Returns:
+        Union[TmpfsReservation,None]: The reservation, or None if the tmpfs is not
+            configured, the size is unknown, or the working copy does not fit.
+    """
+    if TMPFS_WORKDIR_DIRECTORY is None or size is None:
+        return None
+    reservations_directory = get_reservations_directory()
+    reservations_directory.mkdir(parents=True, exist_ok=True)
+    with fasteners.InterProcessLock(reservations_directory / "lock"):
+        reserved_size = get_reserved_size()
+        disk_usage = shutil.disk_usage(TMPFS_WORKDIR_DIRECTORY)
+        budget = parse_size(TMPFS_BUDGET) if TMPFS_BUDGET else disk_usage.total
+        # The reserved space that the working copies have not written yet.
+        unused_reserved_size = max(0, reserved_size - disk_usage.used)
+        available_memory = get_available_memory()
+        if (
+            reserved_size + size > budget
+            or unused_reserved_size + size > disk_usage.free
+            or (
+                available_memory is not None
+                and unused_reserved_size + size > available_memory
+            )
+        ):
+            logger.debug(
+                f"reserve_tmpfs: {size} bytes do not fit, {reserved_size} of "
+                f"{budget} bytes are reserved ({unused_reserved_size} not used "
+                f"yet), {disk_usage.free} bytes are free and {available_memory} "
+                "bytes of memory are available"
+            )
+            return None
+        reservation_file = reservations_directory / (uuid.uuid4().hex + ".json")
+        reservation = {
+            "size": size,
+            "pid": os.getpid(),
+            "host": socket.gethostname(),
+        }
+        reservation_file.write_text(json.dumps(reservation), encoding="utf-8")
+    return TmpfsReservation(reservation_file)
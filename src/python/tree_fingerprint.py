@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Computes the tree fingerprint of a working copy, without spawning a process
+per file.  There are two modes, selected by AST_FINGERPRINT_MODE:
+- "compat" (default): reproduces the fingerprint of the shell pipeline
+      cd <dir>; find . -type f -not -path '*/\\.git*' -exec sha256sum {} \\; \\
+          | LC_ALL=C sort | sha256sum
+  so the fingerprints in existing caches stay valid.  The files are hashed in a
+  thread pool.
+- "git": the id of the tree that `git add --all --force && git write-tree` would
+  write, computed with a temporary index so the index of the working copy is not
+  modified.  git only rehashes the files whose stat data changed since the index
+  was written, which makes it faster on large repositories, but its fingerprints
+  differ from the "compat" ones, so a cache must not mix the two modes.
+compute_tree_object_fingerprint computes the fingerprint that a checkout of a
+tree object would have from the object store, without checking it out.
+usage: python3 tree_fingerprint.py <directory> [--mode compat|git]
+prints the tree fingerprint of the directory.
+"""
+
+import argparse
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+
+FINGERPRINT_MODES = ("compat", "git")
+# The number of threads that hash the files of a working copy.
+N_HASH_THREADS = 8
+MAX_MEMOIZED_BLOB_DIGESTS = 200000
+
+# The sha256 of the blobs hashed by compute_tree_object_fingerprint, by object id.
+_blob_digests: Dict[bytes, bytes] = {}
+
+
+def list_fingerprinted_files(directory: Path) -> List[bytes]:
+    """Lists the files that `find . -type f -not -path '*/\\.git*'` lists.
+    That is the regular files (not the symbolic links) whose path, relative to
+    the directory and starting with "./", does not contain "/.git".  Symbolic
+    links to directories are not followed.
+    Args:
+        directory (Path): The directory.
+    Returns:
+        List[bytes]: The paths of the files, starting with "./".
+    """
+    files = []
+    directories = [b"."]
+    root = os.fsencode(directory)
+    while directories:
+        relative_directory = directories.pop()
+        with os.scandir(os.path.join(root, relative_directory)) as entries:
+            for entry in entries:
+                path = relative_directory + b"/" + entry.name
+                # Every path below a path containing "/.git" also contains it.
+                if b"/.git" in path:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(path)
+                elif entry.is_file(follow_symlinks=False):
+                    files.append(path)
+    return files
+
+
+def sha256sum_line(directory: Path, path: bytes) -> Union[bytes, None]:
+    """Returns the line that `sha256sum <path>` prints, or None if the file
+    cannot be read (sha256sum then prints an error instead).
+    As sha256sum does, a path containing a backslash, a newline or a carriage
+    return is escaped and the line is prefixed with a backslash.
+    """
+    try:
+        with open(os.path.join(os.fsencode(directory), path), "rb") as f:
+            digest = hashlib.file_digest(f, "sha256").hexdigest().encode("ascii")
+    except OSError:
+        return None
+    return format_sha256sum_line(digest, path)
+
+
+def format_sha256sum_line(digest: bytes, path: bytes) -> bytes:
+    """Returns the line that sha256sum prints for a file.
+    Args:
+        digest (bytes): The hexadecimal sha256 of the file.
+        path (bytes): The path of the file, as passed to sha256sum.
+    """
+    escaped_path = (
+        path.replace(b"\\", b"\\\\").replace(b"\n", b"\\n").replace(b"\r", b"\\r")
+    )
+    if escaped_path != path:
+        return b"\\" + digest + b"  " + escaped_path + b"\n"
+    return digest + b"  " + path + b"\n"
+
+
+def compute_compat_fingerprint(directory: Path) -> str:
+    """Computes the fingerprint of the "compat" mode.
+    Args:
+        directory (Path): The working copy.
+    Returns:
+        str: The sha256 of the bytewise-sorted sha256sum lines of the files.
+    """
+    files = list_fingerprinted_files(directory)
+    with ThreadPoolExecutor(max_workers=N_HASH_THREADS) as executor:
+        lines = [
+            line
+            for line in executor.map(
+                lambda path: sha256sum_line(directory, path), files
+            )
+            if line is not None
+        ]
+    return hashlib.sha256(b"".join(sorted(lines))).hexdigest()
+
+
+def compute_git_fingerprint(directory: Path) -> str:
+    """Computes the fingerprint of the "git" mode.
+    Args:
+        directory (Path): The working copy, which must be a git repository.
+    Returns:
+        str: The id of the tree of all files of the working copy, ignored or not.
+    Raises:
+        subprocess.CalledProcessError: If a git command fails.
+    """
+    git_directory = subprocess.run(
+        ["git", "rev-parse", "--absolute-git-dir"],
+        cwd=directory,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+    with tempfile.TemporaryDirectory(prefix="fingerprint-") as temporary_directory:
+        index_path = Path(temporary_directory) / "index"
+        # Starting from the index of the working copy, git does not rehash the
+        # files that are unchanged since it was written.
+        if (Path(git_directory) / "index").exists():
+            shutil.copyfile(Path(git_directory) / "index", index_path)
+        env = dict(os.environ, GIT_INDEX_FILE=str(index_path))
+        subprocess.run(
+            ["git", "add", "--all", "--force", "."],
+            cwd=directory,
+            env=env,
+            check=True,
+            capture_output=True,
+        )
+        return subprocess.run(
+            ["git", "write-tree"],
+            cwd=directory,
+            env=env,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+
+
+def list_tree(git_directory: Path, tree: str) -> List[Tuple[bytes, bytes, bytes]]:
+    """Lists the files of a tree object recursively, with `git ls-tree -r`.
+    Args:
+        git_directory (Path): The git directory that contains the tree.
+        tree (str): The tree, or a commit.
+    Returns:
+        List[Tuple[bytes,bytes,bytes]]: The mode, the object id and the path of
+            each file, symbolic link and submodule.
+    Raises:
+        subprocess.CalledProcessError: If the tree cannot be listed.
+    """
+    output = subprocess.run(
+        ["git", "--git-dir", str(git_directory), "ls-tree", "-r", "-z", tree],
+        check=True,
+        capture_output=True,
+    ).stdout
+    entries = []
+    for entry in output.split(b"\0"):
+        if not entry:
+            continue
+        # Each entry is "<mode> <type> <object>\t<path>".
+        metadata, path = entry.split(b"\t", 1)
+        mode, _, object_id = metadata.split(b" ")
+        entries.append((mode, object_id, path))
+    return entries
+
+
+def hash_blobs(git_directory: Path, object_ids: List[bytes]) -> Dict[bytes, bytes]:
+    """Computes the sha256 of blobs, reading them with a single
+    `git cat-file --batch`.  The digests are memoized in _blob_digests.
+    Args:
+        git_directory (Path): The git directory that contains the blobs.
+        object_ids (List[bytes]): The object ids of the blobs.
+    Returns:
+        Dict[bytes,bytes]: The hexadecimal sha256 of each blob.
+    Raises:
+        subprocess.CalledProcessError: If a blob cannot be read.
+    """
+    digests = {
+        object_id: _blob_digests[object_id]
+        for object_id in object_ids
+        if object_id in _blob_digests
+    }
+    missing = list(dict.fromkeys(o for o in object_ids if o not in digests))
+    if not missing:
+        return digests
+    command = ["git", "--git-dir", str(git_directory), "cat-file", "--batch"]
+    with subprocess.Popen(
+        command, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+    ) as process:
+        assert process.stdin is not None and process.stdout is not None
+        stdin = process.stdin
+
+        def write_object_ids() -> None:
+            with stdin:
+                for object_id in missing:
+                    stdin.write(object_id + b"\n")
+
+        # The object ids are written by a thread, so that neither pipe fills up.
+        writer = threading.Thread(target=write_object_ids)
+        writer.start()
+        for object_id in missing:
+            # The header is "<object> <type> <size>", or "<object> missing".
+            header = process.stdout.readline().split()
+            if len(header) != 3:
+                process.kill()
+                writer.join()
+                raise subprocess.CalledProcessError(1, command, object_id)
+            remaining = int(header[2])
+            sha256 = hashlib.sha256()
+            while remaining > 0:
+                chunk = process.stdout.read(min(remaining, 1 << 20))
+                sha256.update(chunk)
+                remaining -= len(chunk)
+            process.stdout.read(1)  # The newline after the content.
+            digests[object_id] = sha256.hexdigest().encode("ascii")
+        writer.join()
+    for object_id in missing:
+        if len(_blob_digests) >= MAX_MEMOIZED_BLOB_DIGESTS:
+            del _blob_digests[next(iter(_blob_digests))]
+        _blob_digests[object_id] = digests[object_id]
+    return digests
+
+
+def compute_tree_object_fingerprint(
+    git_directory: Path,
+    tree: str,
+    mode: str = "compat",
+    entries: Union[List[Tuple[bytes, bytes, bytes]], None] = None,
+) -> str:
+    """Computes the tree fingerprint that a clean checkout of a tree object would
+    have, without checking it out.  The tree must have no submodule and no
+    .gitattributes, and checkouts must not convert line endings: the files of
+    the checkout are then exactly the blobs of the tree.
+    Args:
+        git_directory (Path): The git directory that contains the tree.
+        tree (str): The id of the tree.
+        mode (str, optional) = "compat": One of FINGERPRINT_MODES.
+        entries (Union[List[Tuple[bytes,bytes,bytes]],None], optional) = None: The
+            entries of the tree, as returned by list_tree, if they are known.
+    Returns:
+        str: The tree fingerprint.
+    """
+    if mode not in FINGERPRINT_MODES:
+        raise ValueError(f"Unknown fingerprint mode: {mode}")
+    if mode == "git":
+        return tree
+    if entries is None:
+        entries = list_tree(git_directory, tree)
+    # The files that list_fingerprinted_files would list in the checkout.
+    files = [
+        (object_id, b"./" + path)
+        for file_mode, object_id, path in entries
+        if file_mode.startswith(b"100") and b"/.git" not in b"/" + path
+    ]
+    digests = hash_blobs(git_directory, [object_id for object_id, _ in files])
+    lines = [
+        format_sha256sum_line(digests[object_id], path) for object_id, path in files
+    ]
+    return hashlib.sha256(b"".join(sorted(lines))).hexdigest()
+
+
+def compute_tree_fingerprint(directory: Path, mode: str = "compat") -> str:
+    """Computes the tree fingerprint of a working copy.
+    Args:
+        directory (Path): The working copy.
+        mode (str, optional) = "compat": The mode, in FINGERPRINT_MODES.
+    Returns:
+        str: The tree fingerprint.
+    """
+    if mode == "compat":
+        return compute_compat_fingerprint(directory)
+    if mode == "git":
+        return compute_git_fingerprint(directory)
+    raise ValueError(f"Unknown fingerprint mode {mode}, expected {FINGERPRINT_MODES}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", type=Path)
+    parser.add_argument("--mode", choices=FINGERPRINT_MODES, default="compat")
+    args = parser.parse_args()
+    print(compute_tree_fingerprint(args.directory, args.mode))
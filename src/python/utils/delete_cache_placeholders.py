@@ -4,7 +4,9 @@
 Deletes all placeholders from the cache. Placeholders are created when a
 a process starts; it indicates that is has started and is still running.
 If the process fails, the placeholder is not replaced with the actual
-result. This script deletes all placeholders from the cache.
+result. This script deletes all placeholders from the cache, both from
+the JSON files and from the SQLite databases (cache.sqlite3).
+A placeholder is either None or a lease (see cache_utils.py).
 
 Usage:
     python delete_cache_placeholders.py --cache_directory <path_to_cache>
@@ -15,7 +17,21 @@ Args:
 
 from argparse import ArgumentParser
 from pathlib import Path
-import json
+import sqlite3
+import sys
+from loguru import logger
+
+# The script is run as src/python/utils/delete_cache_placeholders.py.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from cache_utils import (  # noqa: E402
+    LEASE_KEY,
+    ZSTD_MAGIC,
+    decode_cache_data,
+    encode_cache_data,
+    is_placeholder,
+    write_file_atomically,
+)
+
 
 if __name__ == "__main__":
     parser = ArgumentParser()
@@ -30,19 +46,50 @@ if __name__ == "__main__":
     for file in cache_directory.glob("**/*.json"):
         if file.is_dir():
             continue
+        with open(file, "rb") as f:
+            raw_data = f.read()
         try:
-            with open(file, "r", encoding="utf-8") as f:
-                data = json.load(f)
-        except json.JSONDecodeError:
-            print(f"Could not read {file}")
-            file.unlink()
+            data = decode_cache_data(raw_data)
+        except Exception as e:
+            logger.warning(f"delete_cache_placeholders: Could not read {file}: {e}")
             continue
 
-        for key in list(data.keys()):
-            if data[key] is None:
-                data.pop(key)
+        if "shards" in file.parts:
+            # A file of the sharded layout holds a single entry.
+            if is_placeholder(data["value"]):
+                file.unlink()
                 n_deleted += 1
+            continue
+
+        placeholders = [key for key in data if is_placeholder(data[key])]
+        if not placeholders:
+            continue
+        for key in placeholders:
+            data.pop(key)
+            n_deleted += 1
+
+        # The file keeps its encoding, and is replaced atomically since readers
+        # of the cache do not take a lock.
+        if raw_data.startswith(ZSTD_MAGIC):
+            encoding = "zstd"
+        elif b"\n" in raw_data:
+            encoding = "json"
+        else:
+            encoding = "compact"
+        write_file_atomically(file, encode_cache_data(data, encoding))
 
-        with open(file, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=4, sort_keys=True)
+    for database in cache_directory.glob("**/cache.sqlite3"):
+        connection = sqlite3.connect(database, isolation_level=None)
+        tables = connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"
+        ).fetchall()
+        for (table,) in tables:
+            quoted_table = '"' + table.replace('"', '""') + '"'
+            cursor = connection.execute(
+                f"DELETE FROM {quoted_table} WHERE value = 'null' "
+                "OR json_extract(value, ?) IS NOT NULL",
+                (f"$.{LEASE_KEY}",),
+            )
+            n_deleted += cursor.rowcount
+        connection.close()
     print(f"Deleted {n_deleted} placeholders")
@@ -13,12 +13,55 @@ DELETE_WORKDIRS = True
 REPOS_PATH = (
     Path(os.getenv("AST_REPOS_PATH")) if os.getenv("AST_REPOS_PATH") else Path("repos")
 )
+# Whether to work without network access: the clones are made from the local
+# mirrors as they are, without fetching (AST_OFFLINE=1).
+OFFLINE = os.getenv("AST_OFFLINE", "0") == "1"
+# The disk budget of the clones and working copies, e.g. "500G" (see
+# storage_manager.py).  Unset, nothing is evicted.
+DISK_BUDGET = os.getenv("AST_DISK_BUDGET", "")
+# The bare mirrors that the clones in REPOS_PATH are made from (see mirror_store.py).
+MIRRORS_PATH = REPOS_PATH / ".mirrors"
+# The persistent index of the merge bases of each repository (see
+# merge_base_index.py).  FindMergeCommits.java reads it from the same place.
+MERGE_BASE_INDEX_PATH = (
+    Path(os.getenv("AST_MERGE_BASE_INDEX"))
+    if os.getenv("AST_MERGE_BASE_INDEX")
+    else REPOS_PATH / ".merge_bases"
+)
 WORKDIR_DIRECTORY = Path(
     ".workdir"
 )  # Merges and testing will be performed in this directory.
+# A directory on a RAM-backed file system for the working copies that fit in it,
+# and its budget, e.g. "32G" (see tmpfs_workdir.py).
+TMPFS_WORKDIR_DIRECTORY = (
+    Path(os.getenv("AST_TMPFS_WORKDIR")) if os.getenv("AST_TMPFS_WORKDIR") else None
+)
+TMPFS_BUDGET = os.getenv("AST_TMPFS_BUDGET", "")
+# How a working copy is made from the clone in REPOS_PATH: "copy" (a full copy,
+# including the object store) or "shared" (a `git clone --shared`, which borrows
+# the objects of the clone instead of copying them).
+WORKDIR_MODE = os.getenv("AST_WORKDIR_MODE", "copy")
+# The maximum number of reusable working copies kept in WORKDIR_DIRECTORY/pool
+# (see workdir_pool.py).
+WORKDIR_POOL_SIZE = int(os.getenv("AST_WORKDIR_POOL_SIZE", "64"))
+# How tree fingerprints are computed: "compat" (the sha256sum fingerprints of
+# the existing caches) or "git" (git tree ids).  See tree_fingerprint.py.
+FINGERPRINT_MODE = os.getenv("AST_FINGERPRINT_MODE", "compat")
 
 TIMEOUT_MERGING = 60 * 15  # 15 minutes, in seconds
 
 TIMEOUT_TESTING_PARENT = 60 * 30  # 30 minutes, in seconds
 TIMEOUT_TESTING_MERGE = 60 * 45  # 45 minutes, in seconds
 N_TESTS = 5
+
+# Storage of the caches: "json" (one file per repository), "sharded" (one file
+# per cache entry), or "sqlite" (one database per cache root).  See cache_utils.py.
+CACHE_BACKEND = os.getenv("AST_CACHE_BACKEND", "json")
+# Encoding of the cache files of the "json" and "sharded" backends: "json"
+# (indented, the format of the archived cache), "compact" (JSON without
+# whitespace), or "zstd" (compact JSON compressed with zstd).  Files in any
+# encoding can be read, whatever this setting.
+CACHE_ENCODING = os.getenv("AST_CACHE_ENCODING", "json")
+
+# Directory of the cache statistics written by each process (see cache_utils.py).
+CACHE_STATS_DIRECTORY = Path(os.getenv("AST_CACHE_STATS_DIR", "cache_stats"))
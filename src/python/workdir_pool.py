@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""A pool of reusable working copies, in WORKDIR_DIRECTORY/pool/<repo_slug>/slot-<n>/.
+A Repository created with use_pool=True takes a free slot of its repository
+instead of copying the clone into a new workdir, and returns the slot when it is
+deleted.  A reused working copy is reset to the state of a fresh copy by
+reset_working_copy.
+Each slot is held with an inter-process lock (and, within a process, recorded in
+_held_slots, since the locks only exclude other processes).  The slots of a
+repository are acquired and created under the lock of the repository, so
+processes working on different repositories do not wait for each other.  The
+pool holds at most WORKDIR_POOL_SIZE slots; after a new slot is created, the
+least recently used free slots are evicted: they are chosen under the lock of
+the whole pool, and moved to the trash (see workdir_reaper.py) after it is
+released.
+"""
+
+import os
+import shutil
+import subprocess
+from pathlib import Path
+from typing import List, Set, Union
+import fasteners
+from loguru import logger
+from workdir_reaper import trash_workdir
+from variables import (
+    WORKDIR_DIRECTORY,
+    WORKDIR_POOL_SIZE,
+    LEFT_BRANCH_NAME,
+    RIGHT_BRANCH_NAME,
+)
+
+POOL_DIRECTORY = WORKDIR_DIRECTORY / "pool"
+# The file whose modification time records when a slot was last released.
+LAST_USED_FILE_NAME = ".last_used"
+
+# The slots held by this process.
+_held_slots: Set[Path] = set()
+
+
+class WorkdirPoolSlot:
+    """A slot of the pool, held by this process until release is called."""
+
+    def __init__(self, path: Path, lock: fasteners.InterProcessLock) -> None:
+        """Initializes the slot.
+        Args:
+            path (Path): The directory of the slot, which is the workdir.
+            lock (fasteners.InterProcessLock): The acquired lock of the slot.
+        """
+        self.path = path
+        self.lock = lock
+        # Whether the working copy in the slot was used before and must be reset.
+        self.needs_reset = True
+
+    def release(self) -> None:
+        """Returns the slot to the pool."""
+        if self.path not in _held_slots:
+            return
+        try:
+            (self.path / LAST_USED_FILE_NAME).touch()
+        except FileNotFoundError:
+            # The slot was deleted, e.g. with the clone of its repository.
+            pass
+        _held_slots.discard(self.path)
+        self.lock.release()
+
+
+def get_slot_lock(slot_path: Path) -> fasteners.InterProcessLock:
+    """Returns the lock of a slot."""
+    return fasteners.InterProcessLock(slot_path.with_suffix(".lock"))
+
+
+def try_acquire_slot(slot_path: Path) -> Union[WorkdirPoolSlot, None]:
+    """Acquires a slot if it is free.
+    Args:
+        slot_path (Path): The directory of the slot.
+    Returns:
+        Union[WorkdirPoolSlot,None]: The slot, or None if it is held by a process.
+    """
+    if slot_path in _held_slots:
+        return None
+    lock = get_slot_lock(slot_path)
+    if not lock.acquire(blocking=False):
+        return None
+    _held_slots.add(slot_path)
+    return WorkdirPoolSlot(slot_path, lock)
+
+
+def list_slots() -> List[Path]:
+    """Returns the directories of all slots of the pool."""
+    return [path for path in POOL_DIRECTORY.glob("*/*/slot-*") if path.is_dir()]
+
+
+def get_last_use_time(slot_path: Path) -> float:
+    """Returns when a slot was last released."""
+    try:
+        return (slot_path / LAST_USED_FILE_NAME).stat().st_mtime
+    except FileNotFoundError:
+        return slot_path.stat().st_mtime
+
+
+def acquire_workdir(repo_slug: str) -> WorkdirPoolSlot:
+    """Acquires a free slot of the pool for a repository, creating one if needed.
+    Args:
+        repo_slug (str): The slug of the repository, which is "owner/reponame".
+    Returns:
+        WorkdirPoolSlot: The slot.  Its directory is the workdir of the repository.
+    """
+    repo_pool_directory = POOL_DIRECTORY / repo_slug
+    repo_pool_directory.mkdir(parents=True, exist_ok=True)
+    with fasteners.InterProcessLock(repo_pool_directory.with_suffix(".lock")):
+        slot_paths = [
+            path for path in repo_pool_directory.glob("slot-*") if path.is_dir()
+        ]
+        for slot_path in sorted(slot_paths, key=get_last_use_time, reverse=True):
+            slot = try_acquire_slot(slot_path)
+            if slot is not None:
+                return slot
+        slot_index = 0
+        while True:
+            slot_path = repo_pool_directory / f"slot-{slot_index}"
+            slot_index += 1
+            # The lock of a slot that is being evicted is held until it is trashed.
+            if slot_path.exists():
+                continue
+            new_slot = try_acquire_slot(slot_path)
+            if new_slot is not None:
+                break
+        slot_path.mkdir()
+        new_slot.needs_reset = False
+    with fasteners.InterProcessLock(POOL_DIRECTORY / "pool.lock"):
+        evicted_slots = choose_evicted_slots(WORKDIR_POOL_SIZE)
+    delete_slots(evicted_slots)
+    return new_slot
+
+
+def choose_evicted_slots(max_slots: int) -> List[WorkdirPoolSlot]:
+    """Acquires the least recently used free slots that must be evicted for the
+    pool to hold at most max_slots slots.  The caller must hold the lock of the
+    pool, and delete the slots with delete_slots once it is released.
+    Args:
+        max_slots (int): The maximum number of slots.
+    Returns:
+        List[WorkdirPoolSlot]: The slots to evict.
+    """
+    slot_paths = list_slots()
+    evicted_slots: List[WorkdirPoolSlot] = []
+    for slot_path in sorted(slot_paths, key=get_last_use_time):
+        if len(slot_paths) - len(evicted_slots) <= max_slots:
+            break
+        slot = try_acquire_slot(slot_path)
+        if slot is not None:
+            evicted_slots.append(slot)
+    return evicted_slots
+
+
+def delete_slots(slots: List[WorkdirPoolSlot]) -> None:
+    """Moves slots acquired by choose_evicted_slots to the trash, and releases
+    their locks."""
+    for slot in slots:
+        logger.debug(f"delete_slots: Deleting {slot.path}")
+        trash_workdir(slot.path)
+        _held_slots.discard(slot.path)
+        slot.lock.release()
+
+
+def reset_working_copy(local_repo_path: Path, repo_path: Path) -> None:
+    """Resets a reused working copy to the state of a fresh working copy of the clone.
+    The files are reset to HEAD and every untracked or ignored file is deleted, in
+    the working copy and in its submodules, which are checked out again at the
+    commits recorded in HEAD; the branches created by Repository.create_branch are deleted, and the configuration
+    and attributes that the merge tools write in .git are restored from the clone.
+    A working copy made by copying the clone also fetches the refs of the clone,
+    which may have been updated; one made with `git clone --shared` borrows the
+    objects of the clone and does not need to.
+    Args:
+        local_repo_path (Path): The working copy.
+        repo_path (Path): The clone in REPOS_PATH.
+    Raises:
+        subprocess.CalledProcessError: If a git command fails.
+    """
+
+    def git(*args: str) -> str:
+        return subprocess.run(
+            ["git", *args],
+            cwd=local_repo_path,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+
+    git("reset", "--hard", "--quiet")
+    git("clean", "-ffdxq")
+    git("checkout", "--detach", "--quiet")
+    if (local_repo_path / ".gitmodules").exists():
+        git(
+            "submodule",
+            "foreach",
+            "--quiet",
+            "--recursive",
+            "git reset --hard --quiet && git clean -ffdxq",
+        )
+        git("submodule", "update", "--quiet", "--recursive", "--force")
+    for branch_name in (LEFT_BRANCH_NAME, RIGHT_BRANCH_NAME):
+        if git("branch", "--list", branch_name):
+            git("branch", "-D", branch_name)
+    shutil.copyfile(repo_path / ".git" / "config", local_repo_path / ".git" / "config")
+    attributes_path = Path("info") / "attributes"
+    if (repo_path / ".git" / attributes_path).exists():
+        shutil.copyfile(
+            repo_path / ".git" / attributes_path,
+            local_repo_path / ".git" / attributes_path,
+        )
+    else:
+        (local_repo_path / ".git" / attributes_path).unlink(missing_ok=True)
+    if (local_repo_path / ".git" / "objects" / "info" / "alternates").exists():
+        git("config", "gc.auto", "0")
+    else:
+        git(
+            "fetch",
+            "--quiet",
+            "--update-head-ok",
+            "--no-tags",
+            str(repo_path.resolve()),
+            "+refs/*:refs/*",
+        )
+
+
+def _reset_pool_after_fork() -> None:
+    """Forgets the slots of the parent process in a forked child process,
+    which does not hold their locks.
+    """
+    _held_slots.clear()
+
+
+os.register_at_fork(after_in_child=_reset_pool_after_fork)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Deletes workdirs in the background.
+trash_workdir moves a directory into TRASH_DIRECTORY, which is a rename and
+returns at once, and starts the reaper if it is not running.  The reaper is a
+process with the lowest CPU and I/O priority (nice 19, idle I/O class) that
+deletes the contents of TRASH_DIRECTORY, and exits once it has been empty for
+REAPER_IDLE_TIME seconds.  At most one reaper runs at a time.
+Directories that cannot be renamed into TRASH_DIRECTORY, e.g. because they are
+on another file system, are deleted at once.
+usage: python3 workdir_reaper.py
+runs the reaper.
+"""
+
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import time
+import uuid
+from pathlib import Path
+from typing import Union
+import fasteners
+import psutil
+from loguru import logger
+from variables import WORKDIR_DIRECTORY
+
+TRASH_DIRECTORY = WORKDIR_DIRECTORY / ".trash"
+REAPER_LOCK_PATH = TRASH_DIRECTORY / "reaper.lock"
+# How long the reaper waits for new directories before exiting, in seconds.
+REAPER_IDLE_TIME = 10
+
+# The reaper started by this process, until it is known to have exited.
+_reaper_process: Union[subprocess.Popen, None] = None
+
+
+def make_writable_and_retry(function, path, _error) -> None:
+    """An error handler for shutil.rmtree that makes a path and its parent
+    writable, as `chmod -R 777` did, and retries the deletion.  The error, which
+    is the exception (onexc) or its exc_info (onerror), is not used."""
+    for changed_path in (os.path.dirname(path), path):
+        try:
+            os.chmod(changed_path, stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO)
+        except OSError:
+            pass
+    try:
+        function(path)
+    except FileNotFoundError:
+        pass
+
+
+def delete_directory(path: Union[Path, str]) -> None:
+    """Deletes a directory, including its read-only parts."""
+    if sys.version_info >= (3, 12):
+        shutil.rmtree(path, onexc=make_writable_and_retry)
+    else:
+        shutil.rmtree(path, onerror=make_writable_and_retry)
+
+
+def trash_workdir(path: Union[Path, str]) -> None:
+    """Moves a directory into the trash, to be deleted by the reaper.
+    Args:
+        path (Union[Path,str]): The directory.  Nothing is done if it does not exist.
+    """
+    if not os.path.lexists(path):
+        return
+    TRASH_DIRECTORY.mkdir(parents=True, exist_ok=True)
+    try:
+        os.rename(path, TRASH_DIRECTORY / uuid.uuid4().hex)
+    except OSError as e:
+        logger.debug(f"trash_workdir: Deleting {path} at once: {e}")
+        delete_directory(path)
+        return
+    start_reaper()
+
+
+def start_reaper() -> None:
+    """Starts the reaper unless it is running.  The reaper started by this process
+    is polled first, which also collects its exit status once it has exited, so
+    that it does not remain a zombie process."""
+    global _reaper_process
+    if _reaper_process is not None:
+        if _reaper_process.poll() is None:
+            return
+        _reaper_process = None
+    lock = fasteners.InterProcessLock(REAPER_LOCK_PATH)
+    if not lock.acquire(blocking=False):
+        return
+    lock.release()
+    _reaper_process = subprocess.Popen(
+        [sys.executable, str(Path(__file__).resolve())],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def run_reaper() -> None:
+    """Deletes the contents of the trash until it has been empty for
+    REAPER_IDLE_TIME seconds, unless another reaper is running."""
+    TRASH_DIRECTORY.mkdir(parents=True, exist_ok=True)
+    lock = fasteners.InterProcessLock(REAPER_LOCK_PATH)
+    # The process that started the reaper may still hold the lock for a moment.
+    if not lock.acquire(timeout=1):
+        return
+    undeletable = set()
+    try:
+        os.nice(19)
+        psutil.Process().ionice(psutil.IOPRIO_CLASS_IDLE)
+        idle_since = time.monotonic()
+        while time.monotonic() - idle_since < REAPER_IDLE_TIME:
+            trashed = set(TRASH_DIRECTORY.iterdir()) - {REAPER_LOCK_PATH} - undeletable
+            for path in trashed:
+                try:
+                    delete_directory(path)
+                except OSError as e:
+                    logger.error(f"run_reaper: Could not delete {path}: {e}")
+                    undeletable.add(path)
+            if trashed:
+                idle_since = time.monotonic()
+            else:
+                time.sleep(1)
+    finally:
+        lock.release()
+    # A directory trashed while this reaper was exiting did not start a reaper.
+    if set(TRASH_DIRECTORY.iterdir()) - {REAPER_LOCK_PATH} - undeletable:
+        start_reaper()
+
+
+def _reset_reaper_after_fork() -> None:
+    """Forgets the reaper of the parent process in a forked child process, which
+    cannot wait for it."""
+    global _reaper_process
+    _reaper_process = None
+
+
+os.register_at_fork(after_in_child=_reset_reaper_after_fork)
+
+
+if __name__ == "__main__":
+    run_reaper()